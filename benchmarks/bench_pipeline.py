@@ -0,0 +1,209 @@
+#! /usr/bin/env python3
+"""
+This script benchmarks the stages of readSave_HLC_SLC_charges.main on synthetic data:
+    ingest: read_calibrationFromRuns over the synthetic frames
+    crossover: calculate_crossOverPoints
+    fit: calculate_p0_p1
+    save_jsonl: build_resultColumns and save_jsonl
+    save_pickle: save_pickle
+For each dataset size the wall time, CPU time, hits/s and peak RSS of every stage
+are reported in JSON, with the ingest counters and timers (see utils.metrics). Each size runs in its own process, so that the peak RSS of one size
+is not hidden by a larger one.
+Without the IceCube software a minimal stand-in of the icecube modules is used
+(see benchmarks.standin_icecube), the frames always come from benchmarks.synthetic.
+
+__author__ = Federico Bontempo KIT PhD student <federico.bontempo@kit.edu>
+
+How to run (from the repository directory):
+python3 -m benchmarks.bench_pipeline \
+    --sizes 100000 300000 1000000 \
+    --output <output path + name + .json>
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+from benchmarks import standin_icecube
+
+STANDIN_ICECUBE = standin_icecube.install()
+
+from icecube import icetray
+
+import readSave_HLC_SLC_charges as readSave
+from utils.calculate_p0_p1 import fit_channelMoments, fit_to_dict
+from utils.channel_index import N_DOMS
+from utils.columnar_results import build_resultColumns
+from utils.crossover_points import calculate_crossOverPoints
+from utils.metrics import Metrics
+from benchmarks.synthetic import SyntheticI3File, generate_frames, generate_hits
+
+
+def get_args():
+    p = argparse.ArgumentParser()
+    p.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[100000, 300000, 1000000],
+        help="Numbers of hits of the synthetic datasets",
+    )
+    p.add_argument(
+        "--hitsPerFrame", type=int, default=40, help="Number of hits in each frame"
+    )
+    p.add_argument("--nFiles", type=int, default=4, help="Number of synthetic files")
+    p.add_argument("--seed", type=int, default=0, help="Seed of the generator")
+    p.add_argument("--output", type=str, default="", help="Output path + name + .json")
+    p.add_argument(
+        "--single",
+        type=int,
+        default=0,
+        help="Run only this size in the current process (used internally)",
+    )
+    return p.parse_args()
+
+
+def peak_rss_mb():
+    """Peak resident set size of the process in MB (ru_maxrss is in kB on Linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+@contextlib.contextmanager
+def stage(results, name, nHits):
+    """
+    Time one stage and record its wall time, CPU time, hits/s and the peak RSS after it.
+    """
+    wall0, cpu0 = time.perf_counter(), time.process_time()
+    yield
+    wall = time.perf_counter() - wall0
+    results[name] = {
+        "wall_s": wall,
+        "cpu_s": time.process_time() - cpu0,
+        "hits_per_s": nHits / wall if wall > 0 else None,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_benchmark(nHits, hitsPerFrame, nFiles, seed, outputDir):
+    """
+    Run all the stages on a synthetic dataset of nHits hits.
+    ----------------------------------
+    Returns:
+        result: A dictionary with the dataset size and the measurements of each stage.
+    """
+    runNumb, year = 1, 2022
+    stages = {}
+    metrics = Metrics()
+
+    with stage(stages, "generate", nHits):
+        frames = generate_frames(
+            generate_hits(nHits, seed=seed),
+            hitsPerFrame=hitsPerFrame,
+            runNumb=runNumb,
+            stop=icetray.I3Frame.DAQ,
+        )
+        files_list = []
+        for i in range(nFiles):
+            fileName = f"synthetic_{nHits}_{i}.i3"
+            SyntheticI3File.registry[fileName] = frames[i::nFiles]
+            files_list.append(fileName)
+
+    # The frames are read from the synthetic files, also with the IceCube software
+    readSave.dataio = types.SimpleNamespace(I3File=SyntheticI3File)
+    args = argparse.Namespace(outputDir=outputDir, runNumb=runNumb, year=year)
+
+    with contextlib.redirect_stdout(sys.stderr):
+        with stage(stages, "ingest", nHits):
+            slc_hlc_q_dict, channelMoments = readSave.create_chargeDicts()
+            startTime, endTime = readSave.read_calibrationFromRuns(
+                slc_hlc_q_dict=slc_hlc_q_dict,
+                channelMoments=channelMoments,
+                files_list=files_list,
+                runNumb=runNumb,
+                frameType="Q",
+                metrics=metrics,
+            )
+        with stage(stages, "crossover", nHits):
+            crossOvers_dict = calculate_crossOverPoints(
+                slc_hlc_q_dict, bad_doms_list=[]
+            )
+        with stage(stages, "fit", nHits):
+            p0_p1_dict = fit_to_dict(fit_channelMoments(channelMoments), range(N_DOMS))
+        with stage(stages, "save_jsonl", nHits):
+            resultColumns = build_resultColumns(
+                p0_p1_dict, crossOvers_dict, runNumb, startTime, endTime
+            )
+            readSave.save_jsonl(resultColumns, args)
+        with stage(stages, "save_pickle", nHits):
+            readSave.save_pickle(p0_p1_dict, crossOvers_dict, args)
+
+    return {
+        "n_hits": nHits,
+        "n_frames": len(frames),
+        "n_files": nFiles,
+        "standin_icecube": STANDIN_ICECUBE,
+        "stages": stages,
+        "ingest_metrics": metrics.to_dict(),
+    }
+
+
+def main(args):
+    if args.single != 0:
+        with tempfile.TemporaryDirectory() as outputDir:
+            result = run_benchmark(
+                args.single, args.hitsPerFrame, args.nFiles, args.seed, outputDir
+            )
+        print(json.dumps(result))
+        return
+
+    results = []
+    for nHits in args.sizes:
+        # One process per size, so that the peak RSS belongs to this size only
+        out = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.bench_pipeline",
+                "--single",
+                str(nHits),
+                "--hitsPerFrame",
+                str(args.hitsPerFrame),
+                "--nFiles",
+                str(args.nFiles),
+                "--seed",
+                str(args.seed),
+            ],
+            check=True,
+            stdout=subprocess.PIPE,
+            text=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        )
+        result = json.loads(out.stdout.splitlines()[-1])
+        results.append(result)
+        print(
+            f"{nHits} hits: "
+            + ", ".join(
+                f"{name} {s['wall_s']:.3f} s" for name, s in result["stages"].items()
+            ),
+            file=sys.stderr,
+        )
+
+    report = {"benchmark": "readSave_HLC_SLC_charges", "results": results}
+    if args.output != "":
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+        print(f"Saved {args.output}", file=sys.stderr)
+    else:
+        print(json.dumps(report, indent=1))
+    return
+
+
+if __name__ == "__main__":
+    main(args=get_args())
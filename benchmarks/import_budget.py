@@ -0,0 +1,121 @@
+#! /usr/bin/env python3
+"""
+This script checks the import time of the icetray-free modules of utils.
+Each module is imported in a fresh process (best of --repeat), the time is compared
+with its budget and the heavy modules (icecube, scipy, matplotlib) must not be loaded
+by the import. The program exits with 1 if a module is over budget or loads a heavy module,
+so it can be run before a release or in a batch job.
+
+__author__ = Federico Bontempo KIT PhD student <federico.bontempo@kit.edu>
+
+How to run (from the repository directory):
+python3 -m benchmarks.import_budget [--budget 0.3] [--repeat 5] [--output <output path + name + .json>]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+CORE_MODULES = (
+    "utils.calculate_p0_p1",
+    "utils.crossover_points",
+    "utils.columnar_results",
+    "utils.charge_store",
+    "utils.calibration_artifact",
+    "utils.trend_extrapolation",
+    "utils.robust_fit",
+    "utils.event_ids",
+    "utils.charge_histograms",
+    "utils.reprocessing",
+    "utils.calibration_history",
+    "utils.calibration_diff",
+    "utils.pipeline",
+    "utils.plot_crossovers",
+    "utils.metrics",
+    "utils.log",
+)
+HEAVY_MODULES = ("icecube", "scipy", "matplotlib")
+
+# Runs in the fresh process: numpy is imported first, it is needed by every module
+# and its import time is not part of the budget
+_PROBE = """
+import json, sys, time
+import numpy
+t0 = time.perf_counter()
+import {module}
+t = time.perf_counter() - t0
+heavy = sorted(m for m in {heavy!r} if m in sys.modules)
+print(json.dumps({{"import_s": t, "heavy": heavy}}))
+"""
+
+
+def get_args():
+    p = argparse.ArgumentParser()
+    p.add_argument(
+        "--budget",
+        type=float,
+        default=0.3,
+        help="Maximum import time of each module in seconds (numpy excluded)",
+    )
+    p.add_argument(
+        "--repeat", type=int, default=5, help="Number of imports of each module"
+    )
+    p.add_argument(
+        "--modules",
+        type=str,
+        nargs="+",
+        default=list(CORE_MODULES),
+        help="Modules to check",
+    )
+    p.add_argument("--output", type=str, default="", help="Output path + name + .json")
+    return p.parse_args()
+
+
+def measure_import(module, repeat):
+    """
+    Import the module in fresh processes and return the best import time
+    and the heavy modules loaded by the import.
+    """
+    times = []
+    heavy = []
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, "-c", _PROBE.format(module=module, heavy=HEAVY_MODULES)],
+            check=True,
+            stdout=subprocess.PIPE,
+            text=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        )
+        result = json.loads(out.stdout.splitlines()[-1])
+        times.append(result["import_s"])
+        heavy = result["heavy"]
+    return min(times), heavy
+
+
+def main(args):
+    results = []
+    failed = False
+    for module in args.modules:
+        importTime, heavy = measure_import(module, args.repeat)
+        ok = importTime <= args.budget and not heavy
+        failed |= not ok
+        results.append(
+            {"module": module, "import_s": importTime, "heavy": heavy, "ok": ok}
+        )
+        print(
+            f"{'ok  ' if ok else 'FAIL'} {module}: {importTime * 1e3:.1f} ms"
+            + (f", loads {', '.join(heavy)}" if heavy else ""),
+            file=sys.stderr,
+        )
+
+    if args.output != "":
+        with open(args.output, "w") as f:
+            json.dump({"budget_s": args.budget, "results": results}, f, indent=1)
+        print(f"Saved {args.output}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(args=get_args()))
@@ -0,0 +1,88 @@
+"""
+This script installs a minimal stand-in of the icecube modules used by the calibration
+pipeline (icetray.OMKey, icetray.I3Frame stops, i3logging, dataio.I3File), so that the
+benchmarks can run where the IceCube software is not available.
+It is only installed by the benchmarks and only if "import icecube" fails.
+
+Functions:
+    install: Registers the stand-in modules in sys.modules.
+"""
+
+import sys
+import types
+
+from benchmarks.synthetic import DAQ_STOP, PHYSICS_STOP, SyntheticI3File
+
+
+class OMKey(tuple):
+    """
+    A stand-in of icetray.OMKey, hashable and picklable.
+    """
+
+    def __new__(cls, string, om, pmt=0):
+        return tuple.__new__(cls, (string, om))
+
+    def __getnewargs__(self):
+        return tuple(self)
+
+    string = property(lambda self: self[0])
+    om = property(lambda self: self[1])
+
+    def __repr__(self):
+        return f"OMKey({self[0]},{self[1]},0)"
+
+
+def _log(*args, **kwargs):
+    pass
+
+
+def _log_fatal(message, *args, **kwargs):
+    raise RuntimeError(message)
+
+
+def install():
+    """
+    Register the stand-in icecube modules, unless the IceCube software is available.
+    ----------------------------------
+    Returns:
+        installed: True if the stand-in was installed.
+    """
+    try:
+        import icecube.icetray  # noqa: F401
+
+        return False
+    except ImportError:
+        pass
+
+    icecube = types.ModuleType("icecube")
+    icetray = types.ModuleType("icecube.icetray")
+    i3logging = types.ModuleType("icecube.icetray.i3logging")
+    dataio = types.ModuleType("icecube.dataio")
+
+    icetray.OMKey = OMKey
+    icetray.I3Frame = types.SimpleNamespace(
+        DAQ=DAQ_STOP,
+        Physics=PHYSICS_STOP,
+        Geometry="G",
+        Calibration="C",
+        DetectorStatus="D",
+    )
+    i3logging.log_warn = _log
+    i3logging.log_debug = _log
+    i3logging.log_fatal = _log_fatal
+    icetray.i3logging = i3logging
+    dataio.I3File = SyntheticI3File
+
+    icecube.icetray = icetray
+    icecube.dataio = dataio
+    modules = {
+        "icecube": icecube,
+        "icecube.icetray": icetray,
+        "icecube.icetray.i3logging": i3logging,
+        "icecube.dataio": dataio,
+    }
+    for name in ("vemcal", "dataclasses"):
+        modules[f"icecube.{name}"] = types.ModuleType(f"icecube.{name}")
+        setattr(icecube, name, modules[f"icecube.{name}"])
+    sys.modules.update(modules)
+    return True
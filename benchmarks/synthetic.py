@@ -0,0 +1,139 @@
+"""
+This script contains a synthetic generator of I3ITSLCCalData-like frames, used to benchmark
+the calibration pipeline without the IceCube software and without real data files.
+
+Each frame holds an "I3EventHeader" and an "I3ITSLCCalData" object whose HLC_vs_SLC_Hits are
+items with the fields of ITSLCCalItem (string, om, chip, atwd, hlc_charge_dpe, slc_charge_dpe).
+The SLC charges of each ATWD follow a log-normal distribution around the range of that ATWD
+and the HLC charges follow a linear relation (p0 + p1 * slc) with a gaussian smearing,
+both in integer deci-photoelectrons as delivered by the DAQ.
+
+Classes:
+    ITSLCCalItem: One SLC/HLC hit record.
+    SyntheticFrame: A minimal stand-in of an I3Frame (Stop, in, [], Has).
+    SyntheticI3File: A stand-in of dataio.I3File which yields synthetic frames.
+
+Functions:
+    generate_hits: Generates the hit records as NumPy columns.
+    generate_frames: Groups the hit records in frames.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+ITSLCCalItem = namedtuple(
+    "ITSLCCalItem", ["string", "om", "chip", "atwd", "hlc_charge_dpe", "slc_charge_dpe"]
+)
+Header = namedtuple(
+    "Header", ["run_id", "sub_run_id", "event_id", "start_time", "end_time"]
+)
+SLCCalData = namedtuple("SLCCalData", ["HLC_vs_SLC_Hits"])
+
+# Fraction of the hits, mean and width of the log10 SLC charge (PE) of each ATWD
+ATWD_FRACTIONS = (0.70, 0.25, 0.05)
+ATWD_LOG10_MEAN = (0.6, 2.0, 3.3)
+ATWD_LOG10_SIGMA = (0.45, 0.35, 0.35)
+
+# Stop of the DAQ (Q) and Physics (P) frames as in icetray.I3Frame
+DAQ_STOP = "Q"
+PHYSICS_STOP = "P"
+
+
+def generate_hits(nHits, seed=0):
+    """
+    Generate SLC/HLC hit records with realistic per-ATWD charge distributions.
+    ----------------------------------
+    Parameters:
+        nHits: Number of hit records.
+        seed: Seed of the random generator.
+    Returns:
+        hits: A dictionary of NumPy arrays with the ITSLCCalItem fields.
+    """
+    rng = np.random.default_rng(seed)
+    atwd = rng.choice(3, size=nHits, p=ATWD_FRACTIONS).astype(np.int64)
+    log10_slc = rng.normal(
+        np.take(ATWD_LOG10_MEAN, atwd), np.take(ATWD_LOG10_SIGMA, atwd)
+    )
+    slc = 10**log10_slc
+
+    # Channel dependent linear relation between SLC and HLC charges
+    string = rng.integers(1, 82, size=nHits)
+    om = rng.integers(61, 65, size=nHits)
+    chip = rng.integers(0, 2, size=nHits)
+    channel_seed = ((string * 4 + om) * 2 + chip) * 3 + atwd
+    p0 = 0.1 * np.sin(channel_seed)
+    p1 = 1.0 + 0.05 * np.cos(channel_seed)
+    hlc = p0 + p1 * slc * rng.normal(1.0, 0.08, size=nHits)
+
+    return {
+        "string": string,
+        "om": om,
+        "chip": chip,
+        "atwd": atwd,
+        "hlc_charge_dpe": np.maximum(np.rint(10 * hlc), 0).astype(np.int64),
+        "slc_charge_dpe": np.maximum(np.rint(10 * slc), 0).astype(np.int64),
+    }
+
+
+class SyntheticFrame(dict):
+    """
+    A minimal stand-in of an I3Frame: a dictionary with a Stop and Has.
+    """
+
+    def __init__(self, stop, objects):
+        dict.__init__(self, objects)
+        self.Stop = stop
+
+    def Has(self, key):
+        return key in self
+
+
+def generate_frames(
+    hits, hitsPerFrame=40, runNumb=1, frameKey="I3ITSLCCalData", stop=DAQ_STOP
+):
+    """
+    Group the hit records in frames with an I3EventHeader and the SLC calibration data.
+    ----------------------------------
+    Parameters:
+        hits: The dictionary returned by generate_hits.
+        hitsPerFrame: Number of hits in each frame.
+        runNumb: Run number of the I3EventHeader.
+        frameKey: Frame object name of the SLC calibration data.
+        stop: Stop of the frames (DAQ_STOP or PHYSICS_STOP).
+    Returns:
+        frames: A list of SyntheticFrame.
+    """
+    columns = [hits[field].tolist() for field in ITSLCCalItem._fields]
+    items = [ITSLCCalItem(*row) for row in zip(*columns)]
+
+    frames = []
+    for event_id, start in enumerate(range(0, len(items), hitsPerFrame)):
+        header = Header(runNumb, 0, event_id, 56000.0 + event_id, 56000.0 + event_id)
+        frames.append(
+            SyntheticFrame(
+                stop,
+                {
+                    "I3EventHeader": header,
+                    frameKey: SLCCalData(items[start : start + hitsPerFrame]),
+                },
+            )
+        )
+    return frames
+
+
+class SyntheticI3File:
+    """
+    A stand-in of dataio.I3File: the file name is looked up in a registry of frame lists.
+    """
+
+    registry = {}
+
+    def __init__(self, fileName, mode="r"):
+        self.frames = SyntheticI3File.registry[fileName]
+
+    def __iter__(self):
+        return iter(self.frames)
+
+    def close(self):
+        pass
@@ -0,0 +1,138 @@
+#! /usr/bin/env python3
+"""
+This script adds the SLC calibrations of many runs to the history store (see utils/calibration_history.py)
+and queries the history of channels across the runs.
+
+__author__ = Federico Bontempo KIT PhD student <federico.bontempo@kit.edu>
+
+How to run:
+Ingest (the runs already in the store are skipped):
+python3 calibration_history.py \
+    --store <history directory> \
+    --inputFiles <Run{runNumb}_{year}ITSLCChargeCalResults.jsonl, .pkl, artifact or columnar files or globs>
+
+Query, e.g. p0, p1 and crossover of the DOM (39, 61) from 2012 to 2022:
+python3 calibration_history.py \
+    --store <history directory> \
+    --doms 39,61 \
+    --years 2012 2013 2014 2015 2016 2017 2018 2019 2020 2021 2022 \
+    [--runRange <first run> <last run>] [--columns p0 p1 crossover] \
+    [--output <output path + name + .npz>]
+"""
+
+import argparse
+import glob
+import sys
+import time
+import numpy as np
+
+from utils.calibration_history import HISTORY_COLUMNS, CalibrationHistory
+from utils.channel_index import channel_from_index
+
+
+def get_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("--store", type=str, default="", help="History store directory")
+    p.add_argument(
+        "--inputFiles",
+        type=str,
+        nargs="+",
+        default=[],
+        help="Calibration files or globs to add to the store",
+    )
+    p.add_argument(
+        "--doms",
+        type=str,
+        nargs="+",
+        default=[],
+        help="DOMs to query as string,om",
+    )
+    p.add_argument(
+        "--runRange",
+        type=int,
+        nargs=2,
+        default=None,
+        help="First and last run of the query",
+    )
+    p.add_argument(
+        "--years", type=int, nargs="+", default=None, help="Years of the query"
+    )
+    p.add_argument(
+        "--columns",
+        type=str,
+        nargs="+",
+        default=["p0", "p1", "crossover"],
+        choices=[name for name, _ in HISTORY_COLUMNS],
+        help="Columns of the query",
+    )
+    p.add_argument(
+        "--output", type=str, default="", help="Query output path + name + .npz"
+    )
+
+    return p.parse_args()
+
+
+def __check_args(args):
+    if args.store == "":
+        print("No history store given")
+        sys.exit(1)
+    if len(args.inputFiles) == 0 and len(args.doms) == 0:
+        print("No input files to add or DOMs to query given")
+        sys.exit(1)
+    return
+
+
+def print_history(history, columns):
+    """
+    Print the queried columns, one line per run and channel.
+    """
+    for i, run in enumerate(history["run"]):
+        for j, channel in enumerate(history["channel"]):
+            string, om, chip, atwd = channel_from_index(int(channel))
+            values = " ".join(f"{name}={history[name][i, j]:.6g}" for name in columns)
+            print(
+                f"Run {run} ({history['year'][i]}) "
+                + f"({string}, {om}, chip {chip}, atwd {atwd}): {values}"
+            )
+    return
+
+
+def main(args):
+    __check_args(args)
+    history = CalibrationHistory(args.store)
+
+    if args.inputFiles:
+        fileNames = []
+        for pattern in args.inputFiles:
+            fileNames.extend(sorted(glob.glob(pattern)) or [pattern])
+        t0 = time.perf_counter()
+        added = history.ingest(fileNames)
+        print(
+            f"Added {len(added)} runs to {args.store} in {time.perf_counter() - t0:.2f} s "
+            + f"({len(history)} runs in the store)"
+        )
+
+    if args.doms:
+        doms = [tuple(int(v) for v in dom.split(",")) for dom in args.doms]
+        t0 = time.perf_counter()
+        result = history.query(
+            channels=doms,
+            runRange=args.runRange,
+            years=args.years,
+            columns=args.columns,
+        )
+        print(
+            f"Queried {len(result['run'])} runs x {len(result['channel'])} channels "
+            + f"in {(time.perf_counter() - t0) * 1e3:.2f} ms"
+        )
+        if args.output != "":
+            np.savez(args.output, **result)
+            print(f"Saved {args.output}")
+        else:
+            print_history(result, args.columns)
+    return
+
+
+if __name__ == "__main__":
+    main(args=get_args())
+    print("-------------------- Program finished --------------------")
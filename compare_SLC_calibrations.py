@@ -0,0 +1,208 @@
+#! /usr/bin/env python3
+"""
+This script compares SLC calibration sets channel by channel (see utils/calibration_diff.py),
+e.g. a new calibration with the one of the previous year before it is deployed.
+
+__author__ = Federico Bontempo KIT PhD student <federico.bontempo@kit.edu>
+
+How to run:
+python3 compare_SLC_calibrations.py \
+    --reference <calibration path> \
+    --candidate <calibration path> \
+    [--output <output path + name + .json>] \
+    [--maxPull 5] [--maxRelP1 0.05] [--maxDeltaP0 <PE>] [--maxRelCrossover 0.1] [--maxListed 20] \
+    [--failOnOutliers]
+
+Every consecutive pair of a season (each file is loaded once, one report per line):
+python3 compare_SLC_calibrations.py \
+    --calibrations <calibration path> <calibration path> ... \
+    --output <output path + name + .jsonl>
+
+The calibrations can be calibration artifacts, columnar results, jsonl results
+(readSave_HLC_SLC_charges.py) or Level3 pickles (write_fake_SLC_calibration.py).
+With --failOnOutliers the program exits with 1 if a pair has outliers, appeared
+or disappeared fits or crossover points, so it can be used as a check before the deployment.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from utils.calibration_artifact import load_calibrationSet
+from utils.calibration_diff import (
+    DIFF_THRESHOLDS,
+    diff_calibrationSets,
+    save_diffReport,
+    summarize_diff,
+)
+
+
+def get_args():
+    p = argparse.ArgumentParser()
+    p.add_argument(
+        "--reference", type=str, default="", help="Reference calibration path"
+    )
+    p.add_argument(
+        "--candidate", type=str, default="", help="Calibration path to check"
+    )
+    p.add_argument(
+        "--calibrations",
+        type=str,
+        nargs="+",
+        default=[],
+        help="Calibration paths in time order, each one is compared with the previous one",
+    )
+    p.add_argument(
+        "--output",
+        type=str,
+        default="",
+        help="Report path + name + .json (.jsonl with --calibrations)",
+    )
+    p.add_argument(
+        "--maxPull",
+        type=float,
+        default=DIFF_THRESHOLDS["maxPull"],
+        help="Outlier threshold of the p0 and p1 pulls",
+    )
+    p.add_argument(
+        "--maxRelP1",
+        type=float,
+        default=DIFF_THRESHOLDS["maxRelP1"],
+        help="Outlier threshold of the relative p1 difference",
+    )
+    p.add_argument(
+        "--maxDeltaP0",
+        type=float,
+        default=DIFF_THRESHOLDS["maxDeltaP0"],
+        help="Outlier threshold of the p0 difference in PE (default: not used)",
+    )
+    p.add_argument(
+        "--maxRelCrossover",
+        type=float,
+        default=DIFF_THRESHOLDS["maxRelCrossover"],
+        help="Outlier threshold of the relative crossover point difference",
+    )
+    p.add_argument(
+        "--maxListed",
+        type=int,
+        default=20,
+        help="Maximum number of channels listed in the report for each kind of flag",
+    )
+    p.add_argument(
+        "--failOnOutliers",
+        action="store_true",
+        help="Exit with 1 if a comparison has flagged channels",
+    )
+
+    return p.parse_args()
+
+
+def __check_args(args):
+    pairMode = args.reference != "" or args.candidate != ""
+    if pairMode and args.calibrations:
+        print("Give either --reference and --candidate or --calibrations")
+        sys.exit(1)
+    if pairMode and (args.reference == "" or args.candidate == ""):
+        print("Give both --reference and --candidate")
+        sys.exit(1)
+    if not pairMode and len(args.calibrations) < 2:
+        print("At least two calibration files are needed")
+        sys.exit(1)
+    for calibration in [args.reference, args.candidate] + args.calibrations:
+        if calibration != "" and not os.path.exists(calibration):
+            print(f"Calibration file {calibration} does not exist")
+            sys.exit(1)
+    return
+
+
+def n_flagged(report):
+    """Return the number of outliers and appeared or disappeared fits and crossover points of a report"""
+    counts = report["counts"]
+    return sum(
+        counts[name]
+        for name in (
+            "outlier",
+            "fit_appeared",
+            "fit_disappeared",
+            "outlier_crossover",
+            "crossover_appeared",
+            "crossover_disappeared",
+        )
+    )
+
+
+def print_summary(report, referenceFile, candidateFile):
+    """
+    Print the counts and the largest outliers of a report.
+    """
+    counts = report["counts"]
+    stats = report["stats"]
+    print(f"{os.path.basename(referenceFile)} -> {os.path.basename(candidateFile)}")
+    print(
+        f"    {counts['compared']} channels compared, {counts['outlier']} outliers "
+        + f"(pull {counts['outlier_pull']}, p1 {counts['outlier_p1']}, p0 {counts['outlier_p0']}), "
+        + f"fits appeared {counts['fit_appeared']} disappeared {counts['fit_disappeared']}"
+    )
+    print(
+        f"    {counts['crossover_compared']} crossover points compared, "
+        + f"{counts['outlier_crossover']} outliers, appeared {counts['crossover_appeared']} "
+        + f"disappeared {counts['crossover_disappeared']}"
+    )
+    if stats["rel_p1"]["n"]:
+        print(
+            f"    median rel. p1 difference {stats['rel_p1']['median']:.4g} "
+            + f"(max {stats['rel_p1']['max_abs']:.4g})"
+        )
+    for outlier in report["outliers"][:5]:
+        print(f"    outlier {json.dumps(outlier)}")
+    return
+
+
+def main(args):
+    __check_args(args)
+
+    thresholds = {
+        "maxPull": args.maxPull,
+        "maxRelP1": args.maxRelP1,
+        "maxDeltaP0": args.maxDeltaP0,
+        "maxRelCrossover": args.maxRelCrossover,
+    }
+    if args.calibrations:
+        fileNames = args.calibrations
+    else:
+        fileNames = [args.reference, args.candidate]
+
+    t0 = time.perf_counter()
+    reports = []
+    reference = load_calibrationSet(fileNames[0])
+    for referenceFile, candidateFile in zip(fileNames[:-1], fileNames[1:]):
+        # Each calibration is loaded once and is the reference of the next pair
+        candidate = load_calibrationSet(candidateFile)
+        diff = diff_calibrationSets(reference, candidate, thresholds)
+        report = summarize_diff(diff, reference, candidate, maxListed=args.maxListed)
+        report["reference"]["file"] = referenceFile
+        report["candidate"]["file"] = candidateFile
+        print_summary(report, referenceFile, candidateFile)
+        reports.append(report)
+        reference = candidate
+    print(f"Compared {len(reports)} pairs in {time.perf_counter() - t0:.3f} s")
+
+    if args.output != "":
+        if args.calibrations:
+            with open(args.output, "w") as f:
+                for report in reports:
+                    f.write(json.dumps(report) + "\n")
+        else:
+            save_diffReport(reports[0], args.output)
+        print(f"Saved {args.output}")
+
+    if args.failOnOutliers and any(n_flagged(report) for report in reports):
+        sys.exit(1)
+    return
+
+
+if __name__ == "__main__":
+    main(args=get_args())
+    print("-------------------- Program finished --------------------")
@@ -0,0 +1,65 @@
+#! /usr/bin/env python3
+"""
+This script plots the histograms of the SLC charges with their kde curves and crossover points
+from the diagnostics saved by calculate_crossOverPoints (readSave_HLC_SLC_charges.py --doPlotting).
+The charges are not read and nothing is computed again, the pages are drawn in parallel.
+It does not need icetray.
+
+__author__ = Federico Bontempo KIT PhD student <federico.bontempo@kit.edu>
+
+How to run:
+python3 plot_crossOvers.py \
+    --diagnostics <Run{runNumb}_{year}_crossOverDiagnostics.npz path> \
+    --outputDir <output directory> \
+    [--perOM] \
+    [--nWorkers <number of processes>]
+"""
+
+import argparse
+import os
+import sys
+
+from utils.plot_crossovers import plot_crossOverDiagnostics
+
+
+def get_args():
+    p = argparse.ArgumentParser()
+    p.add_argument(
+        "--diagnostics", type=str, default="", help="Crossover diagnostics .npz path"
+    )
+    p.add_argument("--outputDir", type=str, default="", help="Output directory")
+    p.add_argument(
+        "--perOM", action="store_true", help="One png per OM instead of per station"
+    )
+    p.add_argument(
+        "--nWorkers",
+        type=int,
+        default=0,
+        help="Number of processes (default: number of cores)",
+    )
+    return p.parse_args()
+
+
+def __check_args(args):
+    if args.diagnostics == "" or not os.path.exists(args.diagnostics):
+        print("No diagnostics file given or file does not exist")
+        sys.exit(1)
+    if args.outputDir == "" or not os.path.isdir(args.outputDir):
+        print("No output directory given or directory does not exist")
+        sys.exit(1)
+    return
+
+
+if __name__ == "__main__":
+    args = get_args()
+    __check_args(args)
+
+    prefix = os.path.basename(args.diagnostics).replace("crossOverDiagnostics.npz", "")
+    plot_crossOverDiagnostics(
+        args.diagnostics,
+        f"{args.outputDir}/{prefix}",
+        perOM=args.perOM,
+        nWorkers=args.nWorkers,
+    )
+
+    print("-------------------- Program finished --------------------")
@@ -2,7 +2,7 @@
 """
 This script provides a data processing pipeline for getting the calibration constants needed for the SLC calibration. 
 It reads input files containing calibration data and performs necessary calculations to obtain calibration parameters (p0, p1) and crossover points. 
-The results can be saved in JSONL and pickle file formats.
+The results can be saved in JSONL, pickle and columnar (npz, parquet, hdf5) file formats.
 
 __author__ = Federico Bontempo KIT PhD student <federico.bontempo@kit.edu>
 ! special thanks to Katherine Rawlins for the help !
@@ -20,40 +20,132 @@ Options
     --outputDir: Path to the directory where the results will be saved.
     --frameType: Frame type, either "Q" and/or "P".
     --frameKey: Frame object name for the SLC calibration data.
+    --dedupEvents: Use each event (run_id, sub_run_id, event_id of the I3EventHeader) only once,
+        e.g. with overlapping files. The ids of the used events are saved in Run{runNumb}_{year}_eventIds.npy.
+    --seenEvents: Event id files of other jobs (e.g. parallel workers), their events are skipped
+        and they are merged in the saved event ids (with --dedupEvents).
+    --chargeHistograms: Number of bins per axis of the 2D log10(SLC) vs log10(HLC) histograms of each
+        (string, om, chip, atwd) from 0.1 PE to 1e6 PE (0 is no histograms), filled while reading
+        the files and saved in Run{runNumb}_{year}_chargeHistograms.npz for the fit diagnostics.
+    --targets: Several "STREAM:KEY" targets (e.g. Q:I3ITSLCCalData P:I3ITSLCCalData) calibrated
+        with one reading of the files, instead of --frameType and --frameKey.
+        The results of each target are saved in {outputDir}/{STREAM}_{KEY}.
     --saveJsonl: Save the results in a JSONL file.
     --savePickle: Save the results in a pickle file.
+    --saveColumnar: Save the results in a columnar file (one row per channel) readable without icetray.
+    --columnarFormat: Format of the columnar file, either "npz" (default), "parquet" or "hdf5".
+    --saveArtifact: Save the calibration artifact (Run{runNumb}_{year}_SLCCalibration.npz)
+        which is read by write_SLC_Calibration_in_GCD.py.
+    --saveCharges: Save the raw slc and hlc charges in a charge store (Run{runNumb}_{year}_charges).
+    --compressCharges: Compress the charge store (it is then loaded in memory instead of memory-mapped).
+    --fromCharges: Path to a charge store. The I3 files are not read, only the crossover points
+        are calculated (and plotted) and saved in a pickle file.
+    --doPlotting: Plot the charge histograms with the crossover points.
+    --bootstrapCrossOvers: Number of bootstrap samples of the crossover points (0 is no bootstrap).
+        The median, spread and failed fraction of the crossover points of each OM are saved in
+        Run{runNumb}_{year}_crossOverUncertainties.npz (also with --fromCharges).
+    --bootstrapSeed: Seed of the bootstrap.
+    --robustRefit: Number of sigma-clipping rounds of the robust refit of p0 and p1 on the charges
+        (0 is no refit). The results of each (om, atwd) and the fraction of clipped charges are saved
+        in Run{runNumb}_{year}_robustFit.npz (also with --fromCharges).
+    --clipSigma: Clipping threshold of the robust refit in standard deviations of the residuals.
+    --memoryBudget: Memory budget of the raw charges in MB (0 is no budget). Above it the charges
+        are spilled to temporary memory-mapped files, which are read again one OM at a time.
+    --spillDir: Directory of the temporary files of the spilled charges (default is $TMPDIR).
+    --metricsOut: Save the counters (frames, hits, bytes) and the timers of each stage and file
+        in a JSON file, or in the Prometheus textfile-exporter format if the name ends with .prom.
 
 Functions:
     get_args(): Parses the command-line arguments and returns the arguments as a namespace.
     __check_args(args): Checks if the required arguments are provided and exits the program if any are missing.
     save_jsonl(): Saves the calibration results, including p0, p1, and crossover points, in a JSONL file.
     save_pickle(): Saves the calibration results, including p0, p1, and crossover points, in pickle files.
+    save_columnar(): Saves the calibration results in a columnar npz, parquet or hdf5 file.
+    save_artifact(): Saves the fit results and crossover points in the calibration artifact.
+    save_charges(): Saves the raw slc and hlc charges in a charge store.
+    save_metrics(): Saves the counters and timers of the run.
+    save_eventIds(): Saves the ids of the used events.
+    crossOvers_fromCharges(): Calculates the crossover points from a charge store.
+    bootstrap_crossOvers(): Calculates and saves the bootstrap uncertainties of the crossover points.
+    robust_refit(): Refits p0 and p1 on the charges with sigma clipping and saves the results.
+    create_chargeDicts(): Creates the empty charge dictionaries for all the IceTop OMs.
+    read_targetsFromRuns(): Reads the input files once and fills the charges and moments of several (stream, frame key) targets.
     read_calibrationFromRuns(): Reads calibration data from input files and extracts calibration information for further processing.
+    process_target(): Calculates the crossover points and p0 and p1 values of a target and saves the results.
     main(): Main function to coordinate the calibration process and save the results.
 
 Dependencies:
     argparse: For parsing command-line arguments.
     glob: For finding files matching a specified pattern.
-    json: For handling JSON data.
     pickle: For serializing and deserializing Python objects.
     sys: For system-specific parameters and functions.
     numpy: For numerical operations and array handling.
     icecube: The IceCube software framework for data handling and calculations.
     utils.crossover_points: Custom utility function to calculate crossover points.
     utils.calculate_p0_p1: Custom utility function to calculate p0 and p1 calibration parameters.
+    utils.robust_fit: Custom utility functions for the sigma-clipped refit of p0 and p1.
+    utils.channel_index: Custom utility functions for the integer indices of the OMs and channels.
+    utils.columnar_results: Custom utility functions to save the results in columns.
+    utils.charge_store: Custom utility functions to save and load the raw charges.
+    utils.calibration_artifact: Custom utility functions to save the calibration artifact.
+    utils.metrics: Custom utility classes for the counters and timers.
+    utils.event_ids: Custom utility class for the set of the used events.
+    utils.charge_histograms: Custom utility functions for the 2D histograms of the charges.
 """
 
 import argparse
 import glob
-import json
+import os
 import pickle
 import sys
 import numpy as np
 
 from icecube import icetray, dataio, vemcal
 
-from utils.crossover_points import calculate_crossOverPoints
-from utils.calculate_p0_p1 import calculate_p0_p1
+from utils.crossover_points import (
+    calculate_crossOverPoints,
+    calculate_crossOverUncertainties,
+    save_crossOverUncertainties,
+)
+from utils.calculate_p0_p1 import (
+    create_channelMoments,
+    fit_channelMoments,
+    fit_to_dict,
+    update_channelMoments,
+)
+from utils.robust_fit import robust_fit, save_robustFit
+from utils.channel_index import (
+    N_ATWDS,
+    N_DOMS,
+    N_SEGMENTS,
+    channel_from_index,
+    channel_index,
+    dom_index,
+    omkey_to_dom,
+)
+from utils.charge_store import (
+    DPE_PER_PE,
+    SpillingChargeBuffers,
+    save_chargeStore,
+    load_chargeStore,
+)
+from utils.calibration_artifact import (
+    build_calibrationArtifact,
+    save_calibrationArtifact,
+)
+from utils.columnar_results import (
+    FILE_EXTENSIONS,
+    build_resultColumns,
+    save_columnar as write_columnar,
+    write_jsonl_fromColumns,
+)
+from utils.event_ids import load_eventIds
+from utils.charge_histograms import (
+    create_chargeHistograms,
+    save_chargeHistograms,
+    update_chargeHistograms,
+)
+from utils.metrics import Metrics, NULL_METRICS
 
 
 def get_args():
@@ -74,12 +166,112 @@ def get_args():
         default="I3ITSLCCalData",
         help="Frame object name of the SLC calibration data",
     )
+    p.add_argument(
+        "--dedupEvents",
+        action="store_true",
+        help="Use each (run_id, sub_run_id, event_id) only once",
+    )
+    p.add_argument(
+        "--seenEvents",
+        type=str,
+        nargs="+",
+        default=[],
+        help="Event id files (Run*_eventIds.npy) of the events already used, with --dedupEvents",
+    )
+    p.add_argument(
+        "--chargeHistograms",
+        type=int,
+        default=0,
+        help="Number of bins per axis of the 2D log10(SLC) vs log10(HLC) histograms of each channel (0 is no histograms)",
+    )
+    p.add_argument(
+        "--targets",
+        type=str,
+        nargs="+",
+        default=[],
+        help="STREAM:KEY targets read in one pass (e.g. Q:I3ITSLCCalData P:I3ITSLCCalData)",
+    )
     p.add_argument(
         "--saveJsonl", action="store_true", help="Save the results in a jsonl file"
     )
     p.add_argument(
         "--savePickle", action="store_true", help="Save the results in a pickle file"
     )
+    p.add_argument(
+        "--saveColumnar",
+        action="store_true",
+        help="Save the results in a columnar file readable without icetray",
+    )
+    p.add_argument(
+        "--columnarFormat",
+        type=str,
+        default="npz",
+        choices=sorted(FILE_EXTENSIONS),
+        help="Format of the columnar file: npz, parquet or hdf5",
+    )
+    p.add_argument(
+        "--saveArtifact",
+        action="store_true",
+        help="Save the calibration artifact read by write_SLC_Calibration_in_GCD.py",
+    )
+    p.add_argument(
+        "--saveCharges",
+        action="store_true",
+        help="Save the raw slc and hlc charges in a charge store",
+    )
+    p.add_argument(
+        "--compressCharges",
+        action="store_true",
+        help="Compress the charge store (it can not be memory-mapped anymore)",
+    )
+    p.add_argument(
+        "--fromCharges",
+        type=str,
+        default="",
+        help="Charge store directory, only the crossover points are calculated",
+    )
+    p.add_argument(
+        "--doPlotting",
+        action="store_true",
+        help="Plot the charge histograms with the crossover points",
+    )
+    p.add_argument(
+        "--bootstrapCrossOvers",
+        type=int,
+        default=0,
+        help="Number of bootstrap samples of the crossover points (0 is no bootstrap)",
+    )
+    p.add_argument("--bootstrapSeed", type=int, default=0, help="Seed of the bootstrap")
+    p.add_argument(
+        "--robustRefit",
+        type=int,
+        default=0,
+        help="Number of sigma-clipping rounds of the refit of p0 and p1 (0 is no refit)",
+    )
+    p.add_argument(
+        "--clipSigma",
+        type=float,
+        default=3.0,
+        help="Clipping threshold of the robust refit in standard deviations",
+    )
+    p.add_argument(
+        "--memoryBudget",
+        type=float,
+        default=0,
+        help="Memory budget of the raw charges in MB, they are spilled to disk above it (0 is no budget)",
+    )
+    p.add_argument(
+        "--spillDir",
+        type=str,
+        default=None,
+        help="Directory of the temporary files of the spilled charges",
+    )
+    p.add_argument(
+        "--metricsOut",
+        type=str,
+        default="",
+        help="Save the counters and timers in a JSON file (textfile-exporter format if .prom)",
+    )
     return p.parse_args()
 
 
@@ -90,6 +282,15 @@ def __check_args(args):
     Parameters:
         args: Command-line arguments.
     """
+    if args.fromCharges != "":
+        # The run information is taken from the charge store
+        if not os.path.isdir(args.fromCharges):
+            print(f"Charge store {args.fromCharges} does not exist")
+            sys.exit(1)
+        if args.outputDir == "":
+            print("No output directory given")
+            sys.exit(1)
+        return
     if args.runDir == "":
         print("No run directory given")
         sys.exit(1)
@@ -102,78 +303,52 @@ def __check_args(args):
     if args.outputDir == "":
         print("No output directory given")
         sys.exit(1)
-    if args.frameType == "":
+    if args.frameType == "" and not args.targets:
         print("No frame type given")
         sys.exit(1)
-    if not args.saveJsonl and not args.savePickle:
+    for target in args.targets:
+        frameType = target.partition(":")[0]
+        if frameType == "" or set(frameType) - set("QP"):
+            print(f"Target {target} is not STREAM:KEY with a stream Q and/or P")
+            sys.exit(1)
+    if not (
+        args.saveJsonl or args.savePickle or args.saveColumnar or args.saveArtifact
+    ):
         Warning("No save option selected")
     return
 
 
-def save_jsonl(p0_p1_dict, crossOvers_dict, startTime, endTime, args):
+def save_jsonl(resultColumns, args):
     """
     Save the p0 and p1 and corssover points values in a jsonl file
     ----------------------------------
     Parameters:
-        p0_p1_dict: A dictionary containing the calculated p0 and p1 values, errors, chi-squared values, and other related statistics for each OMKey.
-        crossOvers_dict: A dictionary containing the crossover points for each OMKey.
-        startTime: Start time of the calibration.
-        endTime: End time of the calibration.
+        resultColumns: A dictionary of columns with the p0 and p1 values, errors, chi-squared values,
+            sums and crossover points of each (string, om, chip, atwd) (see utils.columnar_results).
         args: Command-line arguments.
     """
     fileName = (
         f"{args.outputDir}/Run{args.runNumb}_{args.year}ITSLCChargeCalResults.jsonl"
     )
-    with open(fileName, "w") as f:
-        for SOCAkey, valuesDict in p0_p1_dict.items():
-            string, om, chip, atwd = SOCAkey
-            omkey = icetray.OMKey(string, om)
-            # check if the key is there aka if the dom is not dead
-            if crossOvers_dict.get(omkey) is None:
-                cop = -1
-            elif atwd == 0:
-                cop = crossOvers_dict[omkey][0]
-            elif atwd == 1:
-                cop = crossOvers_dict[omkey][1]
-            else:
-                cop = -1
-
-            # save each line in a dictionary in a jsonl file
-            jsonDict = {
-                "_id": "64f9cd9e19368f",
-                "service": "PFMoniWriter",
-                "varname": "ITSLCChargeCalResults",
-                "value": {
-                    "string": string,
-                    "om": om,
-                    "chip": chip,
-                    "channel": atwd,
-                    "runNumber": args.runNumb,
-                    "subrunNumber": 0,
-                    "version": 0,
-                    "recordingStartTime": f"{startTime}",
-                    "recordingStopTime": f"{endTime}",
-                    "result": {
-                        "chi2": valuesDict["chi2"],
-                        "n": valuesDict["n"],
-                        "p0": valuesDict["p0"],
-                        "p0_error": valuesDict["p0_error"],
-                        "p1": valuesDict["p1"],
-                        "p1_error": valuesDict["p1_error"],
-                        "sum_x": valuesDict["x"],
-                        "sum_xx": valuesDict["xx"],
-                        "sum_xy": valuesDict["xy"],
-                        "sum_y": valuesDict["y"],
-                        "sum_yy": valuesDict["yy"],
-                        "crossover": cop,
-                    },
-                },
-                "prio": 3,
-                "time": "2023-09-07 13:18:21.986000",
-                "insert_time": "2023-09-08 06:02:47.940807",
-            }
-            json.dump(jsonDict, f)
-            f.write("\n")
+    write_jsonl_fromColumns(resultColumns, fileName)
+    print(f"Saved {fileName}")
+    return
+
+
+def save_columnar(resultColumns, args):
+    """
+    Save the p0 and p1 and corssover points values in a columnar file (npz, parquet or hdf5)
+    which can be read without icetray.
+    ----------------------------------
+    Parameters:
+        resultColumns: A dictionary of columns (see utils.columnar_results).
+        args: Command-line arguments.
+    """
+    fileName = (
+        f"{args.outputDir}/Run{args.runNumb}_{args.year}ITSLCChargeCalResults"
+        f".{FILE_EXTENSIONS[args.columnarFormat]}"
+    )
+    write_columnar(resultColumns, fileName, fileFormat=args.columnarFormat)
     print(f"Saved {fileName}")
     return
 
@@ -197,153 +372,585 @@ def save_pickle(p0_p1_dict, crossOvers_dict, args):
     return
 
 
-def read_calibrationFromRuns(
-    slc_hlc_q_dict,
-    slc_hlc_sum_q_dict,
+def save_artifact(resultColumns, args):
+    """
+    Save the p0 and p1 values and the crossover points in the calibration artifact,
+    the single file read by write_SLC_Calibration_in_GCD.py.
+    ----------------------------------
+    Parameters:
+        resultColumns: A dictionary of columns (see utils.columnar_results).
+        args: Command-line arguments.
+    """
+    fileName = f"{args.outputDir}/Run{args.runNumb}_{args.year}_SLCCalibration.npz"
+    artifact = build_calibrationArtifact(resultColumns, args.runNumb, args.year)
+    save_calibrationArtifact(artifact, fileName)
+    print(f"Saved {fileName}")
+    return
+
+
+def save_charges(slc_hlc_q_dict, startTime, endTime, args):
+    """
+    Save the raw slc and hlc charges of each OM and ATWD in a charge store,
+    so that the crossover points can be calculated again with --fromCharges.
+    ----------------------------------
+    Parameters:
+        slc_hlc_q_dict: A dictionary of OMKeys with a (2, n) array of slc and hlc charges for each ATWD.
+        startTime: Start time of the calibration.
+        endTime: End time of the calibration.
+        args: Command-line arguments.
+    """
+    storeDir = f"{args.outputDir}/Run{args.runNumb}_{args.year}_charges"
+    meta = {
+        "runNumb": args.runNumb,
+        "year": args.year,
+        "frameType": args.frameType,
+        "frameKey": args.frameKey,
+        "recordingStartTime": f"{startTime}",
+        "recordingStopTime": f"{endTime}",
+    }
+    save_chargeStore(slc_hlc_q_dict, storeDir, meta, compress=args.compressCharges)
+    print(f"Saved {storeDir}")
+    return
+
+
+def save_eventIds(eventIds, args):
+    """
+    Save the (run_id, sub_run_id, event_id) of the used events (and of the --seenEvents) in a npy file.
+    """
+    fileName = f"{args.outputDir}/Run{args.runNumb}_{args.year}_eventIds.npy"
+    eventIds.save(fileName)
+    print(f"Saved {fileName} ({len(eventIds)} events)")
+    return
+
+
+def save_metrics(metrics, args):
+    """
+    Save the counters and timers in a JSON file, or in the Prometheus
+    textfile-exporter format if the file name ends with .prom.
+    ----------------------------------
+    Parameters:
+        metrics: The Metrics filled during the run.
+        args: Command-line arguments.
+    """
+    if args.metricsOut.endswith(".prom"):
+        metrics.write_textfile(args.metricsOut)
+    else:
+        metrics.write_json(args.metricsOut)
+    print(f"Saved {args.metricsOut}")
+    return
+
+
+def count_channelHits(channelMoments, metrics, **labels):
+    """
+    Set the number of hits of each (string, om, chip, atwd) with hits from the channel moments,
+    so the accumulation loop does not need to count them.
+    """
+    if not metrics.enabled:
+        return
+    n = channelMoments["n"].reshape(-1)
+    for channel in np.flatnonzero(n):
+        string, om, chip, atwd = channel_from_index(int(channel))
+        metrics.set(
+            "channel_hits",
+            int(n[channel]),
+            string=string,
+            om=om,
+            chip=chip,
+            atwd=atwd,
+            **labels,
+        )
+    return
+
+
+def bootstrap_crossOvers(slc_hlc_q_dict, runNumb, year, args):
+    """
+    Calculate the median, spread and failed fraction of the crossover points of each OM
+    with args.bootstrapCrossOvers bootstrap samples and save them in a npz file.
+    ----------------------------------
+    Parameters:
+        slc_hlc_q_dict: A dictionary of OMKeys with a (2, n) array of slc and hlc charges for each ATWD.
+        runNumb: Run number of the calibration.
+        year: Year of the calibration.
+        args: Command-line arguments.
+    """
+    crossOverUncertainties_dict = calculate_crossOverUncertainties(
+        slc_hlc_q_dict,
+        bad_doms_list=[],
+        nBootstrap=args.bootstrapCrossOvers,
+        seed=args.bootstrapSeed,
+    )
+    fileName = f"{args.outputDir}/Run{runNumb}_{year}_crossOverUncertainties.npz"
+    save_crossOverUncertainties(
+        crossOverUncertainties_dict, fileName, args.bootstrapCrossOvers
+    )
+    print(f"Saved {fileName}")
+    return
+
+
+def robust_refit(slc_hlc_q_dict, runNumb, year, args):
+    """
+    Refit p0 and p1 of each (om, atwd) on the charges with args.robustRefit rounds
+    of sigma clipping and save the results in a npz file.
+    ----------------------------------
+    Parameters:
+        slc_hlc_q_dict: A dictionary of OMKeys with a (2, n) array of slc and hlc charges for each ATWD.
+        runNumb: Run number of the calibration.
+        year: Year of the calibration.
+        args: Command-line arguments.
+    """
+    robust = robust_fit(slc_hlc_q_dict, nRounds=args.robustRefit, nSigma=args.clipSigma)
+    print(
+        f"Robust refit: {robust['nRounds']} rounds, "
+        f"{(robust['n'] - robust['n_used']).sum()} of {robust['n'].sum()} charges clipped, "
+        f"max clipped fraction {np.nanmax(robust['clipped_fraction'], initial=0):.3f}"
+    )
+    fileName = f"{args.outputDir}/Run{runNumb}_{year}_robustFit.npz"
+    save_robustFit(robust, fileName, args.clipSigma)
+    print(f"Saved {fileName}")
+    return
+
+
+def crossOvers_fromCharges(args, metrics=NULL_METRICS):
+    """
+    Calculate the crossover points (and plot them) from a charge store
+    without reading the I3 files again. The crossover points are saved in a pickle file.
+    ----------------------------------
+    Parameters:
+        args: Command-line arguments.
+        metrics: The Metrics which time the stages (default is disabled).
+    """
+    charges_dict, meta = load_chargeStore(args.fromCharges)
+    runNumb = args.runNumb if args.runNumb != 0 else meta["runNumb"]
+    year = args.year if args.year != 0 else meta["year"]
+
+    slc_hlc_q_dict = {
+        icetray.OMKey(string, om): atwd_dict
+        for (string, om), atwd_dict in charges_dict.items()
+    }
+    with metrics.timer("stage", stage="crossover"):
+        crossOvers_dict = calculate_crossOverPoints(
+            slc_hlc_q_dict,
+            bad_doms_list=[],
+            pathSave=f"{args.outputDir}/Run{runNumb}_{year}_",
+            doPlotting=args.doPlotting,
+        )
+    if args.bootstrapCrossOvers > 0:
+        with metrics.timer("stage", stage="bootstrap"):
+            bootstrap_crossOvers(slc_hlc_q_dict, runNumb, year, args)
+    if args.robustRefit > 0:
+        with metrics.timer("stage", stage="robustFit"):
+            robust_refit(slc_hlc_q_dict, runNumb, year, args)
+
+    fileName = f"{args.outputDir}/Run{runNumb}_{year}_crossOvers_dict.pkl"
+    with open(fileName, "wb") as f:
+        pickle.dump(crossOvers_dict, f)
+    print(f"Saved {fileName}")
+    return
+
+
+def frame_stops(frameType):
+    """
+    Return the frame stops of a frame type, "Q" (DAQ) and/or "P" (Physics).
+    """
+    framesList = []
+    if "Q" in frameType:
+        framesList.append(icetray.I3Frame.DAQ)
+    if "P" in frameType:
+        framesList.append(icetray.I3Frame.Physics)
+    return framesList
+
+
+def parse_targets(args):
+    """
+    Return the (frameType, frameKey) targets of --targets "STREAM:KEY" (the key is --frameKey
+    if it is not given), or the single target of --frameType and --frameKey.
+    """
+    if not args.targets:
+        return [(args.frameType, args.frameKey)]
+    targets = []
+    for target in args.targets:
+        frameType, _, frameKey = target.partition(":")
+        targets.append((frameType, frameKey if frameKey != "" else args.frameKey))
+    return targets
+
+
+def create_target(
+    frameType,
+    frameKey,
+    slc_hlc_q_dict=None,
+    channelMoments=None,
+    eventIds=None,
+    chargeHistograms=None,
+):
+    """
+    Create the accumulators of a (frameType, frameKey) target of read_targetsFromRuns.
+    ----------------------------------
+    Parameters:
+        frameType: Frame type, either "Q" and/or "P".
+        frameKey: Frame object name for the SLC calibration data.
+        slc_hlc_q_dict, channelMoments: The charges and moments to fill (default are new ones, see create_chargeDicts).
+        eventIds: The utils.event_ids.EventIdSet of the events already used, the frames of these events
+            are skipped and the new events are added (default None is no deduplication).
+        chargeHistograms: The 2D log10(SLC) vs log10(HLC) histograms to fill
+            (see utils.charge_histograms, default None is no histograms).
+    Returns:
+        target: A dictionary with the frameType, frameKey, name, frame stops, slc_hlc_q_dict,
+            channelMoments, eventIds, chargeHistograms and the startTime and endTime of the frames of the target.
+    """
+    if slc_hlc_q_dict is None:
+        slc_hlc_q_dict, channelMoments = create_chargeDicts()
+    return {
+        "frameType": frameType,
+        "frameKey": frameKey,
+        "name": f"{frameType}_{frameKey}",
+        "stops": frame_stops(frameType),
+        "slc_hlc_q_dict": slc_hlc_q_dict,
+        "channelMoments": channelMoments,
+        "eventIds": eventIds,
+        "chargeHistograms": chargeHistograms,
+        "startTime": None,
+        "endTime": None,
+    }
+
+
+def _parse_hits(itemlist):
+    """
+    Return the (n, 6) array of the (string, om, chip, atwd, slc_charge_dpe, hlc_charge_dpe) of the hits
+    """
+    # It's just a vector of Items; Each "calkey" is a ITSCLCalItem
+    ## Each "calkey" is a custom lightweight object... extract the info!
+    return np.array(
+        [
+            (
+                calkey.string,
+                calkey.om,
+                calkey.chip,
+                calkey.atwd,
+                calkey.slc_charge_dpe,
+                calkey.hlc_charge_dpe,
+            )
+            for calkey in itemlist
+        ],
+        dtype=np.int64,
+    )
+
+
+def _add_fileHits(target, buffers, fileHits):
+    """
+    Merge the hits of a file in the moments, in the charge buffers and in the histograms of a target.
+    """
+    if not fileHits:
+        return
+    channel, segment, charges = (
+        np.concatenate(column, axis=-1) for column in zip(*fileHits)
+    )
+    ## What is stored is "deci-photoelectrons"
+    slcc, hlcc = charges / DPE_PER_PE
+    update_channelMoments(target["channelMoments"], channel, slcc, hlcc)
+    if target["chargeHistograms"] is not None:
+        update_chargeHistograms(
+            target["chargeHistograms"], channel, charges[0], charges[1]
+        )
+
+    # Add the charges (in dpe) to the collection, one append per (OM, ATWD) of the file
+    order = np.argsort(segment, kind="stable")
+    charges = charges[:, order]
+    segments, starts = np.unique(segment[order], return_index=True)
+    stops = np.append(starts[1:], len(order))
+    for seg, start, stop in zip(segments.tolist(), starts, stops):
+        buffers.append(seg, charges[:, start:stop])
+    buffers.check_budget()
+    return
+
+
+def _collect_charges(target, buffers, metrics, labels):
+    """
+    Put the charges of the buffers in the slc_hlc_q_dict of a target and report the spilled charges.
+    """
+    chargeBytes = 0
+    for omkey, atwd_dict in target["slc_hlc_q_dict"].items():
+        for atwd in range(N_ATWDS):
+            # Each buffer is released when its charges are taken, so they are never in memory twice
+            charges = buffers.release(omkey_to_dom(omkey) * N_ATWDS + atwd)
+            atwd_dict[f"atwd{atwd}"] = charges
+            if not isinstance(charges, np.memmap):
+                chargeBytes += charges.nbytes
+    # The spilled charges stay readable through their views
+    buffers.close()
+    metrics.set("charge_bytes", chargeBytes, **labels)
+    if buffers.nSpills:
+        print(
+            f"Spilled {buffers.spilledBytes / 1e6:.1f} MB of charges of "
+            + f"{buffers.spilledSegments} (OM, ATWD) in {buffers.nSpills} chunks, "
+            + f"reloaded {buffers.reloadedBytes / 1e6:.1f} MB, mapped {buffers.mappedBytes / 1e6:.1f} MB"
+        )
+    metrics.set("spill_bytes", buffers.spilledBytes, **labels)
+    metrics.set("spill_chunks", buffers.nSpills, **labels)
+    metrics.set("spill_reload_bytes", buffers.reloadedBytes, **labels)
+    metrics.set("spill_mapped_bytes", buffers.mappedBytes, **labels)
+    return
+
+
+def read_targetsFromRuns(
+    targets,
     files_list,
     runNumb,
-    frameType,
-    startTime=None,
-    slcdata_name="I3ITSLCCalData",
+    metrics=NULL_METRICS,
+    memoryBudget=0,
+    spillDir=None,
 ):
     """
-    Read calibration data from input files and extract calibration information for further processing.
+    Read the input files once and fill the charges and moments of several (frameType, frameKey) targets,
+    e.g. the Q and P frames or different frame objects, each frame is given to all its targets.
     ----------------------------------
     Parameters:
-        slc_hlc_q_dict: A dictionary of OMKeys with empty arrays for each ATWD array shape: (2, 0).
-        slc_hlc_sum_q_dict: A dictionary of OMKeys with empty dictionaries for each chip and ATWD.
+        targets: A list of targets (see create_target), their slc_hlc_q_dict, channelMoments,
+            startTime and endTime are filled.
         files_list: A list of files containing the runs data.
         runNumb: Run number for which the calibration is being performed.
-        startTime: Start time of the calibration.
-        slcdata_name: Frame object name for the SLC calibration data.
+        metrics: The Metrics which count the frames, hits and bytes and time the decoding
+            and the accumulation of each file (default is disabled).
+            The counters of each target have a target label if there are several targets.
+        memoryBudget: The memory budget of the charges in bytes, shared by the targets (0 is no budget).
+        spillDir: The directory of the temporary files (default is the system temporary directory).
     """
+    targetLabels = [
+        {"target": target["name"]} if len(targets) > 1 else {} for target in targets
+    ]
+    # The charges of each (OM, ATWD) addressed by its segment index (see utils.channel_index),
+    # kept in dpe in growable buffers until all the files are read
+    targetBuffers = []
+    for target in targets:
+        buffers = SpillingChargeBuffers(
+            N_SEGMENTS, memoryBudget // len(targets), spillDir
+        )
+        for omkey, atwd_dict in target["slc_hlc_q_dict"].items():
+            for atwd in range(N_ATWDS):
+                buffers.append(
+                    omkey_to_dom(omkey) * N_ATWDS + atwd, atwd_dict[f"atwd{atwd}"]
+                )
+        targetBuffers.append(buffers)
+
     for f in sorted(files_list):
         print(f"Reading file {f}")
-        for frame in dataio.I3File(f):
-            # Is this one of the streams you wanted (Q or P)?
-            framesList = []
-            if "Q" in frameType:
-                framesList.append(icetray.I3Frame.DAQ)
-            if "P" in frameType:
-                framesList.append(icetray.I3Frame.Physics)
-
-            if frame.Stop not in framesList:
-                continue
-            # IF there is no slc calibration information, skip
-            if slcdata_name not in frame:
-                continue
-
-            slcdata = frame[slcdata_name]
-
-            # At Lv2, all frames have an I3EventHeader, but this is not true for PFFilt
-            if frame.Has("I3EventHeader"):
-                header = frame["I3EventHeader"]
-
-                if startTime is None:
-                    startTime = header.start_time
-                    endTime = header.end_time
-                if endTime < header.end_time:
-                    endTime = header.end_time
-
-                ## Run number sanity checks
-                if not header.run_id == runNumb:
-                    SystemExit(
-                        "I3EventHeader and I3ITSLCCalItem run numbers do not match!"
-                    )
+        fileName = os.path.basename(f)
+        if metrics.enabled and os.path.isfile(f):
+            metrics.inc("bytes_read", os.path.getsize(f))
+        # The hits of the file of each target, merged in the moments and in the buffers as one batch
+        fileHits = [[] for _ in targets]
+        with metrics.timer("file", file=fileName):
+            frames = metrics.timed_iter(
+                dataio.I3File(f), "decode", "accumulate", file=fileName
+            )
+            for frame in frames:
+                metrics.inc("frames_seen")
+                # The hits of each frame object, parsed once for all the targets
+                frameHits = {}
+                for target, labels, hitsList in zip(targets, targetLabels, fileHits):
+                    # Is this one of the streams you wanted (Q or P)?
+                    if frame.Stop not in target["stops"]:
+                        metrics.inc("frames_skipped", reason="frameType", **labels)
+                        continue
+                    # IF there is no slc calibration information, skip
+                    slcdata_name = target["frameKey"]
+                    if slcdata_name not in frame:
+                        metrics.inc("frames_skipped", reason="missingKey", **labels)
+                        continue
 
-            itemlist = slcdata.HLC_vs_SLC_Hits
+                    # At Lv2, all frames have an I3EventHeader, but this is not true for PFFilt
+                    if frame.Has("I3EventHeader"):
+                        header = frame["I3EventHeader"]
 
-            for calkey in itemlist:
-                # It's just a vector of Items; Each "calkey" is a ITSCLCalItem
-                ## Each "calkey" is a custom lightweight object... extract the info!
-                omkey = icetray.OMKey(calkey.string, calkey.om)
-                chip = calkey.chip
-                atwd = calkey.atwd
+                        if target["startTime"] is None:
+                            target["startTime"] = header.start_time
+                            target["endTime"] = header.end_time
+                        if (
+                            target["endTime"] is None
+                            or target["endTime"] < header.end_time
+                        ):
+                            target["endTime"] = header.end_time
 
-                ## What is stored is "deci-photoelectrons"
-                hlcc = calkey.hlc_charge_dpe / 10.0
-                slcc = calkey.slc_charge_dpe / 10.0
+                        ## Run number sanity checks
+                        if not header.run_id == runNumb:
+                            SystemExit(
+                                "I3EventHeader and I3ITSLCCalItem run numbers do not match!"
+                            )
 
-                # Add the calibration to the collection
-                slc_hlc_q_dict[omkey][f"atwd{atwd}"] = np.append(
-                    slc_hlc_q_dict[omkey][f"atwd{atwd}"], [[slcc], [hlcc]], axis=1
-                )
+                        # Skip the events which were already used (e.g. overlapping files)
+                        eventIds = target["eventIds"]
+                        if eventIds is not None and not eventIds.add_event(
+                            header.run_id, header.sub_run_id, header.event_id
+                        ):
+                            metrics.inc("frames_skipped", reason="duplicate", **labels)
+                            continue
 
-                # Add the calibration to the sum collection for the p0 p1 fit
-                slc_hlc_sum_q_dict[omkey][f"chip{chip}atwd{atwd}"]["n"] += 1
-                slc_hlc_sum_q_dict[omkey][f"chip{chip}atwd{atwd}"]["x"] += slcc
-                slc_hlc_sum_q_dict[omkey][f"chip{chip}atwd{atwd}"]["xx"] += slcc**2
-                slc_hlc_sum_q_dict[omkey][f"chip{chip}atwd{atwd}"]["y"] += hlcc
-                slc_hlc_sum_q_dict[omkey][f"chip{chip}atwd{atwd}"]["yy"] += hlcc**2
-                slc_hlc_sum_q_dict[omkey][f"chip{chip}atwd{atwd}"]["xy"] += slcc * hlcc
+                    if slcdata_name not in frameHits:
+                        itemlist = frame[slcdata_name].HLC_vs_SLC_Hits
+                        frameHits[slcdata_name] = (
+                            _parse_hits(itemlist) if len(itemlist) else None
+                        )
+                    hits = frameHits[slcdata_name]
+                    metrics.inc("frames_used", **labels)
+                    metrics.inc("hits", 0 if hits is None else len(hits), **labels)
+                    if hits is None:
+                        continue
 
+                    string, om, chip, atwd = hits[:, :4].T
+                    # Keep the calibration of the frame for the moments of the p0 p1 fit
+                    # and the collection of the charges
+                    hitsList.append(
+                        (
+                            channel_index(string, om, chip, atwd),
+                            dom_index(string, om) * N_ATWDS + atwd,
+                            hits[:, 4:].T,
+                        )
+                    )
+
+            for target, buffers, hitsList in zip(targets, targetBuffers, fileHits):
+                _add_fileHits(target, buffers, hitsList)
         print(f"Completed file {f}")
-    return startTime, endTime
+
+    for target, buffers, labels in zip(targets, targetBuffers, targetLabels):
+        _collect_charges(target, buffers, metrics, labels)
+        eventIds = target["eventIds"]
+        if eventIds is not None and eventIds.nChecked:
+            print(
+                f"Skipped {eventIds.nDuplicates} duplicate events of {eventIds.nChecked} "
+                + f"({eventIds.checkSeconds / eventIds.nChecked * 1e6:.2f} us per frame)"
+            )
+            metrics.set("events_checked", eventIds.nChecked, **labels)
+            metrics.set("events_duplicate", eventIds.nDuplicates, **labels)
+            metrics.add_time("dedup", eventIds.checkSeconds, **labels)
+    return
 
 
-def main(args):
+def read_calibrationFromRuns(
+    slc_hlc_q_dict,
+    channelMoments,
+    files_list,
+    runNumb,
+    frameType,
+    startTime=None,
+    slcdata_name="I3ITSLCCalData",
+    metrics=NULL_METRICS,
+    memoryBudget=0,
+    spillDir=None,
+    eventIds=None,
+):
     """
-    Main function to coordinate the calibration process and save the results.
+    Read calibration data from input files and extract calibration information for further processing.
     ----------------------------------
     Parameters:
-        args: Command-line arguments.
+        slc_hlc_q_dict: A dictionary of OMKeys with empty arrays for each ATWD array shape: (2, 0).
+            The slc and hlc charges are added as integers in dpe (in the smallest integer type
+            which holds them, see utils.charge_store.ChargeBuffer).
+        channelMoments: The moments of each (string, om, chip, atwd) for the p0 p1 fit (see create_channelMoments).
+        files_list: A list of files containing the runs data.
+        runNumb: Run number for which the calibration is being performed.
+        startTime: Start time of the calibration.
+        slcdata_name: Frame object name for the SLC calibration data.
+        metrics: The Metrics which count the frames, hits and bytes and time the decoding
+            and the accumulation of each file (default is disabled).
+        memoryBudget: The memory budget of the charges in bytes (0 is no budget). Above it the charges
+            are spilled to temporary files and the entries of slc_hlc_q_dict of the spilled (OM, ATWD)
+            are memory-mapped views of these files.
+        spillDir: The directory of the temporary files (default is the system temporary directory).
+        eventIds: The utils.event_ids.EventIdSet of the events already used (default None is no deduplication).
+    Returns:
+        startTime, endTime: The start and end time of the calibration.
     """
-    __check_args(args=args)
+    target = create_target(
+        frameType, slcdata_name, slc_hlc_q_dict, channelMoments, eventIds
+    )
+    target["startTime"] = startTime
+    read_targetsFromRuns(
+        [target],
+        files_list,
+        runNumb,
+        metrics=metrics,
+        memoryBudget=memoryBudget,
+        spillDir=spillDir,
+    )
+    return target["startTime"], target["endTime"]
 
-    files_list = sorted(glob.glob(f"{args.runDir}"))
 
+def create_chargeDicts():
+    """
+    Create the empty charge dictionary and moments filled by read_calibrationFromRuns.
+    ----------------------------------
+    Returns:
+        slc_hlc_q_dict: A dictionary of OMKeys with empty arrays for each ATWD array shape: (2, 0).
+        channelMoments: The empty moments of each (string, om, chip, atwd) (see create_channelMoments).
+    """
     # Create a dictionary of OMKeys with
     # empty arrays for each ATWD array shape: (2, 0)
-    # 1. array slc calibration
-    # 2. array hlc calibration
+    # 1. array slc calibration (dpe)
+    # 2. array hlc calibration (dpe)
     slc_hlc_q_dict = {}
-    slc_hlc_sum_q_dict = {}
-
     for string in range(1, 82):
         for om in range(61, 65):
             omkey = icetray.OMKey(string, om)
             slc_hlc_q_dict[omkey] = {
-                "atwd0": np.array([[], []]),
-                "atwd1": np.array([[], []]),
-                "atwd2": np.array([[], []]),
-            }
-            chipATWDkeys = [
-                "chip0atwd0",
-                "chip0atwd1",
-                "chip0atwd2",
-                "chip1atwd0",
-                "chip1atwd1",
-                "chip1atwd2",
-            ]
-            slc_hlc_sum_q_dict[omkey] = {
-                cakey: {
-                    "n": 0,
-                    "x": 0.0,
-                    "xx": 0.0,
-                    "y": 0.0,
-                    "yy": 0.0,
-                    "xy": 0.0,
-                }
-                for cakey in chipATWDkeys
+                "atwd0": np.empty((2, 0), dtype=np.uint8),
+                "atwd1": np.empty((2, 0), dtype=np.uint8),
+                "atwd2": np.empty((2, 0), dtype=np.uint8),
             }
+    return slc_hlc_q_dict, create_channelMoments()
 
-    startTime, endTime = read_calibrationFromRuns(
-        slc_hlc_q_dict=slc_hlc_q_dict,
-        slc_hlc_sum_q_dict=slc_hlc_sum_q_dict,
-        files_list=files_list,
-        runNumb=args.runNumb,
-        frameType=args.frameType,
-        slcdata_name=args.frameKey,
-    )
 
-    crossOvers_dict = calculate_crossOverPoints(slc_hlc_q_dict, bad_doms_list=[])
+def process_target(target, args, metrics=NULL_METRICS, labels=None):
+    """
+    Calculate the crossover points and the p0 and p1 values of a target of the ingest and save the results.
+    ----------------------------------
+    Parameters:
+        target: A target filled by read_targetsFromRuns (see create_target).
+        args: Command-line arguments (outputDir, frameType and frameKey are those of the target).
+        metrics: The Metrics which time the stages (default is disabled).
+        labels: A dictionary with the labels of the metrics (e.g. the target name, default is no labels).
+    """
+    labels = labels if labels is not None else {}
+    slc_hlc_q_dict = target["slc_hlc_q_dict"]
+    channelMoments = target["channelMoments"]
+    startTime, endTime = target["startTime"], target["endTime"]
+
+    count_channelHits(channelMoments, metrics, **labels)
+
+    # Save the used events, to skip them in the next jobs (--seenEvents)
+    if target["eventIds"] is not None:
+        save_eventIds(target["eventIds"], args)
+    if target["chargeHistograms"] is not None:
+        fileName = (
+            f"{args.outputDir}/Run{args.runNumb}_{args.year}_chargeHistograms.npz"
+        )
+        save_chargeHistograms(target["chargeHistograms"], fileName)
+        print(f"Saved {fileName}")
+
+    # Save the raw charges to calculate the crossover points again without the I3 files
+    if args.saveCharges:
+        with metrics.timer("stage", stage="saveCharges", **labels):
+            save_charges(slc_hlc_q_dict, startTime, endTime, args)
+
+    with metrics.timer("stage", stage="crossover", **labels):
+        crossOvers_dict = calculate_crossOverPoints(
+            slc_hlc_q_dict,
+            bad_doms_list=[],
+            pathSave=f"{args.outputDir}/Run{args.runNumb}_{args.year}_",
+            doPlotting=args.doPlotting,
+        )
+    if args.bootstrapCrossOvers > 0:
+        with metrics.timer("stage", stage="bootstrap", **labels):
+            bootstrap_crossOvers(slc_hlc_q_dict, args.runNumb, args.year, args)
     """
     crossOvers_dict = {
         OMKey: crossover_atwd01, crossover_atwd12
         ...
         }
     """
-    p0_p1_dict = calculate_p0_p1(slc_hlc_sum_q_dict, bad_dom_list=[])
+    with metrics.timer("stage", stage="fit", **labels):
+        p0_p1_dict = fit_to_dict(fit_channelMoments(channelMoments), range(N_DOMS))
+    if args.robustRefit > 0:
+        with metrics.timer("stage", stage="robustFit", **labels):
+            robust_refit(slc_hlc_q_dict, args.runNumb, args.year, args)
 
     """
     p0_p1_dict[(string, om, chip, atwd)]= {
@@ -365,12 +972,86 @@ def main(args):
     """
 
     print("Saving results")
-    # Save the p0 and p1 and crossover points values in a jsonl file
-    if args.saveJsonl:
-        save_jsonl(p0_p1_dict, crossOvers_dict, startTime, endTime, args)
-    # Save the p0 and p1 and crossover points values in 2 pickle files
-    if args.savePickle:
-        save_pickle(p0_p1_dict, crossOvers_dict, args)
+    with metrics.timer("stage", stage="save", **labels):
+        if args.saveJsonl or args.saveColumnar or args.saveArtifact:
+            # One row per (string, om, chip, atwd) with the fit results and crossover
+            resultColumns = build_resultColumns(
+                p0_p1_dict, crossOvers_dict, args.runNumb, startTime, endTime
+            )
+        # Save the p0 and p1 and crossover points values in a jsonl file
+        if args.saveJsonl:
+            save_jsonl(resultColumns, args)
+        # Save the p0 and p1 and crossover points values in a columnar file
+        if args.saveColumnar:
+            save_columnar(resultColumns, args)
+        # Save the calibration artifact for the GCD writer
+        if args.saveArtifact:
+            save_artifact(resultColumns, args)
+        # Save the p0 and p1 and crossover points values in 2 pickle files
+        if args.savePickle:
+            save_pickle(p0_p1_dict, crossOvers_dict, args)
+    return
+
+
+def main(args):
+    """
+    Main function to coordinate the calibration process and save the results.
+    ----------------------------------
+    Parameters:
+        args: Command-line arguments.
+    """
+    __check_args(args=args)
+    metrics = Metrics() if args.metricsOut != "" else NULL_METRICS
+
+    if args.fromCharges != "":
+        crossOvers_fromCharges(args, metrics)
+        if metrics.enabled:
+            save_metrics(metrics, args)
+        return
+
+    files_list = sorted(glob.glob(f"{args.runDir}"))
+
+    targets = [
+        create_target(
+            frameType,
+            frameKey,
+            eventIds=load_eventIds(args.seenEvents) if args.dedupEvents else None,
+            chargeHistograms=(
+                create_chargeHistograms(args.chargeHistograms)
+                if args.chargeHistograms > 0
+                else None
+            ),
+        )
+        for frameType, frameKey in parse_targets(args)
+    ]
+
+    with metrics.timer("stage", stage="ingest"):
+        read_targetsFromRuns(
+            targets,
+            files_list=files_list,
+            runNumb=args.runNumb,
+            metrics=metrics,
+            memoryBudget=int(args.memoryBudget * 1e6),
+            spillDir=args.spillDir,
+        )
+
+    if len(targets) == 1:
+        process_target(targets[0], args, metrics)
+    else:
+        # The results of each target are saved in their own directory
+        for target in targets:
+            targetArgs = argparse.Namespace(**vars(args))
+            targetArgs.frameType = target["frameType"]
+            targetArgs.frameKey = target["frameKey"]
+            targetArgs.outputDir = f"{args.outputDir}/{target['name']}"
+            os.makedirs(targetArgs.outputDir, exist_ok=True)
+            print(f"Results of {target['name']} in {targetArgs.outputDir}")
+            process_target(
+                target, targetArgs, metrics, labels={"target": target["name"]}
+            )
+
+    if metrics.enabled:
+        save_metrics(metrics, args)
 
 
 if __name__ == "__main__":
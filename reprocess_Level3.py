@@ -0,0 +1,226 @@
+#! /usr/bin/env python3
+"""
+This script recalibrates the orphaned SLC pulses (Calibrate_Orphaned_SLCVEMPulses) of many Level3 files
+in parallel: one I3Tray per input file, run in a pool of worker processes (one per core by default).
+
+__author__ = Federico Bontempo KIT PhD student <federico.bontempo@kit.edu>
+
+How to run:
+env-shell.sh python3 reprocess_Level3.py \
+    --GCD <GCD path> \
+    --manifest <file list path> (or --inputFiles <input files or globs>) \
+    --outputDir <output directory> \
+    --SLCcalibfile <Run{runNumb}_{year}ITSLCChargeCalResults.jsonl path> \
+    [--outputPattern "{stem}_SLCCalibrated{suffix}"] [--nWorkers 0] [--maxRetries 1] [--queueSize 0] \
+    [--force] [--report <report path + name + .json>]
+
+Each line of the manifest is the path of an input file, or a json dictionary
+    {"inputFile": <input path>, "outputFile": <output path>}
+The output files whose name already exists are skipped (they were written by a previous run),
+unless --force is given. A failed file is retried --maxRetries times and does not stop the others.
+At the end the throughput (files, frames and MB per second) is printed and saved with --report.
+The scheduling is done by utils.reprocessing, which does not need icetray.
+"""
+
+import argparse
+import functools
+import glob
+import json
+import os
+import sys
+
+from utils.metrics import Metrics
+from utils.reprocessing import load_fileManifest, make_jobs, print_report, run_jobs
+
+
+def get_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("--GCD", type=str, default="", help="GCD path")
+    p.add_argument(
+        "--manifest",
+        type=str,
+        default="",
+        help="File with one input file (or json dictionary with inputFile and outputFile) per line",
+    )
+    p.add_argument(
+        "--inputFiles",
+        type=str,
+        nargs="+",
+        default=[],
+        help="Input files or globs (instead of --manifest)",
+    )
+    p.add_argument("--outputDir", type=str, default="", help="Output directory")
+    p.add_argument(
+        "--outputPattern",
+        type=str,
+        default="{stem}_SLCCalibrated{suffix}",
+        help="Output name of each input file, with the fields stem, suffix, name and index",
+    )
+    p.add_argument(
+        "--SLCcalibfile", type=str, default="", help="SLC calibration .jsonl path"
+    )
+    p.add_argument(
+        "--SLCVEMPulses",
+        type=str,
+        default="OfflineIceTopSLCVEMPulses",
+        help="Name of the SLC VEM pulses",
+    )
+    p.add_argument(
+        "--SLCTankPulses",
+        type=str,
+        default="OfflineIceTopSLCTankPulses",
+        help="Name of the SLC tank pulses",
+    )
+    p.add_argument(
+        "--nWorkers",
+        type=int,
+        default=0,
+        help="Number of worker processes (default: number of cores)",
+    )
+    p.add_argument(
+        "--maxRetries",
+        type=int,
+        default=1,
+        help="Number of times a failed file is processed again",
+    )
+    p.add_argument(
+        "--queueSize",
+        type=int,
+        default=0,
+        help="Maximum number of files submitted to the workers (default: 2 * nWorkers)",
+    )
+    p.add_argument(
+        "--force",
+        action="store_true",
+        help="Process also the files whose output already exists",
+    )
+    p.add_argument(
+        "--report", type=str, default="", help="Throughput report path + name + .json"
+    )
+    p.add_argument(
+        "--metricsOut",
+        type=str,
+        default="",
+        help="Prometheus textfile path of the counters and timers",
+    )
+
+    return p.parse_args()
+
+
+def __check_args(args):
+    if args.GCD == "":
+        print("No GCD file given")
+        sys.exit(1)
+    if args.manifest == "" and len(args.inputFiles) == 0:
+        print("No manifest or input files given")
+        sys.exit(1)
+    if args.manifest != "" and not os.path.exists(args.manifest):
+        print(f"Manifest {args.manifest} does not exist")
+        sys.exit(1)
+    if args.outputDir == "":
+        print("No output directory given")
+        sys.exit(1)
+    if args.SLCcalibfile == "":
+        print("No SLC calibration file given")
+        sys.exit(1)
+    return
+
+
+def run_calibrationTray(
+    inputFile, outputFile, gcd, SLCcalibfile, SLCVEMPulses, SLCTankPulses
+):
+    """
+    Run the Calibrate_Orphaned_SLCVEMPulses tray on one input file (in a worker process).
+    ----------------------------------
+    Returns:
+        nFrames: The number of DAQ and Physics frames written.
+    """
+    from I3Tray import I3Tray
+    from icecube import icetray, dataio, dataclasses, phys_services, toprec
+
+    from utils.Agnostic_I3IceTopSLCCalibrator import Calibrate_Orphaned_SLCVEMPulses
+
+    icetray.set_log_level(icetray.I3LogLevel.LOG_ERROR)
+
+    nFrames = [0]
+
+    def count_frames(frame):
+        nFrames[0] += 1
+
+    tray = I3Tray()
+    tray.AddModule("I3Reader", "Reader", FilenameList=[gcd, inputFile])
+    tray.Add(
+        Calibrate_Orphaned_SLCVEMPulses,
+        "SLCCalibrator",
+        SLCcalibfile=SLCcalibfile,
+        SLCVEMPulses=SLCVEMPulses,
+        SLCTankPulses=SLCTankPulses,
+    )
+    tray.Add(
+        count_frames,
+        "CountFrames",
+        Streams=[icetray.I3Frame.DAQ, icetray.I3Frame.Physics],
+    )
+    tray.AddModule(
+        "I3Writer",
+        "i3writer",
+        Filename=outputFile,
+        Streams=[icetray.I3Frame.DAQ, icetray.I3Frame.Physics],
+    )
+    tray.AddModule("TrashCan", "Done")
+    tray.Execute()
+    tray.Finish()
+    return nFrames[0]
+
+
+def get_jobs(args):
+    """
+    Return the jobs (input and output file of each tray) of the manifest or of the input files.
+    """
+    if args.manifest != "":
+        return load_fileManifest(args.manifest, args.outputDir, args.outputPattern)
+    inputFiles = []
+    for pattern in args.inputFiles:
+        inputFiles.extend(sorted(glob.glob(pattern)) or [pattern])
+    return make_jobs(inputFiles, args.outputDir, args.outputPattern)
+
+
+def main(args):
+    __check_args(args)
+
+    jobs = get_jobs(args)
+    runTray = functools.partial(
+        run_calibrationTray,
+        gcd=args.GCD,
+        SLCcalibfile=args.SLCcalibfile,
+        SLCVEMPulses=args.SLCVEMPulses,
+        SLCTankPulses=args.SLCTankPulses,
+    )
+    metrics = Metrics()
+    report = run_jobs(
+        jobs,
+        runTray,
+        nWorkers=args.nWorkers,
+        maxRetries=args.maxRetries,
+        queueSize=args.queueSize,
+        skipDone=not args.force,
+        metrics=metrics,
+    )
+    print_report(report)
+
+    if args.report != "":
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=1)
+        print(f"Saved {args.report}")
+    if args.metricsOut != "":
+        metrics.write_textfile(args.metricsOut)
+        print(f"Saved {args.metricsOut}")
+
+    if report["n_failed"]:
+        sys.exit(1)
+    return
+
+
+if __name__ == "__main__":
+    main(args=get_args())
+    print("-------------------- Program finished --------------------")
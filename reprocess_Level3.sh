@@ -0,0 +1,15 @@
+#!/bin/sh
+
+ENV=/data/user/fbontempo/icetray/build/env-shell.sh
+PYTHON=/cvmfs/icecube.opensciencegrid.org/py3-v4.1.0/RHEL_7_x86_64/bin/python3
+SCRIPT=/home/fbontempo/slcCalibrationScripts/reprocess_Level3.py
+
+eval `/cvmfs/icecube.opensciencegrid.org/py3-v4.1.0/setup.sh`
+
+$ENV $PYTHON $SCRIPT \
+    --GCD "/cvmfs/icecube.opensciencegrid.org/data/GCD/GeoCalibDetectorStatus_2012.56063_V1_OctSnow.i3.gz" \
+    --inputFiles "/data/sim/IceTop/2012/filtered/CORSIKA-ice-top/12360/level2_Elinks/5.0/Level2_IC86_corsika_icetop.010410.*.i3.bz2" \
+    --outputDir "/data/user/fbontempo/slcCalibration/reprocessing/12360/" \
+    --SLCcalibfile "/data/user/fbontempo/slcCalibration/test/Run120160_2012ITSLCChargeCalResults.jsonl" \
+    --maxRetries 1 \
+    --report "/data/user/fbontempo/slcCalibration/reprocessing/12360/report.json"
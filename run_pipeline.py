@@ -0,0 +1,115 @@
+#! /usr/bin/env python3
+"""
+This script runs the calibration scripts of many runs and years from a json manifest
+(see pipeline_manifest.json and utils/pipeline.py), instead of the hard-coded .sh files:
+e.g. readSave_HLC_SLC_charges.py (ingest, fit, crossover points and artifact) of each run,
+write_SLC_Calibration_in_GCD.py of each run and write_extrapolated_SLC_calibration.py of all the runs.
+
+__author__ = Federico Bontempo KIT PhD student <federico.bontempo@kit.edu>
+
+How to run (in the icetray environment if the stages need it):
+env-shell.sh python3 run_pipeline.py \
+    --manifest <manifest .json path> \
+    --workDir <provenance directory> \
+    [--nWorkers 0] [--force] [--dryRun] [--report <report path + name + .json>]
+
+The stages are a DAG: a stage runs after the stages which write its inputs (and the stages of its "after").
+The independent stages (e.g. the stages of different runs) run concurrently with at most --nWorkers commands.
+A stage whose command, code and input contents did not change since its last successful run is skipped,
+unless --force is given. The provenance of every output (command, code and input sha256, host, times)
+is saved in {workDir}/provenance/ and {workDir}/provenance.jsonl, the output of the commands in {workDir}/logs/.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+from utils.metrics import Metrics
+from utils.pipeline import load_pipelineManifest, run_pipeline
+
+
+def get_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("--manifest", type=str, default="", help="Manifest .json path")
+    p.add_argument(
+        "--workDir",
+        type=str,
+        default="",
+        help="Directory of the provenance records, logs and hash cache",
+    )
+    p.add_argument(
+        "--nWorkers",
+        type=int,
+        default=0,
+        help="Maximum number of concurrent commands (default: number of cores)",
+    )
+    p.add_argument(
+        "--force", action="store_true", help="Run also the stages which are up to date"
+    )
+    p.add_argument(
+        "--dryRun", action="store_true", help="Only print the stages which would run"
+    )
+    p.add_argument("--report", type=str, default="", help="Report path + name + .json")
+    p.add_argument(
+        "--metricsOut",
+        type=str,
+        default="",
+        help="Prometheus textfile path of the counters and stage timers",
+    )
+
+    return p.parse_args()
+
+
+def __check_args(args):
+    if args.manifest == "":
+        print("No manifest given")
+        sys.exit(1)
+    if not os.path.exists(args.manifest):
+        print(f"Manifest {args.manifest} does not exist")
+        sys.exit(1)
+    if args.workDir == "":
+        print("No work directory given")
+        sys.exit(1)
+    return
+
+
+def main(args):
+    __check_args(args)
+
+    stages = load_pipelineManifest(args.manifest)
+    print(f"{len(stages)} stages in {args.manifest}")
+    metrics = Metrics()
+    report = run_pipeline(
+        stages,
+        args.workDir,
+        nWorkers=args.nWorkers,
+        force=args.force,
+        dryRun=args.dryRun,
+        metrics=metrics,
+    )
+    print(
+        ", ".join(f"{n} {status}" for status, n in sorted(report["counts"].items()))
+        + f" in {report['wall_s']:.1f} s "
+        + f"({report['n_hashed_files']} files hashed, {report['hashed_bytes'] / 1e6:.1f} MB)"
+    )
+
+    if args.report != "":
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=1)
+        print(f"Saved {args.report}")
+    if args.metricsOut != "":
+        metrics.write_textfile(args.metricsOut)
+        print(f"Saved {args.metricsOut}")
+
+    if any(
+        status in ("failed", "blocked", "missing_input")
+        for status in report["status"].values()
+    ):
+        sys.exit(1)
+    return
+
+
+if __name__ == "__main__":
+    main(args=get_args())
+    print("-------------------- Program finished --------------------")
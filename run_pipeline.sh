@@ -0,0 +1,14 @@
+#!/bin/sh
+
+ENV=/data/user/fbontempo/icetray/build/env-shell.sh
+PYTHON=/cvmfs/icecube.opensciencegrid.org/py3-v4.1.0/RHEL_7_x86_64/bin/python3
+SCRIPT=/home/fbontempo/slcCalibrationScripts/run_pipeline.py
+
+eval `/cvmfs/icecube.opensciencegrid.org/py3-v4.1.0/setup.sh`
+
+# The runs, stages and paths are in the manifest, the stages which are up to date are skipped
+$ENV $PYTHON $SCRIPT \
+    --manifest "/home/fbontempo/slcCalibrationScripts/pipeline_manifest.json" \
+    --workDir "/data/user/fbontempo/slcCalibration/pipeline/work/" \
+    --nWorkers 4 \
+    --report "/data/user/fbontempo/slcCalibration/pipeline/work/report.json"
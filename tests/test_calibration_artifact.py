@@ -0,0 +1,36 @@
+"""
+Tests of the loading of the calibration outputs (utils/calibration_artifact.py).
+"""
+
+import pickle
+
+import numpy as np
+
+from utils.calibration_artifact import load_calibrationSet, valid_fits
+
+
+def test_L3Pickle_without_chip2(tmp_path):
+    # A Level3 pickle has only the chips 0 and 1
+    slc_calibration = {
+        (1, 61, chip, atwd): (
+            [56100.0, 56200.0],
+            [1.0 + chip, 3.0 + chip],
+            [2.0 * (chip + 1)] * 2,
+        )
+        for chip in range(2)
+        for atwd in range(3)
+    }
+    slc_calibration[(2, 62, 0, 0)] = ([56100.0], [1.0], [2.0])
+    fileName = str(tmp_path / "slc_calib_parameters.pcl")
+    with open(fileName, "wb") as f:
+        pickle.dump(slc_calibration, f)
+
+    calibration = load_calibrationSet(fileName)
+    assert not calibration["metadata"]["fitCounts"]
+    assert (calibration["n"] == 0).all()
+    # Chip 2 is the average of the two chips
+    assert np.allclose(calibration["p0"][0, 0, 2], 2.5)
+    assert np.allclose(calibration["p1"][0, 0, 2], 3.0)
+    assert calibration["has_fit"][0, 0] and calibration["has_fit"].sum() == 1
+    # The rule of the Agnostic_I3IceTopSLCCalibrator: n > 1 is not checked without fit counts
+    assert valid_fits(calibration, minN=1)[:, :, 2].sum() == 3
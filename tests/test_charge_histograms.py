@@ -0,0 +1,56 @@
+"""
+Tests of the charge histograms (utils/charge_histograms.py) against np.histogram2d.
+"""
+
+import numpy as np
+
+from utils.charge_histograms import (
+    create_chargeHistograms,
+    merge_chargeHistograms,
+    update_chargeHistograms,
+)
+
+
+def _hits(rng, n, edges):
+    """Charges in PE with values on every edge, on the upper edge, zero and outside of the edges"""
+    logCharges = np.concatenate(
+        (
+            rng.uniform(edges[0] - 0.5, edges[-1] + 0.5, n),
+            np.repeat(edges, 3),
+            [edges[-1]] * 5,
+        )
+    )
+    charges = 10 ** rng.permutation(logCharges)
+    charges[rng.integers(0, len(charges), 10)] = 0.0
+    return charges
+
+
+def test_counts_match_histogram2d():
+    rng = np.random.default_rng(7)
+    chargeHistograms = create_chargeHistograms()
+    edges = chargeHistograms["edges"]
+    channels = np.array([0, 5, 9 * 17 + 4, 9 * 323 + 2])
+
+    slc = _hits(rng, 2000, edges)
+    hlc = _hits(rng, 2000, edges)
+    channel = rng.choice(channels, len(slc))
+    half = len(slc) // 2
+    other = create_chargeHistograms()
+    update_chargeHistograms(chargeHistograms, channel[:half], slc[:half], hlc[:half])
+    update_chargeHistograms(other, channel[half:], slc[half:], hlc[half:])
+    merge_chargeHistograms(chargeHistograms, other)
+
+    counts = chargeHistograms["counts"].reshape((-1,) + (len(edges) - 1,) * 2)
+    with np.errstate(divide="ignore"):
+        logSlc, logHlc = np.log10(slc), np.log10(hlc)
+    for ch in channels:
+        dom, chipATWD = divmod(int(ch), 9)
+        selected = (channel == ch) & (slc > 0) & (hlc > 0)
+        expected, _, _ = np.histogram2d(
+            logSlc[selected], logHlc[selected], bins=[edges, edges]
+        )
+        assert np.array_equal(counts[dom * 6 + chipATWD], expected)
+        zeros = chargeHistograms["zeros"].reshape(-1)[dom * 6 + chipATWD]
+        outside = chargeHistograms["outside"].reshape(-1)[dom * 6 + chipATWD]
+        assert zeros == np.sum((channel == ch) & ~((slc > 0) & (hlc > 0)))
+        assert outside == selected.sum() - expected.sum()
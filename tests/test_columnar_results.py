@@ -0,0 +1,50 @@
+"""
+Tests of the jsonl writer of the result columns (utils/columnar_results.py).
+"""
+
+import json
+
+from utils.columnar_results import build_resultColumns, write_jsonl_fromColumns
+
+
+def _values(n, p0, p1, p0_error, p1_error):
+    """The entry of a channel in the p0_p1_dict, with the literal types of calculate_p0_p1"""
+    return {
+        "n": n,
+        "p0": p0,
+        "p1": p1,
+        "p0_error": p0_error,
+        "p1_error": p1_error,
+        "chi2": 1.5,
+        "x": 2.0,
+        "xx": 4.5,
+        "xy": 3.25,
+        "y": 1.0,
+        "yy": 0.75,
+    }
+
+
+def test_jsonl_keeps_integer_sentinels(tmp_path):
+    p0_p1_dict = {
+        # A good fit, a failed fit, a fit with n <= 2 and an empty channel
+        (1, 61, 0, 0): _values(10, 0.25, 1.125, 0.5, 0.0625),
+        (1, 61, 0, 1): _values(5, 0, 0, -0.5, -0.25),
+        (1, 61, 0, 2): _values(2, 0.25, 1.5, -1, -1),
+        (2, 62, 1, 0): _values(0, 0, 0, -1, -1),
+    }
+    crossOvers_dict = {(1, 61): [120.5, 2000.25]}
+    resultColumns = build_resultColumns(p0_p1_dict, crossOvers_dict, 1, 0.0, 1.0)
+    fileName = tmp_path / "results.jsonl"
+    write_jsonl_fromColumns(resultColumns, str(fileName))
+
+    expectedCrossover = {(1, 61, 0, 0): 120.5, (1, 61, 0, 1): 2000.25}
+    lines = fileName.read_text().splitlines()
+    assert len(lines) == len(p0_p1_dict)
+    for line, (soca, values) in zip(lines, p0_p1_dict.items()):
+        result = json.loads(line)["value"]["result"]
+        for name in ("n", "p0", "p1", "p0_error", "p1_error"):
+            assert result[name] == values[name]
+            assert type(result[name]) is type(values[name]), (soca, name)
+        crossover = expectedCrossover.get(soca, -1)
+        assert result["crossover"] == crossover
+        assert type(result["crossover"]) is type(crossover)
@@ -0,0 +1,34 @@
+"""
+Tests of the set of the used events (utils/event_ids.py).
+"""
+
+import numpy as np
+
+from utils.event_ids import EventIdSet, load_eventIds, pack_eventId
+
+
+def test_duplicates_across_flushes(tmp_path):
+    eventIds = EventIdSet(bufferSize=4)
+    # 10 new events fill the buffer twice, the duplicates are both in the runs and in the buffer
+    for event_id in range(10):
+        assert eventIds.add_event(120160, 0, event_id)
+    for event_id in range(10):
+        assert not eventIds.add_event(120160, 0, event_id)
+    assert eventIds.add_event(120160, 1, 0)
+    assert (len(eventIds), eventIds.nChecked, eventIds.nDuplicates) == (11, 21, 10)
+
+    other = EventIdSet(bufferSize=3)
+    for event_id in range(5, 15):
+        other.add_event(120160, 0, event_id)
+    eventIds.merge(other)
+    expected = sorted(
+        {pack_eventId(120160, 0, e) for e in range(15)} | {pack_eventId(120160, 1, 0)}
+    )
+    assert eventIds.to_array().tolist() == expected
+    assert not eventIds.add_event(120160, 0, 14)
+
+    fileName = str(tmp_path / "eventIds.npy")
+    eventIds.save(fileName)
+    loaded = load_eventIds([fileName, fileName], bufferSize=2)
+    assert np.array_equal(loaded.to_array(), np.array(expected, dtype=np.uint64))
+    assert pack_eventId(120160, 0, 3) in loaded
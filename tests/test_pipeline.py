@@ -0,0 +1,89 @@
+"""
+Tests of the pipeline orchestration (utils/pipeline.py) with a stub runCommand instead of the scripts.
+"""
+
+import json
+
+from utils.pipeline import load_pipelineManifest, run_pipeline
+
+
+def _write_manifest(tmp_path, nRuns):
+    (tmp_path / "in").mkdir()
+    runs = []
+    for run in range(nRuns):
+        (tmp_path / "in" / f"in{run}.txt").write_text(f"input {run}")
+        runs.append({"runNumb": run, "year": 2012})
+    manifest = {
+        "variables": {"d": str(tmp_path)},
+        "runs": runs,
+        "stages": [
+            {
+                "name": "copy",
+                "script": "compare_SLC_calibrations.py",
+                "args": {
+                    "--reference": "{d}/in/in{runNumb}.txt",
+                    "--output": "{d}/out/out{runNumb}.txt",
+                },
+                "inputs": ["{d}/in/in{runNumb}.txt"],
+                "outputs": ["{d}/out/out{runNumb}.txt"],
+            },
+            {
+                "name": "merge",
+                "script": "compare_SLC_calibrations.py",
+                "perRun": False,
+                "args": {"--output": "{d}/out/merged.txt"},
+                "inputs": ["*{d}/out/out{runNumb}.txt"],
+                "outputs": ["{d}/out/merged.txt"],
+            },
+        ],
+    }
+    manifestFile = tmp_path / "manifest.json"
+    manifestFile.write_text(json.dumps(manifest))
+    return str(manifestFile)
+
+
+def stub_command(command, logFile):
+    """Write the file given after --output (a copy of --reference if given), as the scripts do"""
+    output = command[command.index("--output") + 1]
+    text = " ".join(command)
+    if "--reference" in command:
+        with open(command[command.index("--reference") + 1], "r") as f:
+            text = f.read()
+    with open(output, "w") as f:
+        f.write(text)
+    return 0
+
+
+def test_concurrent_stages(tmp_path):
+    stages = load_pipelineManifest(_write_manifest(tmp_path, 64))
+    workDir = str(tmp_path / "work")
+
+    report = run_pipeline(stages, workDir, nWorkers=8, runCommand=stub_command)
+    assert report["counts"] == {"done": 65}
+    assert json.loads((tmp_path / "work" / "hashCache.json").read_text())
+
+    report = run_pipeline(stages, workDir, nWorkers=8, runCommand=stub_command)
+    assert report["counts"] == {"skipped": 65}
+
+
+def test_changed_input_and_failure(tmp_path):
+    stages = load_pipelineManifest(_write_manifest(tmp_path, 4))
+    workDir = str(tmp_path / "work")
+    run_pipeline(stages, workDir, nWorkers=4, runCommand=stub_command)
+
+    (tmp_path / "in" / "in1.txt").write_text("changed input")
+    report = run_pipeline(stages, workDir, nWorkers=4, runCommand=stub_command)
+    assert report["status"]["copy:Run1"] == "done"
+    assert report["status"]["copy:Run0"] == "skipped"
+    assert report["status"]["merge"] == "done"
+
+    def failing_command(command, logFile):
+        if any("in2.txt" in c for c in command):
+            return 3
+        return stub_command(command, logFile)
+
+    report = run_pipeline(
+        stages, workDir, nWorkers=4, force=True, runCommand=failing_command
+    )
+    assert report["status"]["copy:Run2"] == "failed"
+    assert report["status"]["merge"] == "blocked"
@@ -0,0 +1,91 @@
+"""
+Tests of the reprocessing scheduler (utils/reprocessing.py) with a stub tray and a thread pool
+which breaks like a process pool when a worker dies.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from utils.reprocessing import make_jobs, run_jobs
+
+
+def stub_tray(inputFile, outputFile):
+    """Copy the input file, as a tray which writes one frame per line"""
+    with open(inputFile, "r") as f:
+        text = f.read()
+    if "fail" in text:
+        raise RuntimeError(f"cannot process {inputFile}")
+    with open(outputFile, "w") as f:
+        f.write(text)
+    return text.count("\n")
+
+
+class CrashingExecutor(ThreadPoolExecutor):
+    """
+    A thread pool where the job of a "crash" file kills its worker: the job and
+    all the other jobs still in the pool end with BrokenProcessPool, as in a process pool.
+    """
+
+    def __init__(self, max_workers):
+        super().__init__(max_workers=max_workers)
+        self.broken = threading.Event()
+
+    def submit(self, fn, runTray, job):
+        def run():
+            if os.path.basename(job["inputFile"]).startswith("crash"):
+                self.broken.set()
+            else:
+                # The other jobs are still running when the worker dies
+                time.sleep(0.05)
+            if self.broken.is_set():
+                raise BrokenProcessPool("A process in the process pool was terminated")
+            return fn(runTray, job)
+
+        return super().submit(run)
+
+
+def _write_inputs(tmp_path, names, text="frame\nframe\n"):
+    inputFiles = []
+    for name in names:
+        inputFile = tmp_path / "in" / f"{name}.i3"
+        inputFile.parent.mkdir(exist_ok=True)
+        inputFile.write_text(text)
+        inputFiles.append(str(inputFile))
+    return inputFiles
+
+
+def test_retry_and_skip_done(tmp_path):
+    inputFiles = _write_inputs(tmp_path, [f"file{i}" for i in range(6)])
+    (tmp_path / "in" / "file5.i3").write_text("fail\n")
+    jobs = make_jobs(inputFiles, str(tmp_path / "out"))
+
+    report = run_jobs(
+        jobs, stub_tray, nWorkers=3, maxRetries=2, executorClass=ThreadPoolExecutor
+    )
+    assert (report["n_done"], report["n_failed"], report["n_retries"]) == (5, 1, 2)
+    assert report["n_frames"] == 10
+    assert report["failed"][0]["inputFile"] == inputFiles[5]
+    assert "RuntimeError" in report["failed"][0]["error"]
+    assert not list((tmp_path / "out").glob("_part_*"))
+
+    # The finished outputs are skipped, the failed job runs again
+    (tmp_path / "in" / "file5.i3").write_text("frame\n")
+    report = run_jobs(jobs, stub_tray, nWorkers=3, executorClass=ThreadPoolExecutor)
+    assert (report["n_skipped"], report["n_done"], report["n_failed"]) == (5, 1, 0)
+
+
+def test_crash_is_charged_only_to_its_job(tmp_path):
+    names = [f"file{i}" for i in range(8)]
+    names[2] = "crash"
+    jobs = make_jobs(_write_inputs(tmp_path, names), str(tmp_path / "out"))
+
+    report = run_jobs(
+        jobs, stub_tray, nWorkers=4, maxRetries=0, executorClass=CrashingExecutor
+    )
+    assert (report["n_done"], report["n_failed"], report["n_retries"]) == (7, 1, 0)
+    assert report["failed"][0]["inputFile"].endswith("crash.i3")
+    assert "BrokenProcessPool" in report["failed"][0]["error"]
+    assert report["n_crashes"] == 2
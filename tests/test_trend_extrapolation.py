@@ -0,0 +1,53 @@
+"""
+Tests of the extrapolation of the calibrations (utils/trend_extrapolation.py) from Level3 pickles.
+"""
+
+import pickle
+
+import numpy as np
+
+from utils.calibration_artifact import (
+    artifact_to_resultColumns,
+    load_calibrationSet,
+    valid_fits,
+)
+from utils.columnar_results import write_jsonl_fromColumns
+from utils.trend_extrapolation import extrapolate_calibrations
+
+
+def _write_L3Pickle(fileName, mjd, p0):
+    """A Level3 pickle with one time entry per channel: OM (1, 61) complete, OM (2, 62) with one channel"""
+    slc_calibration = {
+        (1, 61, chip, atwd): ([mjd], [p0 + atwd], [2.0 + chip])
+        for chip in range(3)
+        for atwd in range(3)
+    }
+    slc_calibration[(2, 62, 0, 0)] = ([mjd], [p0], [2.0])
+    with open(fileName, "wb") as f:
+        pickle.dump(slc_calibration, f)
+
+
+def test_extrapolation_from_pickles(tmp_path):
+    fileNames = []
+    for i, (mjd, p0) in enumerate(((56100.0, 1.0), (56465.0, 1.5), (56830.0, 2.0))):
+        fileNames.append(str(tmp_path / f"L3_{i}.pcl"))
+        _write_L3Pickle(fileNames[-1], mjd, p0)
+    artifacts = [load_calibrationSet(fileName) for fileName in fileNames]
+
+    (extrapolated,) = extrapolate_calibrations(artifacts, [2016])
+    assert not extrapolated["metadata"]["fitCounts"]
+    # Only the OM with all its channels has a fit
+    assert extrapolated["has_fit"].sum() == 1
+    assert extrapolated["has_fit"][0, 0]
+    assert (extrapolated["n"][0, 0] == 3).all()
+    assert valid_fits(extrapolated).sum() == 9
+
+    # The jsonl read by the Agnostic_I3IceTopSLCCalibrator: the channels of chip 2
+    # are calibrated if n > 1 and p0, p1 are finite
+    fileName = str(tmp_path / "Extrapolated_2016.jsonl")
+    write_jsonl_fromColumns(artifact_to_resultColumns(extrapolated), fileName)
+    calibration = load_calibrationSet(fileName)
+    chip2 = (slice(None), slice(None), 2)
+    assert (calibration["n"][0, 0][2] > 1).all()
+    assert valid_fits(calibration, minN=1)[chip2].sum() == 3
+    assert np.all(np.isfinite(calibration["p0"][0, 0]))
@@ -1,10 +1,28 @@
+import time
+
+import numpy as np
+
 from I3Tray import *
 from icecube import icetray, dataclasses, topeventcleaning, icetop_Level3_scripts
 from icecube.icetray import I3Module, I3ConditionalModule, I3Frame
 from icecube.dataclasses import I3RecoPulseSeriesMapMask, I3EventHeader
 from icecube.icetray.i3logging import (
+    log_info,
     log_warn,
     log_debug,
+    log_fatal,
+)
+
+from utils.calibration_artifact import load_calibrationSet, valid_fits
+from utils.channel_index import (
+    FIRST_OM,
+    N_ATWDS,
+    N_CHIPS,
+    N_DOMS,
+    N_OMS,
+    N_STRINGS,
+    dom_index,
+    is_icetop_dom,
 )
 
 
@@ -20,6 +38,11 @@ class Agnostic_I3IceTopSLCCalibrator(I3ConditionalModule):
     -- Averaging the slopes and intercepts from Chip 0 and Chip 1, for that ATWD
     It uses the same "pickle file" used by regular L3 processing.
 
+    The module counts, in (string, om, atwd) arrays, the pulses calibrated for each guessed ATWD,
+    the pulses set to NaN for each SOCA without calibration and the pulses of the OMs without pe_per_vem,
+    and times the processing of each frame. The warnings are given once per SOCA (or OM) and at most
+    MaxWarnings times, a summary is logged at Finish and optionally written in a JSON file (MetricsOut).
+
     This module is to be used on data prior to IC86.2022.  Starting with IC86.2022, the "I3ITSLCCalData"
     frame objects were created and started coming to the north, and there will be a whole different
     (hopefully better) way of calibrating SLC's in the future.  This module is a quick 'n' dirty stopgap
@@ -41,47 +64,61 @@ class Agnostic_I3IceTopSLCCalibrator(I3ConditionalModule):
         self.AddParameter(
             "Config", "Configuration file with the parameters for each OM/chip/ATWD"
         )
+        self.AddParameter(
+            "MaxWarnings",
+            "Maximum number of warnings about OMs without calibration, the rest is only counted",
+            10,
+        )
+        self.AddParameter(
+            "MetricsOut",
+            "Name of a JSON file where the counters are written at Finish (not written if empty)",
+            "",
+        )
         self.AddOutBox("OutBox")
 
         self.geometry = None
-        self.warned = []
+        self.warned = set()
 
-    def Configure(self):
-        import json  # make python3 happy
+        # Counters indexed by [string - 1, om - 61, atwd]
+        self.n_calibrated = np.zeros((N_STRINGS, N_OMS, N_ATWDS), dtype=np.int64)
+        self.n_nan = np.zeros((N_STRINGS, N_OMS, N_ATWDS), dtype=np.int64)
+        # Pulses of the OMs without pe_per_vem, indexed by [string - 1, om - 61]
+        self.n_missing_pe_per_vem = np.zeros((N_STRINGS, N_OMS), dtype=np.int64)
+        self.n_frames = 0
+        self.frame_time = 0.0
+        self.max_frame_time = 0.0
 
+    def Configure(self):
         self.slc_name = self.GetParameter("SLCPulses")
         self.slc_name_out = self.GetParameter("SLCPulsesOut")
         if self.slc_name_out == "":
             self.slc_name_out = self.slc_name
+        self.max_warnings = self.GetParameter("MaxWarnings")
+        self.metrics_out = self.GetParameter("MetricsOut")
 
-        ## The "rb" to read as binary, and the "latin-1" to translate the ASCII
-        ## are necessary to make a pickle file from python2 readable by python3.
-        ## (This may be able to go away in the future.)
-        self.parameters = {}
-        with open(self.GetParameter("Config"), "rb") as f:
-            for line in f:
-                jsonLine = json.loads(line)
-                self.createDict_from_json(jsonLine)
-
-    def createDict_from_json(self, line):
-        """
-        This function takes the json file and creates a dictionary with the parameters for each OM/chip/ATWD
-        """
-        string = line["value"]["string"]
-        om = line["value"]["om"]
-        chip = line["value"]["chip"]
-        atwd = line["value"]["channel"]
-        n = line["value"]["result"]["n"]
-        p0 = line["value"]["result"]["p0"]
-        p1 = line["value"]["result"]["p1"]
-        crossover = line["value"]["result"]["crossover"]
-        self.parameters[(string, om, chip, atwd)] = {
-            "n": n,
-            "p0": p0,
-            "p1": p1,
-            "crossover": crossover,
-        }
-        return
+        # The parameters of each OM/chip/ATWD in dense arrays addressed by the dom index
+        # (see utils.channel_index), from the jsonl file or any other calibration output
+        calibration = load_calibrationSet(self.GetParameter("Config"))
+        # A SOCA is calibrated if its fit used more than one charge (n > 1) and p0, p1 are finite,
+        # the n > 1 check is skipped if the file has no number of charges (e.g. a Level3 pickle)
+        calibrated = valid_fits(calibration, minN=1)
+        if not calibrated[:, :, 2].any():
+            log_fatal(
+                f"{self.GetParameter('Config')} has no SLC calibration of chip 2 "
+                + "(no fit with n > 1 and finite p0 and p1)"
+            )
+        # Python lists are much faster to index than NumPy arrays element by element
+        self.calibrated_soca = calibrated.reshape(N_DOMS, N_CHIPS, N_ATWDS)[
+            :, 2
+        ].tolist()
+        self.p0_soca = (
+            calibration["p0"].reshape(N_DOMS, N_CHIPS, N_ATWDS)[:, 2].tolist()
+        )
+        self.p1_soca = (
+            calibration["p1"].reshape(N_DOMS, N_CHIPS, N_ATWDS)[:, 2].tolist()
+        )
+        # The crossover points 0-1 and 1-2 in PE, nan if the OM has none
+        self.crossover = calibration["crossover"].reshape(N_DOMS, 2).tolist()
 
     def atwd_educated_guess(self, omkey, charge):
         """
@@ -94,16 +131,11 @@ class Agnostic_I3IceTopSLCCalibrator(I3ConditionalModule):
         Returns:
         atwd: Estimated ATWD channel of the pulse
         """
+        dom = dom_index(omkey.string, omkey.om)
         # TODO The Crossover values are in units of PE, but the charge is in units of VEM!!
         ############ BE CAREFUL!! ##############
-        cop01 = (
-            self.parameters[(omkey.string, omkey.om, 0, 0)]["crossover"]
-            / self.pe_per_vem[omkey]
-        )
-        cop12 = (
-            self.parameters[(omkey.string, omkey.om, 0, 1)]["crossover"]
-            / self.pe_per_vem[omkey]
-        )
+        cop01 = self.crossover[dom][0] / self.pe_per_vem[dom]
+        cop12 = self.crossover[dom][1] / self.pe_per_vem[dom]
         if charge < cop01:
             atwd = 0
         elif charge < cop12:
@@ -113,13 +145,18 @@ class Agnostic_I3IceTopSLCCalibrator(I3ConditionalModule):
         return atwd
 
     def Calibration(self, frame):
-        self.pe_per_vem = {}
+        # pe_per_vem of each IceTop OM addressed by the dom index, nan if it is missing
+        self.pe_per_vem = [float("nan")] * N_DOMS
         I3Cal = frame["I3Calibration"]
         for om in I3Cal.vem_cal.keys():
-            self.pe_per_vem[om] = I3Cal.vem_cal[om].pe_per_vem
+            if is_icetop_dom(om.string, om.om):
+                self.pe_per_vem[dom_index(om.string, om.om)] = I3Cal.vem_cal[
+                    om
+                ].pe_per_vem
         self.PushFrame(frame)
 
     def DAQ(self, frame):
+        start = time.perf_counter()
         if not self.slc_name in frame:
             log_debug(
                 "I didn't find object %s in the frame.  Moving on." % self.slc_name
@@ -136,39 +173,48 @@ class Agnostic_I3IceTopSLCCalibrator(I3ConditionalModule):
         # TODO Redo the time check, just in case
         # header = frame["I3EventHeader"]
 
-        # First check whether SLC parameters are defined.
-        # We'll use OM 2,61 for this (1 was non-existing in IC79)
-        # p = self.parameters[(2, 61, 0, 0)]
-        # if (
-        #     header.start_time.mod_julian_day_double < p[0][0]
-        #     or header.start_time.mod_julian_day_double > p[0][-1]
-        # ):
-        #     log_fatal(
-        #         "Time of this event outside range containing SLC calibration constants."
-        #     )
-
         for om in pulses.keys():
+            dom = dom_index(om.string, om.om)
+            calibrated = [0] * N_ATWDS
+            nan = [0] * N_ATWDS
+            pe_per_vem = self.pe_per_vem[dom]
+            if pe_per_vem != pe_per_vem:  # nan, the OM is not in the vem_cal
+                # Impossible to calibrate without the VEM calibration, so set to NaN
+                self.n_missing_pe_per_vem.flat[dom] += len(pulses[om])
+                self.warn_once(
+                    (om.string, om.om), f"Skipping {om}! (missing pe_per_vem)"
+                )
+                for i in range(len(pulses[om])):
+                    pulses[om][i].charge = float("nan")
+                continue
+
             for i in range(len(pulses[om])):
                 # Make an educated guess about the ATWD channel, based on the charge
                 atwd = self.atwd_educated_guess(om, pulses[om][i].charge)
 
-                soca = (om.string, om.om, 2, atwd)
-                if self.parameters[soca]["n"] > 1:
+                if self.calibrated_soca[dom][atwd]:
                     # do the calibration
-                    intercept = self.parameters[soca]["p0"]
+                    intercept = self.p0_soca[dom][atwd]
                     slope = (
-                        self.parameters[soca]["p1"] * self.pe_per_vem[om]
+                        self.p1_soca[dom][atwd] * pe_per_vem
                     )  # TODO: This is a hack to convert from PE to VEM
                     # calibrate the pulse!
                     pulses[om][i].charge = intercept + slope * pulses[om][i].charge
+                    calibrated[atwd] += 1
 
                 else:
-                    log_warn(f"Skipping {om}! (missing SLC calibration information")
-                    if not (soca, "calib") in self.warned:
-                        self.warned.append((soca, "calib"))
+                    self.warn_once(
+                        (om.string, om.om, 2, atwd),
+                        f"Skipping {om}! (missing SLC calibration information)",
+                    )
 
                     # Impossible to calibrate, so set to NaN
                     pulses[om][i].charge = float("nan")
+                    nan[atwd] += 1
+
+            # The counters are updated once per OM instead of once per pulse
+            self.n_calibrated.reshape(N_DOMS, N_ATWDS)[dom] += calibrated
+            self.n_nan.reshape(N_DOMS, N_ATWDS)[dom] += nan
 
         if self.slc_name_out in frame:
             log_warn(
@@ -177,8 +223,74 @@ class Agnostic_I3IceTopSLCCalibrator(I3ConditionalModule):
             )
             del frame[self.slc_name_out]
         frame.Put(self.slc_name_out, pulses)
+
+        duration = time.perf_counter() - start
+        self.n_frames += 1
+        self.frame_time += duration
+        self.max_frame_time = max(self.max_frame_time, duration)
         self.PushFrame(frame)
 
+    def warn_once(self, key, message):
+        """
+        Warn only the first time for each key (SOCA or OM), and at most MaxWarnings times in total.
+        """
+        if key in self.warned:
+            return
+        self.warned.add(key)
+        if len(self.warned) <= self.max_warnings:
+            log_warn(message)
+        elif len(self.warned) == self.max_warnings + 1:
+            # Only when a warning is actually suppressed, the first time
+            log_warn(
+                "Maximum number of warnings reached, the other OMs without calibration "
+                + "are only counted and reported at Finish"
+            )
+
+    def get_metrics(self):
+        """
+        Return the counters of the module as a dictionary (the arrays are given for the OMs with entries).
+        """
+        string, om = np.nonzero(
+            self.n_calibrated.sum(axis=-1)
+            + self.n_nan.sum(axis=-1)
+            + self.n_missing_pe_per_vem
+        )
+        return {
+            "n_frames": self.n_frames,
+            "frame_time_s": self.frame_time,
+            "mean_frame_time_s": (
+                self.frame_time / self.n_frames if self.n_frames else 0.0
+            ),
+            "max_frame_time_s": self.max_frame_time,
+            "n_calibrated_per_atwd": self.n_calibrated.sum(axis=(0, 1)).tolist(),
+            "n_nan_per_atwd": self.n_nan.sum(axis=(0, 1)).tolist(),
+            "n_missing_pe_per_vem": int(self.n_missing_pe_per_vem.sum()),
+            "n_warned": len(self.warned),
+            "oms": {
+                "string": (string + 1).tolist(),
+                "om": (om + FIRST_OM).tolist(),
+                "n_calibrated": self.n_calibrated[string, om].tolist(),
+                "n_nan": self.n_nan[string, om].tolist(),
+                "n_missing_pe_per_vem": self.n_missing_pe_per_vem[string, om].tolist(),
+            },
+        }
+
+    def Finish(self):
+        import json
+
+        metrics = self.get_metrics()
+        log_info(
+            f"Agnostic_I3IceTopSLCCalibrator: {metrics['n_frames']} frames "
+            + f"({metrics['mean_frame_time_s'] * 1e3:.3f} ms per frame), "
+            + f"pulses calibrated per ATWD {metrics['n_calibrated_per_atwd']}, "
+            + f"set to NaN per ATWD {metrics['n_nan_per_atwd']}, "
+            + f"without pe_per_vem {metrics['n_missing_pe_per_vem']}, "
+            + f"{metrics['n_warned']} SOCAs/OMs without calibration"
+        )
+        if self.metrics_out != "":
+            with open(self.metrics_out, "w") as f:
+                json.dump(metrics, f)
+
 
 @icetray.traysegment
 def Calibrate_Orphaned_SLCVEMPulses(
@@ -1,24 +1,14 @@
 """
 __author__ = Federico Bontempo KIT PhD student <federico.bontempo@kit.edu>
 
-This script defines two functions:  
-    get_calibration_values 
+This script defines the functions:
     calculate_p0_p1
+    create_channelSums, sums_from_dict, fit_channels, fit_to_dict (the fit of all the channels at once)
+    create_channelMoments, update_channelMoments, merge_channelMoments, moments_to_sums,
+    fit_channelMoments (the fit of all the channels from the centered moments)
 
 Here's a summary of what each function does:
 
-get_calibration_values Function:
-    This function calculates the p0 and p1 values for a given OMKey based on provided sums and statistics. 
-    The calculated values and related information are stored in the result_dict.
-
-    Parameters:
-        sums_dict: A dictionary containing sums and statistics necessary for the calculation.
-        string: A string identifier.
-        om: An identifier for the optical module.
-        chip: An identifier for the chip.
-        atwd: An identifier for the analog to waveform digitizer.
-        result_dict: A dictionary to store the results.
-
 calculate_p0_p1 Function:
     This function calculates the p0 and p1 values for each OMKey in the input slcATW_dict. 
     The calculations are based on the method of least squares. 
@@ -30,111 +20,333 @@ calculate_p0_p1 Function:
         Returns:
         result_dict: A dictionary containing the calculated p0 and p1 values, errors, chi-squared values, and other related statistics for each OMKey.
 
-The calculate_p0_p1 function iterates over OMKeys and uses 
-the get_calibration_values function to calculate p0 and p1 values for each combination of OMKey, chip, and ATWD. 
-It also sums the charges from two chips and calculates p0 and p1 for the combined values. 
+The calculate_p0_p1 function puts the sums of the OMKeys in dense (81, 4, 3, 3) arrays
+indexed by [string - 1, om - 61, chip, atwd] (see utils.channel_index) and fit_channels calculates
+p0 and p1 values for all the combinations of OMKey, chip, and ATWD at once.
+It also sums the charges from two chips (chip 2) and calculates p0 and p1 for the combined values.
 The results are then returned in the result_dict.
 
-The get_calibration_values function calculates p0 and p1 values using a least squares method and stores the results in the result_dict. 
-It also handles cases where the calculated values might not be valid.
-"""
+The raw sums (xx, yy, xy) of many charges spanning several decades lose the variance in
+delta = n * xx - x**2 (and chi2 can come out negative). The channel moments keep instead the means
+and the centered co-moments of each channel: the charges of a frame (or of a file) are
+a batch with its own means and co-moments, which are merged in the moments with the parallel
+algorithm of Chan et al., so moments filled by different jobs can be merged as well.
+fit_channelMoments gives the same p0, p1 and chi2 as fit_channels and the raw sums are still
+in its output (moments_to_sums).
 
+This script does not need the IceCube software (the keys can be OMKeys or (string, om) tuples),
+the warnings go to icetray.i3logging if it is available (see utils.log).
+"""
 
 import numpy as np
-from icecube import icetray, vemcal, dataclasses
-from icecube.icetray.i3logging import (
+
+from utils.channel_index import (
+    CHANNEL_SHAPE,
+    channel_from_index,
+    omkey_to_dom,
+    N_ATWDS,
+    N_CHIPS,
+)
+from utils.log import (
     log_warn,
     log_fatal,
 )
 
 
-def get_calibration_values(sums_dict, string, om, chip, atwd, result_dict):
+SUM_KEYS = ("n", "x", "xx", "y", "yy", "xy")
+
+
+def create_channelSums():
+    """
+    Create the empty sums of all the channels, a dictionary of (81, 4, 3, 3) arrays
+    indexed by [string - 1, om - 61, chip, atwd] for each key of SUM_KEYS.
+    Only the chips 0 and 1 are filled, chip 2 is the sum of the two chips (see fit_channels).
     """
-    Calculate the p0 and p1 values for a given OMKey.
+    return {
+        key: np.zeros(CHANNEL_SHAPE, dtype=np.int64 if key == "n" else np.float64)
+        for key in SUM_KEYS
+    }
+
+
+def sums_from_dict(slcATW_dict):
+    """
+    Put the sums of a dictionary {OMKey: {"chip0atwd0": {"n": ..., "x": ...}, ...}} in channel sums.
+    The keys can be OMKeys, (string, om) tuples or "string,om" strings.
+    """
+    channelSums = create_channelSums()
+    for omkey, sums_dict in slcATW_dict.items():
+        dom = omkey_to_dom(omkey)
+        for chip in range(2):
+            for atwd in range(N_ATWDS):
+                for key in SUM_KEYS:
+                    channelSums[key].reshape(-1, N_CHIPS, N_ATWDS)[dom, chip, atwd] = (
+                        sums_dict[f"chip{chip}atwd{atwd}"][key]
+                    )
+    return channelSums
+
+
+def fit_channels(channelSums):
+    """
+    Calculate the p0 and p1 values of all the channels at once with the closed form
+    of the least squares.
     ----------------------------------------------
     Parameters:
-        sums_dict: A dictionary containing sums and statistics necessary for the calculation.
-        string: A string identifier.
-        om: An identifier for the optical module.
-        chip: An identifier for the chip.
-        atwd: An identifier for the analog to waveform digitizer.
-        result_dict: A dictionary to store the results.
+        channelSums: The sums of the chips 0 and 1 (see create_channelSums).
+    Returns:
+        fit: A dictionary of (81, 4, 3, 3) arrays with p0, p1, p0_error, p1_error, chi2
+            and the sums (n, x, xx, y, yy, xy), chip 2 is the fit of the sum of the two chips.
+            p0 = p1 = 0 and the errors are -1 if the fit is not possible, the errors are -1 if n <= 2.
     """
-    delta = sums_dict["n"] * sums_dict["xx"] - sums_dict["x"] ** 2
+    fit = {}
+    for key in SUM_KEYS:
+        fit[key] = channelSums[key].copy()
+        fit[key][:, :, 2] = fit[key][:, :, 0] + fit[key][:, :, 1]
+    n, x, xx, y, yy, xy = (fit[key] for key in SUM_KEYS)
 
-    if (delta <= 0) or (sums_dict["n"] == 1):
+    delta = n * xx - x**2
+    valid = (delta > 0) & (n != 1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        a = np.where(valid, (xx * y - x * xy) / delta, 0.0)
+        b = np.where(valid, (n * xy - x * y) / delta, 0.0)
+        # these are the sqrt(variance) on the parameters
+        aerr = np.where(valid, np.sqrt(xx / delta), -1.0)
+        berr = np.where(valid, np.sqrt(n / delta), -1.0)
+        chi2 = yy - 2 * a * y - 2 * b * xy + a**2 * n + 2 * a * b * x + b**2 * xx
+        scale = np.sqrt(chi2 / (n - 2))
+    fit["p0"] = a
+    fit["p1"] = b
+    fit["p0_error"] = np.where(n > 2, aerr * scale, -1.0)
+    fit["p1_error"] = np.where(n > 2, berr * scale, -1.0)
+    fit["chi2"] = chi2
+
+    _report_fits(fit, valid)
+    return fit
+
+
+def _report_fits(fit, valid):
+    """Log the warnings of the channels which can not be fitted or have a chi2 < 0"""
+    n, x, xx, y, yy, xy = (fit[key] for key in SUM_KEYS)
+    chi2 = fit["chi2"]
+
+    # The empty channels can not be fitted, only the channels with charges are reported
+    for channel in np.flatnonzero(~valid & (n > 0)):
+        string, om, chip, atwd = channel_from_index(int(channel))
         log_warn(
             f"This OM has a delta<=0: ({string},{om},{chip},{atwd})", unit="vemcal"
         )
         log_warn(
-            f"n = {sums_dict['n']}, xx = {sums_dict['xx']}, x = {sums_dict['x']}",
+            f"n = {n.flat[channel]}, xx = {xx.flat[channel]}, x = {x.flat[channel]}",
             unit="vemcal",
         )
-        a = 0
-        b = 0
-        aerr = -1
-        berr = -1
-    else:
-        a = (
-            sums_dict["xx"] * sums_dict["y"] - sums_dict["x"] * sums_dict["xy"]
-        ) / delta
-        b = (sums_dict["n"] * sums_dict["xy"] - sums_dict["x"] * sums_dict["y"]) / delta
-        # these are the sqrt(variance) on the parameters
-        aerr = np.sqrt(sums_dict["xx"] / delta)
-        berr = np.sqrt(sums_dict["n"] / delta)
-    chi2 = (
-        sums_dict["yy"]
-        - 2 * a * sums_dict["y"]
-        - 2 * b * sums_dict["xy"]
-        + a**2 * sums_dict["n"]
-        + 2 * a * b * sums_dict["x"]
-        + b**2 * sums_dict["xx"]
-    )
+    nEmpty = np.count_nonzero(n == 0)
+    if nEmpty:
+        log_warn(f"{nEmpty} channels have no charges", unit="vemcal")
 
-    if chi2 < 0:
+    for channel in np.flatnonzero(chi2 < 0):
+        string, om, chip, atwd = channel_from_index(int(channel))
         log_warn(f"SOCA = {string} {om} {chip} {atwd}", unit="vemcal")
         log_warn(
-            f"WARN: chi2 came out less than zero for some reason: {chi2}",
+            f"WARN: chi2 came out less than zero for some reason: {chi2.flat[channel]}",
             unit="vemcal",
         )
         log_warn(
-            f"N = {sums_dict['n']}, "
-            + f"Sx = {sums_dict['x']}, "
-            + f"Sy = {sums_dict['y']}, "
-            + f"Sxx = {sums_dict['xx']}, "
-            + f"Syy = {sums_dict['yy']}, "
-            + f"Sxy = {sums_dict['xy']}",
+            f"N = {n.flat[channel]}, "
+            + f"Sx = {x.flat[channel]}, "
+            + f"Sy = {y.flat[channel]}, "
+            + f"Sxx = {xx.flat[channel]}, "
+            + f"Syy = {yy.flat[channel]}, "
+            + f"Sxy = {xy.flat[channel]}",
             unit="vemcal",
         )
-        if sums_dict["n"] > 2:
+        if n.flat[channel] > 2:
             log_fatal("This will cause a fatal NaN error later.")
 
-    result_dict[(string, om, chip, atwd)] = {}
-    result_dict[(string, om, chip, atwd)]["p0"] = a
-    result_dict[(string, om, chip, atwd)]["p1"] = b
-    if sums_dict["n"] <= 2:
+    for channel in np.flatnonzero((n > 0) & (n <= 2)):
+        string, om, chip, atwd = channel_from_index(int(channel))
         log_warn(
-            f"This OM has a n={sums_dict['n']}, which is <=2: ({string},{om},{chip},{atwd})",
+            f"This OM has a n={n.flat[channel]}, which is <=2: ({string},{om},{chip},{atwd})",
             unit="vemcal",
         )
-        result_dict[(string, om, chip, atwd)]["p0_error"] = -1
-        result_dict[(string, om, chip, atwd)]["p1_error"] = -1
-    else:
-        result_dict[(string, om, chip, atwd)]["p0_error"] = aerr * np.sqrt(
-            chi2 / (sums_dict["n"] - 2)
+    return
+
+
+MOMENT_KEYS = ("n", "mean_x", "mean_y", "cxx", "cyy", "cxy")
+
+
+def create_channelMoments():
+    """
+    Create the empty moments of all the channels, a dictionary of (81, 4, 3, 3) arrays
+    indexed by [string - 1, om - 61, chip, atwd] for each key of MOMENT_KEYS:
+    the number of charges, the means of x (slc) and y (hlc) and the centered co-moments
+    cxx = sum((x - mean_x)**2), cyy = sum((y - mean_y)**2) and cxy = sum((x - mean_x) * (y - mean_y)).
+    Only the chips 0 and 1 are filled, chip 2 is the merge of the two chips (see fit_channelMoments).
+    """
+    return {
+        key: np.zeros(CHANNEL_SHAPE, dtype=np.int64 if key == "n" else np.float64)
+        for key in MOMENT_KEYS
+    }
+
+
+def _merge_moments(a, b):
+    """
+    Return the moments of the union of the charges of the moments a and b
+    (dictionaries of arrays of the same shape) with the pairwise update of Chan et al.
+    The moments of an empty side are taken as they are, so merging empty moments changes nothing.
+    """
+    n = a["n"] + b["n"]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        fraction = np.where(n > 0, b["n"] / n, 0.0)
+    dx = b["mean_x"] - a["mean_x"]
+    dy = b["mean_y"] - a["mean_y"]
+    weight = a["n"] * fraction
+    aEmpty = a["n"] == 0
+    bEmpty = b["n"] == 0
+
+    merged = {"n": n}
+    for key, delta in (("mean_x", dx), ("mean_y", dy)):
+        merged[key] = np.where(
+            aEmpty, b[key], np.where(bEmpty, a[key], a[key] + delta * fraction)
         )
-        result_dict[(string, om, chip, atwd)]["p1_error"] = berr * np.sqrt(
-            chi2 / (sums_dict["n"] - 2)
+    for key, delta0, delta1 in (("cxx", dx, dx), ("cyy", dy, dy), ("cxy", dx, dy)):
+        merged[key] = np.where(
+            aEmpty,
+            b[key],
+            np.where(bEmpty, a[key], a[key] + b[key] + delta0 * delta1 * weight),
         )
-    result_dict[(string, om, chip, atwd)]["n"] = sums_dict["n"]
-    result_dict[(string, om, chip, atwd)]["chi2"] = chi2
+    return merged
 
-    # Extend tth result_dict with the sum_dict
-    result_dict[(string, om, chip, atwd)].update(sums_dict)
 
+def update_channelMoments(channelMoments, channel, x, y):
+    """
+    Merge a batch of charges in the channel moments (in place).
+    The means and co-moments of the batch are calculated with two passes over its charges.
+    ----------------------------------------------
+    Parameters:
+        channelMoments: The moments of the chips 0 and 1 (see create_channelMoments).
+        channel: The channel index of each charge (see utils.channel_index).
+        x: The slc charges.
+        y: The hlc charges.
+    """
+    if len(channel) == 0:
+        return
+    channels, inverse = np.unique(channel, return_inverse=True)
+    n = np.bincount(inverse)
+    batch = {"n": n}
+    batch["mean_x"] = np.bincount(inverse, x) / n
+    batch["mean_y"] = np.bincount(inverse, y) / n
+    dx = x - batch["mean_x"][inverse]
+    dy = y - batch["mean_y"][inverse]
+    batch["cxx"] = np.bincount(inverse, dx * dx)
+    batch["cyy"] = np.bincount(inverse, dy * dy)
+    batch["cxy"] = np.bincount(inverse, dx * dy)
+
+    flat = {key: value.reshape(-1) for key, value in channelMoments.items()}
+    merged = _merge_moments({key: flat[key][channels] for key in MOMENT_KEYS}, batch)
+    for key in MOMENT_KEYS:
+        flat[key][channels] = merged[key]
     return
 
 
+def merge_channelMoments(channelMoments, other):
+    """
+    Merge the channel moments other in channelMoments (in place), e.g. the moments
+    of different files or jobs of the same run.
+    """
+    merged = _merge_moments(channelMoments, other)
+    for key in MOMENT_KEYS:
+        channelMoments[key][...] = merged[key]
+    return channelMoments
+
+
+def moments_to_sums(channelMoments):
+    """
+    Return the raw sums (see create_channelSums) of the channel moments,
+    e.g. xx = cxx + n * mean_x**2.
+    """
+    n = channelMoments["n"]
+    mean_x = channelMoments["mean_x"]
+    mean_y = channelMoments["mean_y"]
+    return {
+        "n": n.copy(),
+        "x": n * mean_x,
+        "xx": channelMoments["cxx"] + n * mean_x**2,
+        "y": n * mean_y,
+        "yy": channelMoments["cyy"] + n * mean_y**2,
+        "xy": channelMoments["cxy"] + n * mean_x * mean_y,
+    }
+
+
+def fit_channelMoments(channelMoments):
+    """
+    Calculate the p0 and p1 values of all the channels at once from the centered moments,
+    the same fit as fit_channels without the cancellation of the raw sums.
+    ----------------------------------------------
+    Parameters:
+        channelMoments: The moments of the chips 0 and 1 (see create_channelMoments).
+    Returns:
+        fit: A dictionary of (81, 4, 3, 3) arrays with p0, p1, p0_error, p1_error, chi2,
+            the raw sums (n, x, xx, y, yy, xy) and the moments (mean_x, mean_y, cxx, cyy, cxy),
+            chip 2 is the fit of the merge of the two chips.
+            p0 = p1 = 0 and the errors are -1 if the fit is not possible, the errors are -1 if n <= 2.
+    """
+    moments = {key: channelMoments[key].copy() for key in MOMENT_KEYS}
+    merged = _merge_moments(
+        {key: moments[key][:, :, 0] for key in MOMENT_KEYS},
+        {key: moments[key][:, :, 1] for key in MOMENT_KEYS},
+    )
+    for key in MOMENT_KEYS:
+        moments[key][:, :, 2] = merged[key]
+    n, mean_x, mean_y, cxx, cyy, cxy = (moments[key] for key in MOMENT_KEYS)
+
+    fit = moments_to_sums(moments)
+    fit.update(moments)
+    # delta = n * xx - x**2 = n * cxx
+    valid = (cxx > 0) & (n != 1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        b = np.where(valid, cxy / cxx, 0.0)
+        a = np.where(valid, mean_y - b * mean_x, 0.0)
+        # these are the sqrt(variance) on the parameters
+        aerr = np.where(valid, np.sqrt(1.0 / n + mean_x**2 / cxx), -1.0)
+        berr = np.where(valid, np.sqrt(1.0 / cxx), -1.0)
+        # cxy**2 <= cxx * cyy, only the rounding can make it negative
+        chi2 = np.where(valid, np.maximum(cyy - b * cxy, 0.0), fit["yy"])
+        scale = np.sqrt(chi2 / (n - 2))
+    fit["p0"] = a
+    fit["p1"] = b
+    fit["p0_error"] = np.where(n > 2, aerr * scale, -1.0)
+    fit["p1_error"] = np.where(n > 2, berr * scale, -1.0)
+    fit["chi2"] = chi2
+
+    _report_fits(fit, valid)
+    return fit
+
+
+def fit_to_dict(fit, doms):
+    """
+    Convert the fit of fit_channels in the result_dict of calculate_p0_p1.
+    ----------------------------------------------
+    Parameters:
+        fit: The dictionary returned by fit_channels.
+        doms: The dom indices (see utils.channel_index) of the OMs, in the order of the result_dict.
+    Returns:
+        result_dict: A dictionary {(string, om, chip, atwd): {"p0": ..., "p1": ..., ...}}.
+    """
+    names = ("p0", "p1", "p0_error", "p1_error", "n", "chi2") + SUM_KEYS[1:]
+    # Python lists are much faster to index than NumPy arrays element by element
+    values = {name: fit[name].reshape(-1, N_CHIPS * N_ATWDS).tolist() for name in names}
+
+    result_dict = {}
+    for dom in doms:
+        for atwd in range(N_ATWDS):
+            for chip in range(N_CHIPS):
+                channel = dom * N_CHIPS * N_ATWDS + chip * N_ATWDS + atwd
+                string, om, _, _ = channel_from_index(channel)
+                result_dict[(string, om, chip, atwd)] = {
+                    name: values[name][dom][chip * N_ATWDS + atwd] for name in names
+                }
+    return result_dict
+
+
 def calculate_p0_p1(slcATW_dict, bad_dom_list=[]):
     """
     Calculate the p0 and p1 values for each OMKey in the slcATW_dict.
@@ -165,35 +377,5 @@ def calculate_p0_p1(slcATW_dict, bad_dom_list=[]):
         Returns:
         result_dict: A dictionary containing the calculated p0 and p1 values, errors, chi-squared values, and other related statistics for each OMKey.
     """
-
-    result_dict = {}
-    for omkey, sums_dict in slcATW_dict.items():
-        string, om = omkey.string, omkey.om
-        for atwd in range(3):
-            for chip in range(2):
-                get_calibration_values(
-                    sums_dict=sums_dict[f"chip{chip}atwd{atwd}"],
-                    string=string,
-                    om=om,
-                    chip=chip,
-                    atwd=atwd,
-                    result_dict=result_dict,
-                )
-
-            # sum the two chips
-            sumsChips_dictc = {}
-            sums_dict0 = sums_dict[f"chip0atwd{atwd}"]
-            sums_dict1 = sums_dict[f"chip1atwd{atwd}"]
-            for key in sums_dict0.keys():
-                sumsChips_dictc[key] = sums_dict0[key] + sums_dict1[key]
-
-            get_calibration_values(
-                sums_dict=sumsChips_dictc,
-                string=string,
-                om=om,
-                chip=2,
-                atwd=atwd,
-                result_dict=result_dict,
-            )
-
-    return result_dict
+    fit = fit_channels(sums_from_dict(slcATW_dict))
+    return fit_to_dict(fit, [omkey_to_dom(omkey) for omkey in slcATW_dict.keys()])
@@ -0,0 +1,317 @@
+"""
+__author__ = Federico Bontempo KIT PhD student <federico.bontempo@kit.edu>
+
+This script contains the functions to write and read the SLC calibration artifact.
+The artifact is the single file which holds the fit results (p0, p1, errors, chi2, n)
+and the crossover points of one calibration. It is written once by readSave_HLC_SLC_charges.py
+and read by write_SLC_Calibration_in_GCD.py without refitting.
+
+The artifact is a compressed npz file with dense arrays indexed by
+[string - 1, om - 61, chip, atwd] (chip 2 is the sum of the two chips):
+    n: (81, 4, 3, 3) int64, the number of charges used in the fit
+    p0, p1, p0_error, p1_error, chi2: (81, 4, 3, 3) float64
+    crossover: (81, 4, 2) float64, the crossover points 0-1 and 1-2 in PE
+    has_fit: (81, 4) bool, the OM has fit results
+    has_crossover: (81, 4) bool, the OM has crossover points
+    metadata: json text with the format name, version, run, year and times
+        (fitCounts is false if n is not the number of charges, e.g. for a Level3 pickle)
+
+Functions:
+    build_calibrationArtifact: Creates the artifact arrays from the result columns.
+    save_calibrationArtifact: Writes the artifact in a npz file.
+    load_calibrationArtifact: Reads and checks the artifact.
+    artifact_to_resultColumns: Converts the artifact back to result columns.
+    load_calibrationSet: Reads any calibration output (artifact, columnar, jsonl, L3 pickle) as an artifact.
+    valid_fits: Returns the channels of an artifact whose fit results can be used.
+"""
+
+import json
+import numpy as np
+
+from utils.channel_index import (
+    CHANNEL_SHAPE,
+    DOM_SHAPE,
+    FIRST_OM,
+    N_ATWDS,
+    N_CHIPS,
+    N_OMS,
+    N_STRINGS,
+)
+
+ARTIFACT_FORMAT = "ITSLCCalibrationArtifact"
+ARTIFACT_VERSION = 1
+
+FIT_ARRAYS = ("p0", "p1", "p0_error", "p1_error", "chi2")
+
+
+def build_calibrationArtifact(resultColumns, runNumb=None, year=0):
+    """
+    Create the calibration artifact from the result columns (see utils.columnar_results).
+    ----------------------------------
+    Parameters:
+        resultColumns: A dictionary of columns with one row per (string, om, chip, atwd).
+        runNumb: Run number of the calibration (default is the run of the columns).
+        year: Year of the calibration.
+    Returns:
+        artifact: A dictionary with the dense arrays and the metadata of the artifact.
+    """
+    if runNumb is None:
+        runNumb = resultColumns["run"][0] if len(resultColumns["run"]) else 0
+    string = resultColumns["string"].astype(np.intp) - 1
+    om = resultColumns["om"].astype(np.intp) - FIRST_OM
+    chip = resultColumns["chip"].astype(np.intp)
+    atwd = resultColumns["atwd"].astype(np.intp)
+    index = (string, om, chip, atwd)
+
+    shape = CHANNEL_SHAPE
+    artifact = {"n": np.zeros(shape, dtype=np.int64)}
+    artifact["n"][index] = resultColumns["n"]
+    for name in FIT_ARRAYS:
+        artifact[name] = np.full(shape, np.nan)
+        artifact[name][index] = resultColumns[name]
+
+    artifact["has_fit"] = np.zeros(DOM_SHAPE, dtype=bool)
+    artifact["has_fit"][string, om] = True
+
+    # The crossover column holds the crossover 0-1 in the ATWD0 rows
+    # and the crossover 1-2 in the ATWD1 rows, -1 if the OM has none
+    artifact["crossover"] = np.full((N_STRINGS, N_OMS, 2), np.nan)
+    artifact["has_crossover"] = np.zeros(DOM_SHAPE, dtype=bool)
+    rows = (chip == 0) & (atwd < 2)
+    crossover = resultColumns["crossover"][rows]
+    artifact["crossover"][string[rows], om[rows], atwd[rows]] = crossover
+    rows0 = rows & (atwd == 0)
+    artifact["has_crossover"][string[rows0], om[rows0]] = (
+        resultColumns["crossover"][rows0] != -1
+    )
+    artifact["crossover"][~artifact["has_crossover"]] = np.nan
+
+    artifact["metadata"] = {
+        "format": ARTIFACT_FORMAT,
+        "version": ARTIFACT_VERSION,
+        "runNumb": int(runNumb),
+        "year": int(year),
+        "startMJD": float(resultColumns["start_mjd"][0]) if len(string) else np.nan,
+        "endMJD": float(resultColumns["end_mjd"][0]) if len(string) else np.nan,
+        "recordingStartTime": resultColumns["recordingStartTime"],
+        "recordingStopTime": resultColumns["recordingStopTime"],
+    }
+    return artifact
+
+
+def save_calibrationArtifact(artifact, fileName):
+    """
+    Save the calibration artifact in a compressed npz file.
+    ----------------------------------
+    Parameters:
+        artifact: The dictionary returned by build_calibrationArtifact.
+        fileName: The name of the output file (.npz).
+    """
+    arrays = {k: v for k, v in artifact.items() if k != "metadata"}
+    np.savez_compressed(
+        fileName, metadata=np.array(json.dumps(artifact["metadata"])), **arrays
+    )
+    return
+
+
+def load_calibrationArtifact(fileName):
+    """
+    Load the calibration artifact and check its format and version.
+    ----------------------------------
+    Parameters:
+        fileName: The name of the artifact file (.npz).
+    Returns:
+        artifact: A dictionary with the dense arrays and the metadata of the artifact.
+    """
+    with np.load(fileName) as f:
+        artifact = {k: f[k] for k in f.files if k != "metadata"}
+        artifact["metadata"] = json.loads(str(f["metadata"]))
+
+    metadata = artifact["metadata"]
+    if metadata.get("format") != ARTIFACT_FORMAT:
+        raise ValueError(f"{fileName} is not a SLC calibration artifact")
+    if metadata.get("version") != ARTIFACT_VERSION:
+        raise ValueError(
+            f"{fileName} has artifact version {metadata.get('version')}, "
+            + f"expected {ARTIFACT_VERSION}"
+        )
+    return artifact
+
+
+def artifact_to_resultColumns(artifact):
+    """
+    Convert the calibration artifact back to result columns (see utils.columnar_results),
+    one row for each (string, om, chip, atwd) of the OMs with fit results.
+    ----------------------------------
+    Parameters:
+        artifact: The calibration artifact.
+    Returns:
+        resultColumns: A dictionary with the column name as key and a NumPy array as value.
+    """
+    string, om = artifact["has_fit"].nonzero()
+    nOMs = len(string)
+    string = np.repeat(string, N_CHIPS * N_ATWDS)
+    om = np.repeat(om, N_CHIPS * N_ATWDS)
+    chip = np.tile(np.repeat(np.arange(N_CHIPS), N_ATWDS), nOMs)
+    atwd = np.tile(np.arange(N_ATWDS), N_CHIPS * nOMs)
+    index = (string, om, chip, atwd)
+
+    resultColumns = {
+        "string": (string + 1).astype(np.int16),
+        "om": (om + FIRST_OM).astype(np.int16),
+        "chip": chip.astype(np.int8),
+        "atwd": atwd.astype(np.int8),
+        "n": artifact["n"][index],
+    }
+    for name in FIT_ARRAYS:
+        resultColumns[name] = artifact[name][index]
+    # The raw sums are not part of the artifact
+    for name in ("sum_x", "sum_xx", "sum_xy", "sum_y", "sum_yy"):
+        resultColumns[name] = np.full(len(string), np.nan)
+
+    crossover = np.full(len(string), -1.0)
+    rows = (atwd < 2) & artifact["has_crossover"][string, om]
+    crossover[rows] = artifact["crossover"][string[rows], om[rows], atwd[rows]]
+    resultColumns["crossover"] = crossover
+
+    metadata = artifact["metadata"]
+    resultColumns["run"] = np.full(len(string), metadata.get("runNumb", 0))
+    resultColumns["start_mjd"] = np.full(len(string), metadata.get("startMJD", np.nan))
+    resultColumns["end_mjd"] = np.full(len(string), metadata.get("endMJD", np.nan))
+    resultColumns["recordingStartTime"] = metadata.get("recordingStartTime", "")
+    resultColumns["recordingStopTime"] = metadata.get("recordingStopTime", "")
+    return resultColumns
+
+
+def _load_jsonlColumns(fileName):
+    """
+    Read a PFMoniWriter jsonl file (see save_jsonl) into result columns.
+    """
+    rows = []
+    with open(fileName, "r") as f:
+        for line in f:
+            if line.strip() == "":
+                continue
+            value = json.loads(line)["value"]
+            rows.append((value, value["result"]))
+
+    resultColumns = {
+        "string": np.array([v["string"] for v, r in rows], dtype=np.int16),
+        "om": np.array([v["om"] for v, r in rows], dtype=np.int16),
+        "chip": np.array([v["chip"] for v, r in rows], dtype=np.int8),
+        "atwd": np.array([v["channel"] for v, r in rows], dtype=np.int8),
+        "run": np.array([v["runNumber"] for v, r in rows], dtype=np.int64),
+        "n": np.array([r["n"] for v, r in rows], dtype=np.int64),
+    }
+    for name in FIT_ARRAYS + ("crossover",):
+        resultColumns[name] = np.array([r[name] for v, r in rows], dtype=np.float64)
+    resultColumns["start_mjd"] = np.full(len(rows), np.nan)
+    resultColumns["end_mjd"] = np.full(len(rows), np.nan)
+    resultColumns["recordingStartTime"] = (
+        rows[0][0]["recordingStartTime"] if rows else ""
+    )
+    resultColumns["recordingStopTime"] = rows[0][0]["recordingStopTime"] if rows else ""
+    return resultColumns
+
+
+def _load_L3Pickle(fileName):
+    """
+    Read a Level3 SLC calibration pickle {(string, om, chip, atwd): (time, intercepts, slopes)}
+    into a calibration artifact. The constants of each channel are averaged over the time entries.
+    The Level3 pickles have only the chips 0 and 1: the missing chip 2 is the average of the two chips
+    (as the Agnostic_I3IceTopSLCCalibrator does for the pulses without chip).
+    """
+    import pickle
+
+    with open(fileName, "rb") as f:
+        slc_calibration = pickle.load(f, encoding="latin-1")
+
+    shape = CHANNEL_SHAPE
+    artifact = {"n": np.zeros(shape, dtype=np.int64)}
+    for name in FIT_ARRAYS:
+        artifact[name] = np.full(shape, np.nan)
+    artifact["has_fit"] = np.zeros(DOM_SHAPE, dtype=bool)
+    artifact["crossover"] = np.full((N_STRINGS, N_OMS, 2), np.nan)
+    artifact["has_crossover"] = np.zeros(DOM_SHAPE, dtype=bool)
+
+    startMJD, endMJD = np.inf, -np.inf
+    for key, (time, intercepts, slopes) in slc_calibration.items():
+        if len(key) != 4:
+            raise ValueError(
+                f"{fileName} is not keyed by (string, om, chip, atwd): {key}"
+            )
+        string, om, chip, atwd = (int(k) for k in key)
+        index = (string - 1, om - FIRST_OM, chip, atwd)
+        artifact["p0"][index] = np.mean(intercepts)
+        artifact["p1"][index] = np.mean(slopes)
+        startMJD = min(startMJD, float(np.min(time)))
+        endMJD = max(endMJD, float(np.max(time)))
+
+    for name in ("p0", "p1"):
+        chip2 = artifact[name][:, :, 2]
+        missing = np.isnan(chip2)
+        chip2[missing] = artifact[name][:, :, :2].mean(axis=2)[missing]
+
+    # The pickle has no number of charges (n stays 0), an OM has a fit only if all its channels are there
+    artifact["has_fit"] = np.isfinite(artifact["p0"]).all(axis=(-2, -1))
+    artifact["metadata"] = {
+        "format": ARTIFACT_FORMAT,
+        "version": ARTIFACT_VERSION,
+        "runNumb": 0,
+        "year": 0,
+        "startMJD": startMJD if np.isfinite(startMJD) else np.nan,
+        "endMJD": endMJD if np.isfinite(endMJD) else np.nan,
+        "recordingStartTime": "",
+        "recordingStopTime": "",
+        "fitCounts": False,
+    }
+    return artifact
+
+
+def load_calibrationSet(fileName):
+    """
+    Load any calibration output of this package as a calibration artifact:
+    the artifact itself, the columnar results (.npz, .parquet, .hdf5),
+    the PFMoniWriter jsonl or a Level3 pickle (.pkl, .pcl).
+    ----------------------------------
+    Parameters:
+        fileName: The name of the calibration file.
+    Returns:
+        artifact: A dictionary with the dense arrays and the metadata of the artifact.
+    """
+    from utils.columnar_results import load_columnar
+
+    if fileName.endswith(".npz"):
+        with np.load(fileName) as f:
+            isArtifact = "has_fit" in f.files
+        if isArtifact:
+            return load_calibrationArtifact(fileName)
+        return build_calibrationArtifact(load_columnar(fileName))
+    if fileName.endswith((".parquet", ".hdf5", ".h5")):
+        return build_calibrationArtifact(load_columnar(fileName))
+    if fileName.endswith(".jsonl"):
+        return build_calibrationArtifact(_load_jsonlColumns(fileName))
+    if fileName.endswith((".pkl", ".pcl")):
+        return _load_L3Pickle(fileName)
+    raise ValueError(f"Unknown calibration file extension {fileName}")
+
+
+def valid_fits(artifact, minN=0):
+    """
+    Return the channels of a calibration artifact whose fit results can be used.
+    ----------------------------------
+    Parameters:
+        artifact: A calibration artifact.
+        minN: The fits with n <= minN are not valid, unless the artifact has no
+            number of charges (metadata fitCounts false, e.g. a Level3 pickle).
+    Returns:
+        valid: (81, 4, 3, 3) bool, the OM has a fit and p0 and p1 are finite.
+    """
+    valid = (
+        artifact["has_fit"][..., np.newaxis, np.newaxis]
+        & np.isfinite(artifact["p0"])
+        & np.isfinite(artifact["p1"])
+    )
+    if artifact["metadata"].get("fitCounts", True):
+        valid &= artifact["n"] > minN
+    return valid
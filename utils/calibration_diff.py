@@ -0,0 +1,230 @@
+"""
+__author__ = Federico Bontempo KIT PhD student <federico.bontempo@kit.edu>
+
+This script contains the comparison of two SLC calibration sets (e.g. a new calibration and the one
+of the previous year) loaded as calibration artifacts (see utils.calibration_artifact.load_calibrationSet),
+so any output of readSave_HLC_SLC_charges.py, write_fake_SLC_calibration.py or
+write_extrapolated_SLC_calibration.py can be compared with any other.
+
+The artifacts are dense arrays indexed by [string - 1, om - 61, chip, atwd], so the two sets are
+aligned on the channel index by construction and all the deltas and pulls are computed
+for all the channels at once:
+    delta = candidate - reference
+    pull = delta / sqrt(error_reference**2 + error_candidate**2)   (nan without errors, e.g. Level3 pickles)
+A channel is an outlier if |pull| > maxPull, |delta p1| / p1 > maxRelP1 or |delta p0| > maxDeltaP0,
+a crossover point if |delta| / crossover > maxRelCrossover. The fits and crossover points
+which are only in one of the sets (appeared or disappeared, e.g. a crossover which went nan) are flagged too.
+
+Functions:
+    diff_calibrationSets: Computes the per-channel deltas, pulls and flags.
+    summarize_diff: Returns the compact report of a diff.
+    save_diffReport: Saves the report in a json file.
+"""
+
+import json
+import numpy as np
+
+from utils.calibration_artifact import valid_fits
+from utils.channel_index import FIRST_OM
+
+# Default outlier thresholds
+DIFF_THRESHOLDS = {
+    "maxPull": 5.0,
+    "maxRelP1": 0.05,
+    "maxDeltaP0": np.inf,
+    "maxRelCrossover": 0.1,
+}
+
+
+def diff_calibrationSets(reference, candidate, thresholds=None):
+    """
+    Compare two calibration artifacts channel by channel.
+    ----------------------------------
+    Parameters:
+        reference: The reference calibration artifact (e.g. the previous year).
+        candidate: The calibration artifact to check.
+        thresholds: A dictionary with the outlier thresholds (see DIFF_THRESHOLDS), the missing ones have the default value.
+    Returns:
+        diff: A dictionary of arrays indexed by [string - 1, om - 61, chip, atwd]
+            ([string - 1, om - 61, crossover] for the crossover points):
+            compared: both sets have a valid fit of the channel
+            fit_appeared, fit_disappeared: only the candidate (reference) has a valid fit
+            delta_p0, delta_p1, rel_p1, pull_p0, pull_p1: nan if not compared
+            outlier_pull, outlier_p1, outlier_p0, outlier: the outlier flags of the compared channels
+            crossover_compared, crossover_appeared, crossover_disappeared, delta_crossover,
+            rel_crossover, outlier_crossover: the same for the (81, 4, 2) crossover points
+            and thresholds: the thresholds which were used.
+    """
+    thresholds = {**DIFF_THRESHOLDS, **(thresholds or {})}
+
+    validRef = valid_fits(reference)
+    validCand = valid_fits(candidate)
+    compared = validRef & validCand
+
+    diff = {
+        "compared": compared,
+        "fit_appeared": validCand & ~validRef,
+        "fit_disappeared": validRef & ~validCand,
+    }
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for name in ("p0", "p1"):
+            delta = np.where(compared, candidate[name] - reference[name], np.nan)
+            sigma = np.hypot(reference[f"{name}_error"], candidate[f"{name}_error"])
+            diff[f"delta_{name}"] = delta
+            diff[f"pull_{name}"] = np.where(sigma > 0, delta / sigma, np.nan)
+        diff["rel_p1"] = diff["delta_p1"] / np.abs(reference["p1"])
+
+        # The comparisons with nan (no errors, not compared) are False
+        diff["outlier_pull"] = (np.abs(diff["pull_p0"]) > thresholds["maxPull"]) | (
+            np.abs(diff["pull_p1"]) > thresholds["maxPull"]
+        )
+        diff["outlier_p1"] = np.abs(diff["rel_p1"]) > thresholds["maxRelP1"]
+        diff["outlier_p0"] = np.abs(diff["delta_p0"]) > thresholds["maxDeltaP0"]
+        diff["outlier"] = diff["outlier_pull"] | diff["outlier_p1"] | diff["outlier_p0"]
+
+        crossRef = reference["has_crossover"][..., np.newaxis] & np.isfinite(
+            reference["crossover"]
+        )
+        crossCand = candidate["has_crossover"][..., np.newaxis] & np.isfinite(
+            candidate["crossover"]
+        )
+        crossCompared = crossRef & crossCand
+        diff["crossover_compared"] = crossCompared
+        diff["crossover_appeared"] = crossCand & ~crossRef
+        diff["crossover_disappeared"] = crossRef & ~crossCand
+        diff["delta_crossover"] = np.where(
+            crossCompared, candidate["crossover"] - reference["crossover"], np.nan
+        )
+        diff["rel_crossover"] = diff["delta_crossover"] / np.abs(reference["crossover"])
+        diff["outlier_crossover"] = (
+            np.abs(diff["rel_crossover"]) > thresholds["maxRelCrossover"]
+        )
+    diff["thresholds"] = thresholds
+    return diff
+
+
+def _flagged_list(mask, columns, maxListed):
+    """
+    Return the (string, om, ...) indices and the values of columns of the first maxListed flagged entries,
+    ordered by the absolute value of the first column (largest first).
+    """
+    index = np.nonzero(mask)
+    order = np.arange(len(index[0]))
+    if columns:
+        first = np.abs(next(iter(columns.values()))[index])
+        order = np.argsort(-np.nan_to_num(first, nan=-1.0), kind="stable")
+    order = order[:maxListed]
+
+    entries = []
+    for i in order:
+        entry = {"string": int(index[0][i]) + 1, "om": int(index[1][i]) + FIRST_OM}
+        if len(index) == 4:
+            entry["chip"] = int(index[2][i])
+            entry["atwd"] = int(index[3][i])
+        else:
+            entry["crossover"] = ("0-1", "1-2")[int(index[2][i])]
+        for name, values in columns.items():
+            value = float(values[tuple(axis[i] for axis in index)])
+            entry[name] = value if np.isfinite(value) else None
+        entries.append(entry)
+    return entries
+
+
+def _stats(values):
+    """Return the median, maximum absolute value and number of the finite values"""
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return {"n": 0, "median": None, "max_abs": None}
+    return {
+        "n": int(len(values)),
+        "median": float(np.median(values)),
+        "max_abs": float(np.max(np.abs(values))),
+    }
+
+
+def summarize_diff(diff, reference=None, candidate=None, maxListed=20):
+    """
+    Return the compact report of a diff: the number of compared, appeared, disappeared and outlier
+    channels and crossover points, the statistics of the deltas and pulls and the list
+    of the largest outliers (at most maxListed of each kind).
+    ----------------------------------
+    Parameters:
+        diff: The dictionary returned by diff_calibrationSets.
+        reference, candidate: The artifacts (their metadata is added to the report).
+        maxListed: The maximum number of listed channels of each kind.
+    Returns:
+        report: A dictionary which can be saved as json.
+    """
+    report = {}
+    for name, artifact in (("reference", reference), ("candidate", candidate)):
+        if artifact is not None:
+            metadata = artifact["metadata"]
+            report[name] = {
+                key: metadata.get(key)
+                for key in ("runNumb", "year", "startMJD", "endMJD")
+            }
+    report["thresholds"] = {
+        key: (float(value) if np.isfinite(value) else None)
+        for key, value in diff["thresholds"].items()
+    }
+
+    counts = {}
+    for name in (
+        "compared",
+        "fit_appeared",
+        "fit_disappeared",
+        "outlier",
+        "outlier_pull",
+        "outlier_p1",
+        "outlier_p0",
+        "crossover_compared",
+        "crossover_appeared",
+        "crossover_disappeared",
+        "outlier_crossover",
+    ):
+        counts[name] = int(np.count_nonzero(diff[name]))
+    report["counts"] = counts
+    report["stats"] = {
+        name: _stats(diff[name])
+        for name in (
+            "delta_p0",
+            "delta_p1",
+            "rel_p1",
+            "pull_p0",
+            "pull_p1",
+            "rel_crossover",
+        )
+    }
+
+    report["outliers"] = _flagged_list(
+        diff["outlier"],
+        {
+            "rel_p1": diff["rel_p1"],
+            "delta_p0": diff["delta_p0"],
+            "pull_p0": diff["pull_p0"],
+            "pull_p1": diff["pull_p1"],
+        },
+        maxListed,
+    )
+    report["crossover_outliers"] = _flagged_list(
+        diff["outlier_crossover"],
+        {"rel_crossover": diff["rel_crossover"]},
+        maxListed,
+    )
+    for name in (
+        "fit_appeared",
+        "fit_disappeared",
+        "crossover_appeared",
+        "crossover_disappeared",
+    ):
+        report[name] = _flagged_list(diff[name], {}, maxListed)
+    return report
+
+
+def save_diffReport(report, fileName):
+    """
+    Save the report of summarize_diff in a json file.
+    """
+    with open(fileName, "w") as f:
+        json.dump(report, f, indent=1)
+    return
@@ -0,0 +1,327 @@
+"""
+__author__ = Federico Bontempo KIT PhD student <federico.bontempo@kit.edu>
+
+This script contains the history store of the SLC calibrations: the results of many runs
+(jsonl, Level3 pickles, artifacts or columnar files, see utils.calibration_artifact.load_calibrationSet)
+in one directory, so that e.g. the p0, p1 and crossover of a DOM across all the runs of 2012-2022
+are read with one query instead of parsing every file.
+
+The store is append-only and columnar. Each run is a block of 2916 rows, one for each channel index
+(see utils.channel_index), so the channel index of a row is its position in the block
+and the channels without results are nan (n = 0). Each column is a raw binary file
+of blocks which is only appended to and read with np.memmap:
+    <directory>/index.json: the format, version, columns and the run table
+        (run, year, start and end MJD, block and source file of each run)
+    <directory>/<column>.bin: (nBlocks, 2916) values of the column
+The primary index is the run table sorted by run (np.searchsorted for the run ranges).
+The columns are written before the index, which is replaced atomically, so an interrupted
+ingest leaves the store as it was (the extra blocks are dropped by the next ingest).
+
+Functions:
+    channels_of: Returns the channel indices of OMKeys, (string, om) or (string, om, chip, atwd) keys.
+    run_fromFileName: Returns the run number and year in a calibration file name.
+Classes:
+    CalibrationHistory: The history store with the ingest and query methods.
+"""
+
+import json
+import os
+import re
+import numpy as np
+
+from utils.channel_index import (
+    CHANNEL_SHAPE,
+    N_ATWDS,
+    N_CHANNELS,
+    N_CHIPS,
+    channel_index,
+    omkey_to_dom,
+)
+
+HISTORY_FORMAT = "ITSLCCalibrationHistory"
+HISTORY_VERSION = 1
+
+# Name and dtype of each column of the store
+HISTORY_COLUMNS = (
+    ("n", np.int64),
+    ("p0", np.float64),
+    ("p1", np.float64),
+    ("p0_error", np.float64),
+    ("p1_error", np.float64),
+    ("chi2", np.float64),
+    ("crossover", np.float64),
+)
+
+# Columns of the run table (index.json)
+_RUN_KEYS = ("run", "year", "start_mjd", "end_mjd", "block", "source")
+
+
+def channels_of(keys):
+    """
+    Return the channel indices (see utils.channel_index) of a list of keys:
+    channel indices, OMKeys or (string, om) tuples (the 9 channels of the DOM)
+    or (string, om, chip, atwd) tuples. None returns all the channels.
+    """
+    if keys is None:
+        return np.arange(N_CHANNELS)
+    channels = []
+    for key in keys:
+        if isinstance(key, (int, np.integer)):
+            channels.append(int(key))
+        elif not hasattr(key, "string") and len(key) == 4:
+            channels.append(channel_index(*(int(k) for k in key)))
+        else:
+            dom = omkey_to_dom(key)
+            nChannels = N_CHIPS * N_ATWDS
+            channels.extend(range(dom * nChannels, (dom + 1) * nChannels))
+    channels = np.asarray(channels, dtype=np.intp)
+    if np.any((channels < 0) | (channels >= N_CHANNELS)):
+        raise ValueError(f"Channel indices out of range in {keys}")
+    return channels
+
+
+def run_fromFileName(fileName):
+    """
+    Return the run number and year of a file named Run{runNumb}_{year}... (0 if not found).
+    """
+    match = re.search(r"Run(\d+)(?:_(\d{4}))?", os.path.basename(fileName))
+    if match is None:
+        return 0, 0
+    return int(match.group(1)), int(match.group(2) or 0)
+
+
+def _artifact_block(artifact):
+    """
+    Return the columns of one run (a (2916,) array for each column) from a calibration artifact.
+    The crossover of a channel is the crossover 0-1 for ATWD0 and 1-2 for ATWD1, nan for ATWD2.
+    """
+    block = {"n": artifact["n"].reshape(N_CHANNELS).astype(np.int64)}
+    for name in ("p0", "p1", "p0_error", "p1_error", "chi2"):
+        block[name] = artifact[name].reshape(N_CHANNELS).astype(np.float64)
+
+    crossover = np.full(CHANNEL_SHAPE, np.nan)
+    cops = np.where(
+        artifact["has_crossover"][..., np.newaxis], artifact["crossover"], np.nan
+    )
+    crossover[..., :2] = cops[:, :, np.newaxis, :]
+    block["crossover"] = crossover.reshape(N_CHANNELS)
+    return block
+
+
+class CalibrationHistory:
+    """
+    The append-only history store of the SLC calibrations in a directory (created if needed).
+    ingest adds the calibration files of new runs, query returns the columns of a set of channels
+    for a run or time range as (nRuns, nChannels) arrays.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        indexFile = os.path.join(directory, "index.json")
+        if os.path.exists(indexFile):
+            with open(indexFile, "r") as f:
+                index = json.load(f)
+            if index.get("format") != HISTORY_FORMAT:
+                raise ValueError(f"{directory} is not a SLC calibration history store")
+            if index.get("version") != HISTORY_VERSION:
+                raise ValueError(
+                    f"{directory} has history version {index.get('version')}, "
+                    + f"expected {HISTORY_VERSION}"
+                )
+            runTable = index["runs"]
+        else:
+            runTable = {key: [] for key in _RUN_KEYS}
+        self._set_runTable(runTable)
+
+    def _set_runTable(self, runTable):
+        """Set the run table and its primary index (the order of the runs)"""
+        self.runTable = runTable
+        run = np.asarray(runTable["run"], dtype=np.int64)
+        order = np.argsort(run, kind="stable")
+        self.runs = run[order]
+        self._years = np.asarray(runTable["year"], dtype=np.int64)[order]
+        self._startMJD = np.asarray(runTable["start_mjd"], dtype=np.float64)[order]
+        self._endMJD = np.asarray(runTable["end_mjd"], dtype=np.float64)[order]
+        self._blocks = np.asarray(runTable["block"], dtype=np.intp)[order]
+        self._columns = {}
+        return
+
+    def __len__(self):
+        return len(self.runs)
+
+    def __contains__(self, runNumb):
+        i = np.searchsorted(self.runs, runNumb)
+        return i < len(self.runs) and self.runs[i] == runNumb
+
+    def _columnFile(self, name):
+        return os.path.join(self.directory, f"{name}.bin")
+
+    def column(self, name):
+        """Return the (nBlocks, 2916) memory-mapped column name (in block order)"""
+        if name not in self._columns:
+            dtype = np.dtype(dict(HISTORY_COLUMNS)[name])
+            nBlocks = len(self.runs)
+            if nBlocks == 0:
+                self._columns[name] = np.empty((0, N_CHANNELS), dtype=dtype)
+            else:
+                self._columns[name] = np.memmap(
+                    self._columnFile(name),
+                    dtype=dtype,
+                    mode="r",
+                    shape=(nBlocks, N_CHANNELS),
+                )
+        return self._columns[name]
+
+    def append(self, artifacts, sources=None):
+        """
+        Append the calibration artifacts of new runs (one block per artifact),
+        with one write per column. The runs which are already in the store are skipped.
+        ----------------------------------
+        Parameters:
+            artifacts: A list of calibration artifacts (see utils.calibration_artifact)
+                with their run number (and year) in the metadata.
+            sources: The file name of each artifact, kept in the run table.
+        Returns:
+            added: The run numbers which were added.
+        """
+        sources = sources if sources is not None else [""] * len(artifacts)
+        nBlocks = len(self.runs)
+        seen = set(self.runs.tolist())
+        runTable = {key: list(values) for key, values in self.runTable.items()}
+        blocks = []
+        added = []
+        skipped = []
+        for artifact, source in zip(artifacts, sources):
+            metadata = artifact["metadata"]
+            runNumb = int(metadata.get("runNumb", 0))
+            if runNumb in seen:
+                skipped.append(runNumb)
+                continue
+            seen.add(runNumb)
+            for key, value in (
+                ("run", runNumb),
+                ("year", int(metadata.get("year", 0))),
+                ("start_mjd", float(metadata.get("startMJD", np.nan))),
+                ("end_mjd", float(metadata.get("endMJD", np.nan))),
+                ("block", nBlocks + len(blocks)),
+                ("source", source),
+            ):
+                runTable[key].append(value)
+            blocks.append(_artifact_block(artifact))
+            added.append(runNumb)
+        if skipped:
+            print(f"{len(skipped)} runs are already in the history and were skipped")
+        if not blocks:
+            return added
+
+        # Release the memory maps before writing
+        self._columns = {}
+        for name, dtype in HISTORY_COLUMNS:
+            itemsize = np.dtype(dtype).itemsize
+            with open(self._columnFile(name), "ab") as f:
+                # Drop the blocks of an interrupted ingest
+                f.truncate(nBlocks * N_CHANNELS * itemsize)
+                f.write(
+                    np.stack([block[name] for block in blocks]).astype(dtype).tobytes()
+                )
+
+        index = {
+            "format": HISTORY_FORMAT,
+            "version": HISTORY_VERSION,
+            "columns": [[name, np.dtype(dtype).str] for name, dtype in HISTORY_COLUMNS],
+            "runs": runTable,
+        }
+        indexFile = os.path.join(self.directory, "index.json")
+        tmpName = f"{indexFile}.tmp{os.getpid()}"
+        with open(tmpName, "w") as f:
+            json.dump(index, f)
+        os.replace(tmpName, indexFile)
+        self._set_runTable(runTable)
+        return added
+
+    def ingest(self, fileNames):
+        """
+        Load the calibration files (jsonl, Level3 pickles, artifacts or columnar files) and append them.
+        The run number and year which are not in the file are taken from its name (Run{runNumb}_{year}...).
+        ----------------------------------
+        Returns:
+            added: The run numbers which were added.
+        """
+        from utils.calibration_artifact import load_calibrationSet
+
+        artifacts = []
+        sources = []
+        nSkipped = 0
+        for fileName in fileNames:
+            runNumb, year = run_fromFileName(fileName)
+            # Do not read the files of the runs which are already in the store
+            if runNumb != 0 and runNumb in self:
+                nSkipped += 1
+                continue
+            artifact = load_calibrationSet(fileName)
+            metadata = artifact["metadata"]
+            if int(metadata.get("runNumb", 0)) == 0:
+                if runNumb == 0:
+                    raise ValueError(f"No run number in {fileName}")
+                metadata["runNumb"] = runNumb
+            if int(metadata.get("year", 0)) == 0:
+                metadata["year"] = year
+            artifacts.append(artifact)
+            sources.append(os.path.abspath(fileName))
+        if nSkipped:
+            print(f"{nSkipped} files of runs already in the history were not read")
+        return self.append(artifacts, sources=sources)
+
+    def select_runs(self, runRange=None, mjdRange=None, years=None):
+        """
+        Return the positions (in run order) of the runs in runRange (first, last) (inclusive),
+        of the runs whose time range overlaps mjdRange (first, last) and of the years.
+        """
+        first, last = 0, len(self.runs)
+        if runRange is not None:
+            first = np.searchsorted(self.runs, runRange[0], side="left")
+            last = np.searchsorted(self.runs, runRange[1], side="right")
+        selected = np.arange(first, last)
+        if mjdRange is not None:
+            overlap = (self._endMJD[selected] >= mjdRange[0]) & (
+                self._startMJD[selected] <= mjdRange[1]
+            )
+            selected = selected[overlap]
+        if years is not None:
+            selected = selected[np.isin(self._years[selected], years)]
+        return selected
+
+    def query(
+        self, channels=None, runRange=None, mjdRange=None, years=None, columns=None
+    ):
+        """
+        Return the history of a set of channels.
+        ----------------------------------
+        Parameters:
+            channels: The channels (see channels_of), e.g. [(39, 61)] for the 9 channels of the DOM (39, 61).
+            runRange: The (first, last) run numbers (inclusive), default all the runs.
+            mjdRange: The (first, last) MJD which the time range of the runs overlaps.
+            years: The years of the runs.
+            columns: The names of the columns (default all, see HISTORY_COLUMNS).
+        Returns:
+            history: A dictionary with run, year, start_mjd and end_mjd (nRuns,) in run order,
+                channel (nChannels,) and each column as a (nRuns, nChannels) array.
+        """
+        channels = channels_of(channels)
+        selected = self.select_runs(runRange, mjdRange, years)
+        columns = columns if columns is not None else [n for n, _ in HISTORY_COLUMNS]
+
+        history = {
+            "run": self.runs[selected],
+            "year": self._years[selected],
+            "start_mjd": self._startMJD[selected],
+            "end_mjd": self._endMJD[selected],
+            "channel": channels,
+        }
+        blocks = self._blocks[selected]
+        for name in columns:
+            history[name] = np.asarray(
+                self.column(name)[blocks[:, np.newaxis], channels[np.newaxis, :]]
+            )
+        return history
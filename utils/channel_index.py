@@ -0,0 +1,109 @@
+"""
+__author__ = Federico Bontempo KIT PhD student <federico.bontempo@kit.edu>
+
+This script contains the integer indexing of the IceTop DOMs and channels,
+so that the calibration data can be kept in dense NumPy arrays instead of dictionaries
+keyed by OMKeys or by strings.
+
+The indices follow the C order of the dense (81, 4) and (81, 4, 3, 3) arrays
+[string - 1, om - 61, chip, atwd] (chip 2 is the sum of the two chips):
+    dom = (string - 1) * 4 + (om - 61)                                  0 <= dom < 324
+    channel = dom * 9 + chip * 3 + atwd                                 0 <= channel < 2916
+    segment = dom * 3 + atwd (the charges of both chips of an ATWD)     0 <= segment < 972
+so array.reshape(-1)[channel] is array[string - 1, om - 61, chip, atwd].
+
+All the functions work with scalars and with NumPy arrays.
+
+Functions:
+    omkey_to_tuple: OMKey, (string, om) tuple or "string,om" string -> (string, om).
+    dom_index: (string, om) -> dom.
+    dom_from_index: dom -> (string, om).
+    channel_index: (string, om, chip, atwd) -> channel.
+    channel_from_index: channel -> (string, om, chip, atwd).
+    omkey_to_dom: OMKey, (string, om) tuple or "string,om" string -> dom.
+    is_icetop_dom: True for the IceTop DOMs (om 61 to 64).
+    bad_dom_mask: The (324,) boolean mask of a list of bad DOMs.
+"""
+
+import numpy as np
+
+N_STRINGS = 81
+N_OMS = 4
+FIRST_OM = 61
+N_CHIPS = 3
+N_ATWDS = 3
+
+N_DOMS = N_STRINGS * N_OMS
+N_CHANNELS = N_DOMS * N_CHIPS * N_ATWDS
+N_SEGMENTS = N_DOMS * N_ATWDS
+DOM_SHAPE = (N_STRINGS, N_OMS)
+CHANNEL_SHAPE = (N_STRINGS, N_OMS, N_CHIPS, N_ATWDS)
+
+
+def omkey_to_tuple(omkey):
+    """
+    Return the (string, om) tuple of an icetray.OMKey, a tuple or a "string,om" string.
+    """
+    if hasattr(omkey, "string"):
+        return (int(omkey.string), int(omkey.om))
+    if isinstance(omkey, str):
+        string, om = omkey.replace("OMKey", "").strip("()").split(",")[:2]
+        return (int(string), int(om))
+    return (int(omkey[0]), int(omkey[1]))
+
+
+def dom_index(string, om):
+    """Return the dom index of (string, om)"""
+    return (string - 1) * N_OMS + (om - FIRST_OM)
+
+
+def dom_from_index(dom):
+    """Return the (string, om) of a dom index"""
+    string, om = divmod(dom, N_OMS)
+    return string + 1, om + FIRST_OM
+
+
+def channel_index(string, om, chip, atwd):
+    """Return the channel index of (string, om, chip, atwd)"""
+    return (dom_index(string, om) * N_CHIPS + chip) * N_ATWDS + atwd
+
+
+def channel_from_index(channel):
+    """Return the (string, om, chip, atwd) of a channel index"""
+    dom, chipATWD = divmod(channel, N_CHIPS * N_ATWDS)
+    chip, atwd = divmod(chipATWD, N_ATWDS)
+    string, om = dom_from_index(dom)
+    return string, om, chip, atwd
+
+
+def omkey_to_dom(omkey):
+    """Return the dom index of an OMKey, a (string, om) tuple or a "string,om" string"""
+    return dom_index(*omkey_to_tuple(omkey))
+
+
+def is_icetop_dom(string, om):
+    """Return True for the IceTop DOMs (om 61 to 64 of the strings 1 to 81)"""
+    return (
+        (string >= 1)
+        & (string <= N_STRINGS)
+        & (om >= FIRST_OM)
+        & (om < FIRST_OM + N_OMS)
+    )
+
+
+def bad_dom_mask(bad_dom_list):
+    """
+    Return the (324,) boolean mask of the bad DOMs, the in-ice DOMs of the list are ignored.
+    ----------------------------------
+    Parameters:
+        bad_dom_list: A list of OMKeys, (string, om) tuples or "string,om" strings.
+    Returns:
+        mask: A boolean array, mask[dom] is True for the bad DOMs.
+    """
+    mask = np.zeros(N_DOMS, dtype=bool)
+    if len(bad_dom_list) == 0:
+        return mask
+    string, om = np.array([omkey_to_tuple(omkey) for omkey in bad_dom_list]).T
+    icetop = is_icetop_dom(string, om)
+    mask[dom_index(string[icetop], om[icetop])] = True
+    return mask
@@ -0,0 +1,148 @@
+"""
+__author__ = Federico Bontempo KIT PhD student <federico.bontempo@kit.edu>
+
+This script contains the 2D histograms of log10(SLC) vs log10(HLC) charges (in PE) of each
+(string, om, chip, atwd) channel, to check the linear relation fitted by calculate_p0_p1
+(residuals and linearity) without keeping the charges of every hit.
+
+The histograms have a fixed binning, so they are filled in batches (e.g. the hits of a file)
+with one np.bincount over the flat bin indices (the same counts as np.histogram2d per channel,
+the upper edge is in the last bin),
+they can be merged across files and workers (merge_chargeHistograms) and their memory
+is O(bins) whatever the number of hits.
+Only the chips 0 and 1 are filled, the histograms of chip 2 are their sum.
+
+The histograms are a dictionary:
+    counts: (81, 4, 2, 3, nBins, nBins) uint32 indexed by [string - 1, om - 61, chip, atwd, slc bin, hlc bin]
+    edges: (nBins + 1,) the bin edges of log10(charge / PE), the same for SLC and HLC
+    zeros: (81, 4, 2, 3) the number of hits with a zero SLC or HLC charge
+    outside: (81, 4, 2, 3) the number of hits outside of the edges
+
+Functions:
+    create_chargeHistograms: Creates the empty histograms.
+    update_chargeHistograms: Adds a batch of hits.
+    merge_chargeHistograms: Adds the histograms of other files or workers.
+    hlc_profile: The mean log10(HLC) in each SLC bin (the linearity check).
+    save_chargeHistograms: Saves the histograms in a compressed npz file.
+    load_chargeHistograms: Loads the histograms saved by save_chargeHistograms.
+"""
+
+import numpy as np
+
+from utils.channel_index import DOM_SHAPE, N_ATWDS, N_CHIPS
+from utils.charge_store import charges_to_pe
+
+# Range of log10(charge / PE) of the histograms
+LOG_CHARGE_RANGE = (-1.0, 6.0)
+# The chips 0 and 1 are filled
+N_FILLED_CHIPS = 2
+
+
+def create_chargeHistograms(nBins=35, logRange=LOG_CHARGE_RANGE):
+    """
+    Create the empty 2D histograms of all the channels with nBins x nBins bins in logRange.
+    """
+    channelShape = DOM_SHAPE + (N_FILLED_CHIPS, N_ATWDS)
+    return {
+        "counts": np.zeros(channelShape + (nBins, nBins), dtype=np.uint32),
+        "edges": np.linspace(logRange[0], logRange[1], nBins + 1),
+        "zeros": np.zeros(channelShape, dtype=np.int64),
+        "outside": np.zeros(channelShape, dtype=np.int64),
+    }
+
+
+def _bin_index(logCharge, edges):
+    """
+    Return the bin of each log10(charge) as np.histogram2d: a value on an edge is in the bin above it,
+    except the upper edge which is in the last bin. The values outside of the edges (or nan) have
+    the bins -1 or nBins.
+    """
+    nBins = len(edges) - 1
+    index = np.searchsorted(edges, logCharge, side="right") - 1
+    index[logCharge == edges[-1]] = nBins - 1
+    return index
+
+
+def update_chargeHistograms(chargeHistograms, channel, slc, hlc):
+    """
+    Add a batch of hits to the histograms (in place).
+    ----------------------------------
+    Parameters:
+        chargeHistograms: The histograms (see create_chargeHistograms).
+        channel: The channel index of each hit (see utils.channel_index), chip 0 or 1.
+        slc: The slc charges (integers in dpe or floats in PE, see utils.charge_store.charges_to_pe).
+        hlc: The hlc charges.
+    """
+    if len(channel) == 0:
+        return
+    edges = chargeHistograms["edges"]
+    nBins = len(edges) - 1
+
+    # The channels of chips 0 and 1 are the first 6 of the 9 channels of each DOM
+    dom, chipATWD = np.divmod(channel, N_CHIPS * N_ATWDS)
+    histChannel = dom * N_FILLED_CHIPS * N_ATWDS + chipATWD
+
+    slcPE = charges_to_pe(slc)
+    hlcPE = charges_to_pe(hlc)
+    positive = (slcPE > 0) & (hlcPE > 0)
+    np.add.at(chargeHistograms["zeros"].reshape(-1), histChannel[~positive], 1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slcBin = _bin_index(np.log10(slcPE), edges)
+        hlcBin = _bin_index(np.log10(hlcPE), edges)
+    inside = (slcBin >= 0) & (slcBin < nBins) & (hlcBin >= 0) & (hlcBin < nBins)
+    np.add.at(
+        chargeHistograms["outside"].reshape(-1), histChannel[positive & ~inside], 1
+    )
+
+    flatBin = (histChannel[inside] * nBins + slcBin[inside]) * nBins + hlcBin[inside]
+    counts = chargeHistograms["counts"].reshape(-1)
+    counts += np.bincount(flatBin, minlength=counts.size).astype(np.uint32)
+    return
+
+
+def merge_chargeHistograms(chargeHistograms, other):
+    """
+    Add the histograms other (of other files or workers, with the same edges) to chargeHistograms (in place).
+    """
+    if not np.array_equal(chargeHistograms["edges"], other["edges"]):
+        raise ValueError("The charge histograms have different edges")
+    for key in ("counts", "zeros", "outside"):
+        chargeHistograms[key] += other[key]
+    return chargeHistograms
+
+
+def hlc_profile(chargeHistograms):
+    """
+    Return the mean log10(HLC) (at the bin centers) and the number of hits in each SLC bin of each channel,
+    with chip 2 the sum of the chips 0 and 1. A linear HLC = p1 * SLC gives a slope 1 profile.
+    ----------------------------------
+    Returns:
+        centers: (nBins,) the bin centers of log10(charge / PE).
+        mean: (81, 4, 3, 3, nBins) the mean log10(HLC), nan in the empty bins.
+        n: (81, 4, 3, 3, nBins) the number of hits.
+    """
+    edges = chargeHistograms["edges"]
+    centers = (edges[1:] + edges[:-1]) / 2
+    counts = chargeHistograms["counts"].astype(np.int64)
+    counts = np.concatenate((counts, counts.sum(axis=2, keepdims=True)), axis=2)
+    n = counts.sum(axis=-1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = (counts * centers).sum(axis=-1) / n
+    return centers, mean, n
+
+
+def save_chargeHistograms(chargeHistograms, fileName):
+    """
+    Save the histograms in a compressed npz file (most of the bins are empty).
+    """
+    np.savez_compressed(fileName, **chargeHistograms)
+    return
+
+
+def load_chargeHistograms(fileName):
+    """
+    Load the histograms saved by save_chargeHistograms.
+    """
+    with np.load(fileName) as f:
+        return {key: f[key] for key in ("counts", "edges", "zeros", "outside")}
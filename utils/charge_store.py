@@ -0,0 +1,349 @@
+"""
+__author__ = Federico Bontempo KIT PhD student <federico.bontempo@kit.edu>
+
+This script contains the functions to persist the raw SLC and HLC charges of a run,
+so that the crossover points can be calculated again without reading the I3 files.
+
+The charges are kept as ITSLCCalItem delivers them, integers in deci-photoelectrons (dpe),
+in the smallest integer type which holds them (see ChargeBuffer). They are converted to PE
+(charges_to_pe) only where they are used, e.g. in the crossover points.
+Floating point charges (the stores of version 1 and the old pickle files) are in PE.
+
+The store is a directory with:
+    charges.npy (or charges.npz if compressed): A (2, N) array with the slc (row 0) and hlc (row 1) charges.
+        The charges of each (string, om, atwd) channel are one contiguous segment.
+    keys.npy: A (n_channels, 3) array with the (string, om, atwd) of each segment.
+    offsets.npy: A (n_channels + 1,) array, the segment i is charges[:, offsets[i]:offsets[i+1]].
+    meta.json: Run number, year, start and end time of the calibration.
+
+The uncompressed store is memory-mapped when loaded, so only the segments which are used are read.
+The compressed store is smaller on disk but has to be decompressed in memory when loaded.
+
+Functions:
+    smallest_dtype: The smallest integer type which holds a range of values.
+    charges_to_pe: Converts the dpe charges in PE.
+    ChargeBuffer: A growable (2, n) array of charges which widens its type on overflow.
+    SpillingChargeBuffers: The charge buffers of all the segments which are spilled
+        to temporary memory-mapped files above a memory budget.
+    save_chargeStore: Writes the slc_hlc_q_dict in a charge store.
+    load_chargeStore: Loads a charge store as a dictionary of (2, n) views.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from utils.channel_index import omkey_to_tuple
+
+CHARGE_STORE_VERSION = 2
+# Version 1 has the charges in PE (float64), version 2 in dpe (integers)
+SUPPORTED_VERSIONS = (1, 2)
+
+DPE_PER_PE = 10.0
+
+
+def smallest_dtype(low, high):
+    """Return the smallest integer type which holds the values from low to high"""
+    if low < 0:
+        # A signed type for both ends (min_scalar_type of high alone is unsigned)
+        return np.result_type(np.min_scalar_type(low), np.min_scalar_type(-high - 1))
+    return np.min_scalar_type(high)
+
+
+def charges_to_pe(charges):
+    """
+    Return the charges in PE: the integer charges are in dpe, the floating point charges
+    are already in PE (version 1 stores and old pickle files).
+    """
+    charges = np.asarray(charges)
+    if np.issubdtype(charges.dtype, np.integer):
+        return charges / DPE_PER_PE
+    return charges
+
+
+class ChargeBuffer:
+    """
+    A growable (2, n) array of slc and hlc charges. The capacity is doubled when it is full,
+    so appending n charges costs O(n) instead of the O(n**2) of np.append.
+    The type starts as uint8 and is widened (the charges are copied once) when the appended
+    charges do not fit, e.g. uint8 -> uint16 -> uint32.
+    """
+
+    def __init__(self, charges=None, capacity=64):
+        self.dtype = np.dtype(np.uint8)
+        self.size = 0
+        self._data = np.empty((2, capacity), dtype=self.dtype)
+        if charges is not None:
+            self.append(charges)
+
+    def append(self, charges):
+        """Append a (2, k) array of charges"""
+        charges = np.asarray(charges)
+        k = charges.shape[1]
+        if k == 0:
+            return
+        if np.issubdtype(charges.dtype, np.integer):
+            needed = smallest_dtype(charges.min(), charges.max())
+        else:
+            needed = charges.dtype
+        if not np.can_cast(needed, self.dtype):
+            self.dtype = np.promote_types(self.dtype, needed)
+            self._data = self._data.astype(self.dtype)
+        if self.size + k > self._data.shape[1]:
+            capacity = max(2 * self._data.shape[1], self.size + k)
+            data = np.empty((2, capacity), dtype=self.dtype)
+            data[:, : self.size] = self._data[:, : self.size]
+            self._data = data
+        self._data[:, self.size : self.size + k] = charges
+        self.size += k
+        return
+
+    @property
+    def nbytes(self):
+        """The memory used by the buffer (with the unused capacity)"""
+        return self._data.nbytes
+
+    def charges(self):
+        """Return a (2, n) view of the charges"""
+        return self._data[:, : self.size]
+
+    def clear(self, capacity=64):
+        """Remove the charges and release the memory (the type is kept)"""
+        self.size = 0
+        self._data = np.empty((2, capacity), dtype=self.dtype)
+        return
+
+    def to_array(self):
+        """Return a (2, n) copy of the charges without the unused capacity"""
+        return self._data[:, : self.size].copy()
+
+    def release(self):
+        """
+        Return the (2, n) charges without the unused capacity and empty the buffer,
+        so the charges are in memory once (they are not copied if the buffer is full)
+        """
+        if self.size == self._data.shape[1]:
+            charges = self._data
+        else:
+            charges = self.to_array()
+        self.clear(capacity=0)
+        return charges
+
+
+class SpillingChargeBuffers:
+    """
+    The ChargeBuffers of all the segments under a memory budget. When the buffers use more
+    than memoryBudget bytes, the largest ones are spilled (appended) to a temporary file of
+    their segment until they use less than half of the budget. The file of a segment is
+    a (n, 2) array, so all its charges are mapped back as a (2, n) view by to_array
+    without reading them in memory; the charges are read only when they are used
+    (e.g. the crossover points of one OM at a time).
+
+    The spilled, reloaded (when the type of a spilled segment is widened) and mapped bytes
+    are counted in spilledBytes, reloadedBytes and mappedBytes.
+    """
+
+    def __init__(self, nSegments, memoryBudget=0, spillDir=None):
+        """
+        Parameters:
+            nSegments: The number of segments.
+            memoryBudget: The memory budget of the buffers in bytes (0 is no budget).
+            spillDir: The directory of the temporary files (default is the system temporary directory).
+        """
+        self.buffers = [ChargeBuffer() for _ in range(nSegments)]
+        self.memoryBudget = memoryBudget
+        self.spillDir = spillDir
+        self._tmpDir = None
+        self._spilled = {}
+        self.spilledBytes = 0
+        self.reloadedBytes = 0
+        self.mappedBytes = 0
+        self.nSpills = 0
+
+    @property
+    def nbytes(self):
+        """The memory used by the buffers"""
+        return sum(buffer.nbytes for buffer in self.buffers)
+
+    def append(self, segment, charges):
+        """Append a (2, k) array of charges to a segment"""
+        self.buffers[segment].append(charges)
+        return
+
+    def check_budget(self):
+        """Spill the largest buffers if the buffers use more than the memory budget"""
+        if self.memoryBudget <= 0:
+            return
+        nbytes = self.nbytes
+        if nbytes <= self.memoryBudget:
+            return
+        for segment in np.argsort([-buffer.nbytes for buffer in self.buffers]):
+            if nbytes <= self.memoryBudget / 2:
+                break
+            buffer = self.buffers[segment]
+            nbytes -= buffer.nbytes
+            self.spill(int(segment))
+            nbytes += buffer.nbytes
+        return
+
+    def spill(self, segment):
+        """Append the charges of the buffer of a segment to its file and clear the buffer"""
+        buffer = self.buffers[segment]
+        if buffer.size == 0:
+            return
+        if self._tmpDir is None:
+            self._tmpDir = tempfile.mkdtemp(prefix="slccal_spill_", dir=self.spillDir)
+        fileName, dtype, size = self._spilled.get(
+            segment, (f"{self._tmpDir}/segment{segment}.bin", buffer.dtype, 0)
+        )
+        if not np.can_cast(buffer.dtype, dtype):
+            # Rewrite the spilled charges with the wider type
+            spilled = np.fromfile(fileName, dtype=dtype)
+            self.reloadedBytes += spilled.nbytes
+            dtype = np.promote_types(dtype, buffer.dtype)
+            spilled.astype(dtype).tofile(fileName)
+            self.spilledBytes += spilled.size * dtype.itemsize
+
+        rows = np.ascontiguousarray(buffer.charges().T, dtype=dtype)
+        with open(fileName, "ab") as f:
+            rows.tofile(f)
+        self.spilledBytes += rows.nbytes
+        self.nSpills += 1
+        self._spilled[segment] = (fileName, dtype, size + buffer.size)
+        buffer.clear()
+        return
+
+    def to_array(self, segment):
+        """
+        Return the (2, n) charges of a segment, a memory-mapped view if the segment was spilled
+        """
+        if segment not in self._spilled:
+            return self.buffers[segment].to_array()
+        self.spill(segment)
+        fileName, dtype, size = self._spilled[segment]
+        charges = np.memmap(fileName, dtype=dtype, mode="r", shape=(size, 2)).T
+        self.mappedBytes += charges.nbytes
+        return charges
+
+    def release(self, segment):
+        """
+        Return the (2, n) charges of a segment like to_array and release its buffer,
+        so the charges of all the segments can be taken out one at a time under the memory budget
+        """
+        if segment not in self._spilled:
+            return self.buffers[segment].release()
+        charges = self.to_array(segment)
+        self.buffers[segment].clear(capacity=0)
+        return charges
+
+    @property
+    def spilledSegments(self):
+        """The number of spilled segments"""
+        return len(self._spilled)
+
+    def close(self):
+        """
+        Remove the temporary files. The views returned by to_array stay valid
+        until they are deleted (the mapped files are only unlinked, on POSIX systems).
+        """
+        if self._tmpDir is not None:
+            shutil.rmtree(self._tmpDir, ignore_errors=True)
+            self._tmpDir = None
+        return
+
+
+def save_chargeStore(slc_hlc_q_dict, storeDir, meta, compress=False):
+    """
+    Save the raw slc and hlc charges of each OM and ATWD in a charge store.
+    ----------------------------------
+    Parameters:
+        slc_hlc_q_dict: A dictionary of OMKeys with a (2, n) array of slc and hlc charges for each ATWD.
+        storeDir: The directory where the store is written (it is created if it does not exist).
+        meta: A dictionary with the run information (e.g. runNumb, year, startTime, endTime).
+        compress: If True the charges are written compressed (the store can not be memory-mapped).
+    """
+    os.makedirs(storeDir, exist_ok=True)
+
+    keys = []
+    segments = []
+    for omkey in sorted(slc_hlc_q_dict.keys(), key=omkey_to_tuple):
+        string, om = omkey_to_tuple(omkey)
+        for atwd in range(3):
+            keys.append((string, om, atwd))
+            segments.append(np.asarray(slc_hlc_q_dict[omkey][f"atwd{atwd}"]))
+
+    lengths = np.array([segment.shape[1] for segment in segments], dtype=np.int64)
+    offsets = np.zeros(len(segments) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    # The type of the charges (the empty segments have no type)
+    filled = [segment.dtype for segment in segments if segment.shape[1] > 0]
+    dtype = np.result_type(*filled) if filled else np.uint8
+
+    np.save(f"{storeDir}/keys.npy", np.array(keys, dtype=np.int16).reshape(-1, 3))
+    np.save(f"{storeDir}/offsets.npy", offsets)
+    # Remove the charges of a previous store with the other layout
+    for old in ("charges.npy", "charges.npz"):
+        if os.path.exists(f"{storeDir}/{old}"):
+            os.remove(f"{storeDir}/{old}")
+    if compress:
+        charges = np.empty((2, offsets[-1]), dtype=dtype)
+    else:
+        # Written segment by segment, the (memory-mapped) charges are not copied in memory
+        charges = np.lib.format.open_memmap(
+            f"{storeDir}/charges.npy",
+            mode="w+",
+            dtype=dtype,
+            shape=(2, int(offsets[-1])),
+        )
+    for i, segment in enumerate(segments):
+        charges[:, offsets[i] : offsets[i + 1]] = segment
+    if compress:
+        np.savez_compressed(f"{storeDir}/charges.npz", charges=charges)
+    else:
+        charges.flush()
+    del charges
+
+    with open(f"{storeDir}/meta.json", "w") as f:
+        json.dump({"version": CHARGE_STORE_VERSION, **meta}, f)
+    return
+
+
+def load_chargeStore(storeDir):
+    """
+    Load a charge store written by save_chargeStore.
+    The uncompressed charges are memory-mapped, each entry is a view of its segment
+    (integers in dpe, or floats in PE for the stores of version 1, see charges_to_pe).
+    ----------------------------------
+    Parameters:
+        storeDir: The directory of the store.
+    Returns:
+        slc_hlc_q_dict: A dictionary of (string, om) with a (2, n) array of slc and hlc charges for each ATWD.
+        meta: The dictionary with the run information given when the store was saved.
+    """
+    with open(f"{storeDir}/meta.json", "r") as f:
+        meta = json.load(f)
+    if meta.get("version") not in SUPPORTED_VERSIONS:
+        raise ValueError(
+            f"Charge store {storeDir} has version {meta.get('version')}, "
+            + f"expected one of {SUPPORTED_VERSIONS}"
+        )
+
+    keys = np.load(f"{storeDir}/keys.npy")
+    offsets = np.load(f"{storeDir}/offsets.npy")
+    if os.path.exists(f"{storeDir}/charges.npy"):
+        charges = np.load(f"{storeDir}/charges.npy", mmap_mode="r")
+    else:
+        with np.load(f"{storeDir}/charges.npz") as f:
+            charges = f["charges"]
+
+    slc_hlc_q_dict = {}
+    for (string, om, atwd), start, stop in zip(
+        keys.tolist(), offsets[:-1].tolist(), offsets[1:].tolist()
+    ):
+        slc_hlc_q_dict.setdefault((string, om), {})[f"atwd{atwd}"] = charges[
+            :, start:stop
+        ]
+    return slc_hlc_q_dict, meta
@@ -0,0 +1,293 @@
+"""
+__author__ = Federico Bontempo KIT PhD student <federico.bontempo@kit.edu>
+
+This script contains the functions to store the SLC calibration results in a columnar layout.
+Each row is one (string, om, chip, atwd) channel and each column is one quantity
+(n, p0, p1, errors, chi2, sums, crossover, run and time).
+The columns are plain NumPy arrays, so the files can be read back without icetray,
+either with NumPy (.npz), pandas (.parquet) or h5py/pandas (.hdf5).
+
+Functions:
+    build_resultColumns: Converts the p0_p1_dict and crossOvers_dict into columns.
+    save_columnar: Writes the columns in a npz, parquet or hdf5 file with bulk array writes.
+    load_columnar: Reads the columns back as a dictionary of NumPy arrays.
+    write_jsonl_fromColumns: Streams the columns into the PFMoniWriter jsonl format.
+"""
+
+import json
+import math
+import numpy as np
+
+from utils.channel_index import omkey_to_tuple
+
+COLUMNAR_VERSION = 1
+
+# Name and dtype of each column of the result table
+RESULT_COLUMNS = (
+    ("string", np.int16),
+    ("om", np.int16),
+    ("chip", np.int8),
+    ("atwd", np.int8),
+    ("n", np.int64),
+    ("p0", np.float64),
+    ("p1", np.float64),
+    ("p0_error", np.float64),
+    ("p1_error", np.float64),
+    ("chi2", np.float64),
+    ("sum_x", np.float64),
+    ("sum_xx", np.float64),
+    ("sum_xy", np.float64),
+    ("sum_y", np.float64),
+    ("sum_yy", np.float64),
+    ("crossover", np.float64),
+    ("run", np.int64),
+    ("start_mjd", np.float64),
+    ("end_mjd", np.float64),
+)
+
+# Keys of the p0_p1_dict entries that are copied one to one in the columns
+_FIT_KEYS = {
+    "n": "n",
+    "p0": "p0",
+    "p1": "p1",
+    "p0_error": "p0_error",
+    "p1_error": "p1_error",
+    "chi2": "chi2",
+    "sum_x": "x",
+    "sum_xx": "xx",
+    "sum_xy": "xy",
+    "sum_y": "y",
+    "sum_yy": "yy",
+}
+
+FILE_EXTENSIONS = {"npz": "npz", "parquet": "parquet", "hdf5": "hdf5"}
+
+
+def time_to_mjd(time):
+    """
+    Return the modified julian day of an I3Time (or of a number) as float.
+    """
+    if time is None:
+        return np.nan
+    if hasattr(time, "mod_julian_day_double"):
+        return float(time.mod_julian_day_double)
+    return float(time)
+
+
+def build_resultColumns(p0_p1_dict, crossOvers_dict, runNumb, startTime, endTime):
+    """
+    Convert the p0 and p1 values and the crossover points in columns.
+    The crossover of the row is the crossover 0-1 for ATWD0 and the crossover 1-2 for ATWD1,
+    -1 if the OM has no crossover points or for ATWD2.
+    ----------------------------------
+    Parameters:
+        p0_p1_dict: A dictionary containing the calculated p0 and p1 values for each (string, om, chip, atwd).
+        crossOvers_dict: A dictionary containing the crossover points for each OMKey.
+        runNumb: Run number of the calibration.
+        startTime: Start time of the calibration (I3Time).
+        endTime: End time of the calibration (I3Time).
+    Returns:
+        resultColumns: A dictionary with the column name as key and a NumPy array as value.
+            The recording start and stop times are also kept as text in "recordingStartTime"
+            and "recordingStopTime", as they are written in the jsonl file.
+    """
+    socaKeys = list(p0_p1_dict.keys())
+    valuesDicts = list(p0_p1_dict.values())
+    nRows = len(socaKeys)
+
+    resultColumns = {}
+    soca = np.array(socaKeys, dtype=np.int64).reshape(nRows, 4)
+    for i, name in enumerate(("string", "om", "chip", "atwd")):
+        resultColumns[name] = soca[:, i].astype(dict(RESULT_COLUMNS)[name])
+    for name, key in _FIT_KEYS.items():
+        resultColumns[name] = np.fromiter(
+            (valuesDict[key] for valuesDict in valuesDicts),
+            dtype=dict(RESULT_COLUMNS)[name],
+            count=nRows,
+        )
+
+    # Crossover points of each OM as a (nRows, 2) lookup with -1 for missing OMs
+    crossOvers = {omkey_to_tuple(k): v for k, v in crossOvers_dict.items()}
+    cops = np.full((nRows, 2), -1.0)
+    for i, (string, om, chip, atwd) in enumerate(socaKeys):
+        cop = crossOvers.get((string, om))
+        if cop is not None:
+            cops[i] = cop
+    atwd = resultColumns["atwd"]
+    resultColumns["crossover"] = np.where(
+        atwd == 0, cops[:, 0], np.where(atwd == 1, cops[:, 1], -1.0)
+    )
+
+    resultColumns["run"] = np.full(nRows, runNumb, dtype=np.int64)
+    resultColumns["start_mjd"] = np.full(nRows, time_to_mjd(startTime))
+    resultColumns["end_mjd"] = np.full(nRows, time_to_mjd(endTime))
+    resultColumns["recordingStartTime"] = f"{startTime}"
+    resultColumns["recordingStopTime"] = f"{endTime}"
+    return resultColumns
+
+
+def save_columnar(resultColumns, fileName, fileFormat="npz"):
+    """
+    Save the result columns in a npz, parquet or hdf5 file.
+    Every column is written as one array, the text times are saved as metadata.
+    ----------------------------------
+    Parameters:
+        resultColumns: The dictionary returned by build_resultColumns.
+        fileName: The name of the output file.
+        fileFormat: Either "npz", "parquet" or "hdf5".
+    """
+    arrays = {name: resultColumns[name] for name, _ in RESULT_COLUMNS}
+    metadata = {
+        "version": COLUMNAR_VERSION,
+        "recordingStartTime": resultColumns["recordingStartTime"],
+        "recordingStopTime": resultColumns["recordingStopTime"],
+    }
+
+    if fileFormat == "npz":
+        np.savez(fileName, metadata=np.array(json.dumps(metadata)), **arrays)
+    elif fileFormat == "parquet":
+        import pandas as pd
+
+        df = pd.DataFrame(arrays, copy=False)
+        df.attrs.update(metadata)
+        df.to_parquet(fileName, index=False)
+    elif fileFormat == "hdf5":
+        import h5py
+
+        with h5py.File(fileName, "w") as f:
+            for name, array in arrays.items():
+                f.create_dataset(name, data=array)
+            for key, value in metadata.items():
+                f.attrs[key] = value
+    else:
+        raise ValueError(f"Unknown columnar format {fileFormat}")
+    return
+
+
+def load_columnar(fileName):
+    """
+    Load the result columns from a npz, parquet or hdf5 file.
+    ----------------------------------
+    Parameters:
+        fileName: The name of the file written by save_columnar.
+    Returns:
+        resultColumns: A dictionary with the column name as key and a NumPy array as value,
+            plus the "recordingStartTime" and "recordingStopTime" text.
+    """
+    if fileName.endswith(".npz"):
+        with np.load(fileName) as f:
+            resultColumns = {name: f[name] for name, _ in RESULT_COLUMNS}
+            metadata = json.loads(str(f["metadata"]))
+    elif fileName.endswith(".parquet"):
+        import pandas as pd
+
+        df = pd.read_parquet(fileName)
+        resultColumns = {name: df[name].to_numpy() for name, _ in RESULT_COLUMNS}
+        metadata = dict(df.attrs)
+    elif fileName.endswith((".hdf5", ".h5")):
+        import h5py
+
+        with h5py.File(fileName, "r") as f:
+            resultColumns = {name: f[name][()] for name, _ in RESULT_COLUMNS}
+            metadata = dict(f.attrs)
+    else:
+        raise ValueError(f"Unknown columnar file extension {fileName}")
+
+    resultColumns["recordingStartTime"] = str(metadata.get("recordingStartTime", ""))
+    resultColumns["recordingStopTime"] = str(metadata.get("recordingStopTime", ""))
+    return resultColumns
+
+
+def _json_numbers(array):
+    """
+    Convert an array in a list of JSON number literals (NaN and Infinity as json.dump does).
+    """
+    if np.issubdtype(array.dtype, np.integer):
+        return [str(v) for v in array.tolist()]
+    literals = []
+    for v in array.tolist():
+        if math.isfinite(v):
+            literals.append(repr(v))
+        elif math.isnan(v):
+            literals.append("NaN")
+        else:
+            literals.append("Infinity" if v > 0 else "-Infinity")
+    return literals
+
+
+# One line of the PFMoniWriter jsonl file, the fields are filled column by column
+_JSONL_TEMPLATE = (
+    '{{"_id": "64f9cd9e19368f", "service": "PFMoniWriter", '
+    '"varname": "ITSLCChargeCalResults", "value": {{'
+    '"string": {}, "om": {}, "chip": {}, "channel": {}, '
+    '"runNumber": {}, "subrunNumber": 0, "version": 0, '
+    '"recordingStartTime": {start}, "recordingStopTime": {stop}, '
+    '"result": {{"chi2": {}, "n": {}, "p0": {}, "p0_error": {}, '
+    '"p1": {}, "p1_error": {}, "sum_x": {}, "sum_xx": {}, "sum_xy": {}, '
+    '"sum_y": {}, "sum_yy": {}, "crossover": {}}}}}, "prio": 3, '
+    '"time": "2023-09-07 13:18:21.986000", '
+    '"insert_time": "2023-09-08 06:02:47.940807"}}\n'
+)
+
+_JSONL_COLUMNS = (
+    "string",
+    "om",
+    "chip",
+    "atwd",
+    "run",
+    "chi2",
+    "n",
+    "p0",
+    "p0_error",
+    "p1",
+    "p1_error",
+    "sum_x",
+    "sum_xx",
+    "sum_xy",
+    "sum_y",
+    "sum_yy",
+    "crossover",
+)
+
+
+def _int_sentinels(resultColumns):
+    """
+    Return the rows where the baseline save_jsonl wrote an integer literal, as a mask of each column:
+    p0 = p1 = 0 of the failed fits, the errors -1 of the fits with n <= 2 and the crossover -1.
+    """
+    failed = (resultColumns["p0"] == 0) & (resultColumns["p1"] == 0)
+    fewCharges = np.asarray(resultColumns["n"]) <= 2
+    return {
+        "p0": failed,
+        "p1": failed,
+        "p0_error": fewCharges & (resultColumns["p0_error"] == -1),
+        "p1_error": fewCharges & (resultColumns["p1_error"] == -1),
+        "crossover": resultColumns["crossover"] == -1,
+    }
+
+
+def write_jsonl_fromColumns(resultColumns, fileName):
+    """
+    Write the result columns in the PFMoniWriter jsonl format.
+    Each column is converted to text once, the lines are formatted from the
+    columns and the whole file is written with a single buffered write.
+    ----------------------------------
+    Parameters:
+        resultColumns: The dictionary returned by build_resultColumns or load_columnar.
+        fileName: The name of the output jsonl file.
+    """
+    start = json.dumps(resultColumns["recordingStartTime"])
+    stop = json.dumps(resultColumns["recordingStopTime"])
+    textColumns = [_json_numbers(np.asarray(resultColumns[c])) for c in _JSONL_COLUMNS]
+    # The sentinels keep the integer literals of the baseline files (0 and -1, not 0.0 and -1.0)
+    for name, isInt in _int_sentinels(resultColumns).items():
+        literals = textColumns[_JSONL_COLUMNS.index(name)]
+        for i in np.flatnonzero(isInt).tolist():
+            literals[i] = str(int(resultColumns[name][i]))
+    text = "".join(
+        _JSONL_TEMPLATE.format(*row, start=start, stop=stop)
+        for row in zip(*textColumns)
+    )
+    with open(fileName, "w") as f:
+        f.write(text)
+    return
@@ -2,7 +2,7 @@
 """
 This script contains the functions to calculate the crossover points of the SLC calibration values.
 It takes the SLC calibration values from a .pkl file and calculates the crossover points.
-It can also plot the histograms with the crossover points.
+It can also save the histograms and kde curves of the charges, which are plotted by utils.plot_crossovers.
 
 __author__ = 
 Julian Saffer KIT PhD student <julian.saffer@kit.edu>
@@ -10,15 +10,20 @@ Federico Bontempo KIT PhD student <federico.bontempo@kit.edu>
 ! special thanks to Katherine Rawlins for the help !
 
 When running the main script, simply import calculate_crossOverPoints
+
+This script does not need the IceCube software (the keys can be OMKeys or (string, om) tuples).
+scipy and matplotlib are only imported when the crossover points are calculated or plotted.
 """
 
 import pickle
 import numpy as np
 
-from scipy.stats import gaussian_kde
-from scipy.optimize import brentq
+from utils.channel_index import bad_dom_mask, omkey_to_dom, omkey_to_tuple
+from utils.charge_store import charges_to_pe
 
-from icecube import icetray, dataio, vemcal
+# Binning of the log10 SLC charges and x values of the kde curves of the diagnostic plots
+CHARGE_BINNING = np.linspace(-1, 6, 71)
+CHARGE_ARRAY_KDE = np.linspace(-1, 6, 701)
 
 
 def load_chargesFromFile(file):
@@ -28,12 +33,43 @@ def load_chargesFromFile(file):
     return slcATW_dict
 
 
+def log_charges(atwd_dict):
+    """
+    Return the log10 of the SLC charges (in PE) of the 3 ATWDs of an OM without the zero charges.
+    The ATWD2 charges are dropped if they are all to the very left of the ATWD1 charges.
+    """
+    logCharges = []
+    for atwd in range(3):
+        logCharge = np.log10(charges_to_pe(atwd_dict[f"atwd{atwd}"][0]))
+        logCharges.append(logCharge[~np.isinf(logCharge)])  # remove zero charges
+    atwd0, atwd1, atwd2 = logCharges
+
+    # Check if the ATW2 has charges to the very left
+    # that mess up the crossover point
+    if len(atwd2) != 0 and len(atwd1) != 0:
+        if max(atwd2) < min(atwd1):
+            atwd2 = np.array([])
+    return atwd0, atwd1, atwd2
+
+
 def findIntersection(fun1, fun2, weight1, weight2, lower, upper):
-    return brentq(lambda x: weight1 * fun1(x) - weight2 * fun2(x), lower, upper)
+    from scipy.optimize import brentq
+
+    # gaussian_kde returns a 1 element array, brentq needs a scalar
+    return brentq(
+        lambda x: np.asarray(weight1 * fun1(x) - weight2 * fun2(x)).item(),
+        lower,
+        upper,
+    )
 
 
 def calculate_crossOverPoints(
-    slcATW_dict, bad_doms_list, pathSave="", doPlotting=False
+    slcATW_dict,
+    bad_doms_list,
+    pathSave="",
+    doPlotting=False,
+    diagnostics=None,
+    nWorkers=0,
 ):
     """
     Calculate the crossover points of the SLC calibration values.
@@ -47,9 +83,13 @@ def calculate_crossOverPoints(
     Parameters:
         slcATW_dict: A dictionary of OMKeys with a list of slc and hlc charges for each ATWD and chips.
         bad_dom_list: A list of bad DOMs (default is an empty list).
-        pathSave: A path to save the plots (default is an empty string).
+        pathSave: A path to save the plots and their diagnostics (default is an empty string).
         doPlotting: A boolean to decide if the plots should be saved (default is False).
-        (The plots are not fully implemented yet.)
+            The histograms and kde curves are saved in {pathSave}crossOverDiagnostics.npz
+            and plotted by utils.plot_crossovers (one page per station).
+        diagnostics: A dictionary which is filled with the histograms and kde curves of each OMKey
+            (see save_crossOverDiagnostics), the default None does not keep them.
+        nWorkers: Number of processes used for the plots (default is the number of cores).
 
     Returns:
         crossOverPoints_dict: A dictionary containing the crossover points for each OMKey.
@@ -58,25 +98,20 @@ def calculate_crossOverPoints(
             ...
         }
     """
+    from scipy.stats import gaussian_kde
+
     crossOverPoints_dict = {}
+    bad_doms = bad_dom_mask(bad_doms_list)
+    if doPlotting and diagnostics is None:
+        diagnostics = {}
+    if diagnostics is not None:
+        for name in ("omkeys", "counts", "kde", "crossovers", "bad"):
+            diagnostics.setdefault(name, [])
 
     # Loop over all OMKeys
     for key in slcATW_dict.keys():
-        atwd0 = np.log10(slcATW_dict[key]["atwd0"][0])[
-            ~np.isinf(np.log10(slcATW_dict[key]["atwd0"][0]))
-        ]  # remove zero charges
-        atwd1 = np.log10(slcATW_dict[key]["atwd1"][0])[
-            ~np.isinf(np.log10(slcATW_dict[key]["atwd1"][0]))
-        ]
-        atwd2 = np.log10(slcATW_dict[key]["atwd2"][0])[
-            ~np.isinf(np.log10(slcATW_dict[key]["atwd2"][0]))
-        ]
-
-        # Check if the ATW2 has charges to the very left
-        # that mess up the crossover point
-        if len(atwd2) != 0 and len(atwd1) != 0:
-            if max(atwd2) < min(atwd1):
-                atwd2 = np.array([])
+        isBad = bad_doms[omkey_to_dom(key)]
+        atwd0, atwd1, atwd2 = log_charges(slcATW_dict[key])
 
         len0 = len(atwd0)
         len1 = len(atwd1)
@@ -85,6 +120,8 @@ def calculate_crossOverPoints(
         charge_binning = np.linspace(-1, 6, 71)
         charge_bin_width = charge_binning[1] - charge_binning[0]
 
+        kde0 = kde1 = kde2 = None
+        weight0 = weight1 = weight2 = 0
         if len0 > 1:
             med0 = np.median(atwd0)
             kde0 = gaussian_kde(atwd0)
@@ -109,11 +146,42 @@ def calculate_crossOverPoints(
             except:
                 cop12_kde = np.nan
 
+        if diagnostics is not None:
+            # Keep what is needed for the plots, so that nothing is computed again
+            diagnostics["omkeys"].append(omkey_to_tuple(key))
+            diagnostics["counts"].append(
+                [
+                    np.histogram(atwd, bins=charge_binning)[0]
+                    for atwd in (atwd0, atwd1, atwd2)
+                ]
+            )
+            diagnostics["kde"].append(
+                [
+                    (
+                        weight * kde(CHARGE_ARRAY_KDE)
+                        if kde is not None
+                        else np.zeros(CHARGE_ARRAY_KDE.size)
+                    )
+                    for kde, weight in (
+                        (kde0, weight0),
+                        (kde1, weight1),
+                        (kde2, weight2),
+                    )
+                ]
+            )
+            diagnostics["crossovers"].append(
+                (
+                    cop01_kde if (len0 > 1) and (len1 > 1) else np.nan,
+                    cop12_kde if (len1 > 1) and (len2 > 1) else np.nan,
+                )
+            )
+            diagnostics["bad"].append(isBad)
+
         # Check if the OMKey has charges in all ATWDs
         # and save the crossover points in the dictionary
         if (len0 > 1) and (len1 > 1) and (len2 > 1):
             crossOverPoints_dict[key] = (10**cop01_kde, 10**cop12_kde)
-        elif key in bad_doms_list:
+        elif isBad:
             # e.g. 2022 dead DOMs "OMKey(74,61,0)" and "OMKey(39,61,0)"
             continue
         else:
@@ -123,114 +191,219 @@ def calculate_crossOverPoints(
             )
 
     if doPlotting:
-        plot_histWithCrossOverPoints(
-            slcATW_dict, pathSave, charge_array_kde=np.linspace(-1, 6, 701)
-        )
+        from utils.plot_crossovers import plot_crossOverDiagnostics
+
+        diagnosticsFile = f"{pathSave}crossOverDiagnostics.npz"
+        save_crossOverDiagnostics(diagnostics, diagnosticsFile)
+        plot_crossOverDiagnostics(diagnosticsFile, pathSave, nWorkers=nWorkers)
 
     return crossOverPoints_dict
 
 
-def plot_histWithCrossOverPoints(slcATW_dict, pathSave, charge_array_kde):
+def save_crossOverDiagnostics(diagnostics, fileName):
     """
-    Plot the histograms of the SLC calibration values with the crossover points.
-    This is not fully implemented yet. Nor tested.
+    Save the histograms and kde curves filled by calculate_crossOverPoints in a npz file.
+    The file contains:
+        omkeys: (n_oms, 2) the string and om of each OM
+        counts: (n_oms, 3, 70) the histograms of the log10 SLC charges of each ATWD
+        kde: (n_oms, 3, 701) the kde curves scaled to the histograms
+        crossovers: (n_oms, 2) the log10 of the crossover points 0-1 and 1-2
+        bad: (n_oms,) the OM is a bad DOM
+        charge_binning, charge_array_kde: the bin edges and the x values of the kde curves
     ----------------------------------------------
     Parameters:
-        slcATW_dict: A dictionary of OMKeys with a list of slc and hlc charges for each ATWD and chips.
-        pathSave: A path to save the plots.
-        charge_array_kde: The charge array for the kernel density estimation.
+        diagnostics: The dictionary filled by calculate_crossOverPoints.
+        fileName: The name of the output file.
     """
-    import matplotlib.pyplot as plt
+    nOMs = len(diagnostics["omkeys"])
+    np.savez_compressed(
+        fileName,
+        omkeys=np.array(diagnostics["omkeys"], dtype=np.int16).reshape(nOMs, 2),
+        counts=np.array(diagnostics["counts"], dtype=np.int64).reshape(
+            nOMs, 3, CHARGE_BINNING.size - 1
+        ),
+        kde=np.array(diagnostics["kde"], dtype=np.float32).reshape(
+            nOMs, 3, CHARGE_ARRAY_KDE.size
+        ),
+        crossovers=np.array(diagnostics["crossovers"], dtype=np.float64).reshape(
+            nOMs, 2
+        ),
+        bad=np.array(diagnostics["bad"], dtype=bool),
+        charge_binning=CHARGE_BINNING,
+        charge_array_kde=CHARGE_ARRAY_KDE,
+    )
+    return
+
+
+# Fine binning of the log10 SLC charges used by the bootstrap (the resolution of the crossover points)
+BOOTSTRAP_BINNING = np.linspace(-1, 6, 701)
+BOOTSTRAP_CENTERS = 0.5 * (BOOTSTRAP_BINNING[1:] + BOOTSTRAP_BINNING[:-1])
+# The kernels are cut at this number of bandwidths
+KERNEL_CUT = 6.0
+
+
+def _bootstrap_counts(logCharges, nBootstrap, rng):
+    """
+    Bin the log10 charges and draw nBootstrap resampled histograms (multinomial with the same number of charges).
+    Only the filled bins are kept, the others stay empty in all the samples.
+    Returns the bin indices, the (nBootstrap, n_filled_bins) counts and the Scott bandwidth
+    of the original charges (as gaussian_kde).
+    """
+    counts = np.histogram(logCharges, bins=BOOTSTRAP_BINNING)[0]
+    bins = np.flatnonzero(counts)
+    resampled = rng.multinomial(
+        counts.sum(), counts[bins] / counts.sum(), size=nBootstrap
+    )
+    bandwidth = np.std(logCharges, ddof=1) * len(logCharges) ** (-1.0 / 5)
+    return bins, resampled, bandwidth
 
-    fig, axes = plt.subplots(81, 4, figsize=(25, 162 * 1.5))
 
-    for key in slcATW_dict.keys():
-        # check if key is a string
-        if isinstance(key, str):
-            station = int(key.replace("OMKey", "")[1:-1].split(",")[0]) - 1
-            om = int(key.replace("OMKey", "")[1:-1].split(",")[1]) - 61
-        else:
-            station = key.string - 1
-            om = key.om - 61
-
-        axes[station, om].text(
-            0.05,
-            0.8,
-            key,
-            fontsize=10,
-            color="k",
-            weight="bold",
-            transform=axes[station, om].transAxes,
-        )
-
-        atwd0 = np.log10(slcATW_dict[key]["atwd0"][0])[
-            ~np.isinf(np.log10(slcATW_dict[key]["atwd0"][0]))
-        ]  # remove zero charges
-        atwd1 = np.log10(slcATW_dict[key]["atwd1"][0])[
-            ~np.isinf(np.log10(slcATW_dict[key]["atwd1"][0]))
-        ]
-        atwd2 = np.log10(slcATW_dict[key]["atwd2"][0])[
-            ~np.isinf(np.log10(slcATW_dict[key]["atwd2"][0]))
-        ]
-
-        if len(atwd2) != 0 and len(atwd1) != 0:
-            if max(atwd2) < min(atwd1):
-                atwd2 = np.array([])
+def _bootstrap_medians(bins, resampled):
+    """Return the median bin center of each resampled histogram"""
+    cumulative = np.cumsum(resampled, axis=1)
+    index = np.argmax(cumulative >= 0.5 * cumulative[:, -1:], axis=1)
+    return BOOTSTRAP_CENTERS[bins[index]]
 
-        len0 = len(atwd0)
-        len1 = len(atwd1)
-        len2 = len(atwd2)
 
-        charge_binning = np.linspace(-1, 6, 71)
-        charge_bin_width = charge_binning[1] - charge_binning[0]
+def _bootstrap_kde(bins, resampled, bandwidth, evaluated):
+    """
+    Evaluate the binned kde of all the resampled histograms at the points evaluated
+    with one matrix product: (nBootstrap, n_source_bins) @ (n_source_bins, n_eval).
+    Only the bins closer than KERNEL_CUT bandwidths to the evaluated points are used.
+    """
+    source = BOOTSTRAP_CENTERS[bins]
+    used = (source >= evaluated[0] - KERNEL_CUT * bandwidth) & (
+        source <= evaluated[-1] + KERNEL_CUT * bandwidth
+    )
+    kernel = np.exp(
+        -0.5 * ((evaluated[np.newaxis, :] - source[used, np.newaxis]) / bandwidth) ** 2
+    )
+    kernel /= np.sqrt(2 * np.pi) * bandwidth
+    return resampled[:, used] @ kernel / resampled.sum(axis=1, keepdims=True)
+
+
+def _bootstrap_roots(sample0, weight0, sample1, weight1):
+    """
+    Find the crossover point of the two weighted kde curves of each bootstrap sample
+    between their medians: the first sign change of weight0 * kde0 - weight1 * kde1,
+    refined by linear interpolation. nan if the curves do not cross.
+    """
+    med0 = _bootstrap_medians(*sample0[:2])
+    med1 = _bootstrap_medians(*sample1[:2])
+    lower = np.minimum(med0, med1)
+    upper = np.maximum(med0, med1)
+
+    # The evaluated bin centers cover the intervals of all the bootstrap samples
+    evalIndex = np.arange(
+        np.searchsorted(BOOTSTRAP_CENTERS, lower.min()),
+        np.searchsorted(BOOTSTRAP_CENTERS, upper.max()) + 1,
+    )
+    evalIndex = evalIndex[evalIndex < BOOTSTRAP_CENTERS.size]
+    roots = np.full(len(med0), np.nan)
+    if len(evalIndex) < 2:
+        return roots
+    x = BOOTSTRAP_CENTERS[evalIndex]
+    diff = weight0 * _bootstrap_kde(*sample0, x) - weight1 * _bootstrap_kde(*sample1, x)
+
+    # A sign change between x[j] and x[j + 1], both inside the interval of the sample
+    inside = (x[np.newaxis, :] >= lower[:, np.newaxis]) & (
+        x[np.newaxis, :] <= upper[:, np.newaxis]
+    )
+    change = (
+        (np.sign(diff[:, :-1]) != np.sign(diff[:, 1:])) & inside[:, :-1] & inside[:, 1:]
+    )
+    found = change.any(axis=1)
+    j = np.argmax(change, axis=1)[found]
+    rows = np.flatnonzero(found)
+    d0, d1 = diff[rows, j], diff[rows, j + 1]
+    roots[rows] = x[j] + (x[j + 1] - x[j]) * d0 / (d0 - d1)
+    return roots
+
+
+def calculate_crossOverUncertainties(
+    slcATW_dict, bad_doms_list, nBootstrap=200, seed=None
+):
+    """
+    Calculate the median and the spread of the crossover points of each OM with a bootstrap.
+    The charges of each OM and ATWD are binned once, the nBootstrap resampled histograms are
+    drawn at once (multinomial) and their binned kde curves are evaluated with one matrix product,
+    with the bandwidth of the original charges (as scipy.stats.gaussian_kde). The crossover point
+    of each sample is the sign change of the weighted kde difference between the two medians,
+    as in calculate_crossOverPoints.
+    ----------------------------------------------
+    Parameters:
+        slcATW_dict: A dictionary of OMKeys with the slc and hlc charges for each ATWD.
+        bad_doms_list: A list of bad DOMs, they are skipped.
+        nBootstrap: The number of bootstrap samples.
+        seed: The seed of the random generator.
+    Returns:
+        crossOverUncertainties_dict: A dictionary with the following structure:
+        crossOverUncertainties_dict = {
+            OMKey: {
+                "median": (crossover_point_01, crossover_point_12), # median of the samples in PE
+                "spread": (spread_01, spread_12), # half of the 16%-84% interval in PE
+                "failed": (failed_01, failed_12), # fraction of the samples without crossover
+            }
+            ...
+        }
+    """
+    rng = np.random.default_rng(seed)
+    bad_doms = bad_dom_mask(bad_doms_list)
+    charge_bin_width = CHARGE_BINNING[1] - CHARGE_BINNING[0]
 
-        if len0:
-            axes[station, om].hist(
-                atwd0, alpha=0.5, color="blue", bins=charge_binning, label="ATWD0"
-            )
-            med0 = np.median(atwd0)
-            kde0 = gaussian_kde(atwd0)
-            weight0 = len(slcATW_dict[key]["atwd0"][0]) * charge_bin_width
-        if len1:
-            axes[station, om].hist(
-                atwd1, alpha=0.5, color="green", bins=charge_binning, label="ATWD1"
-            )
-            med1 = np.median(atwd1)
-            kde1 = gaussian_kde(atwd1)
-            weight1 = len(slcATW_dict[key]["atwd1"][0]) * charge_bin_width
-        if len2:
-            axes[station, om].hist(
-                atwd2, alpha=0.5, color="red", bins=charge_binning, label="ATWD2"
-            )
-            med2 = np.median(atwd2)
-            kde2 = gaussian_kde(atwd2)
-            weight2 = len(slcATW_dict[key]["atwd2"][0]) * charge_bin_width
+    crossOverUncertainties_dict = {}
+    for key in slcATW_dict.keys():
+        if bad_doms[omkey_to_dom(key)]:
+            continue
+        logCharges = log_charges(slcATW_dict[key])
+        if any(len(logCharge) <= 1 for logCharge in logCharges):
+            continue
 
-        if len0 and len1:
-            cop01_kde = findIntersection(kde0, kde1, weight0, weight1, med0, med1)
-            axes[station, om].axvline(x=cop01_kde, c="k", ls="solid")
-        if len1 and len2:
-            cop12_kde = findIntersection(kde1, kde2, weight1, weight2, med1, med2)
-            axes[station, om].axvline(x=cop12_kde, c="k", ls="dashed")
-
-        axes[station, om].set_xlabel(r"$\log_\mathrm{10}$" + "(SLC charge (PE))")
-        axes[station, om].set_ylabel("count")
-        axes[station, om].set_xlim(-1, 6)
-        axes[station, om].set_yscale("log")
-        if (key != "OMKey(74,61,0)") and (key != "OMKey(39,61,0)"):
-            axes[station, om].legend(loc="upper right")
-        else:
-            axes[station, om].text(
-                0.5,
-                0.5,
-                "dead DOM",
-                horizontalalignment="center",
-                verticalalignment="center",
-                fontsize=10,
-                color="k",
-                weight="bold",
-                transform=axes[station, om].transAxes,
-            )
+        samples = []
+        for atwd, logCharge in enumerate(logCharges):
+            sample = _bootstrap_counts(logCharge, nBootstrap, rng)
+            weight = len(slcATW_dict[key][f"atwd{atwd}"][0]) * charge_bin_width
+            samples.append((sample, weight))
+
+        median, spread, failed = [], [], []
+        for first, second in ((0, 1), (1, 2)):
+            roots = _bootstrap_roots(*samples[first], *samples[second])
+            good = roots[np.isfinite(roots)]
+            failed.append(1.0 - len(good) / nBootstrap)
+            if len(good) == 0:
+                median.append(np.nan)
+                spread.append(np.nan)
+                continue
+            p16, p50, p84 = np.percentile(good, (16, 50, 84))
+            median.append(10**p50)
+            spread.append(0.5 * (10**p84 - 10**p16))
+
+        crossOverUncertainties_dict[key] = {
+            "median": tuple(median),
+            "spread": tuple(spread),
+            "failed": tuple(failed),
+        }
+    return crossOverUncertainties_dict
 
-    plt.savefig(f"{pathSave}SLCCal_first_results_linear.png", bbox_inches="tight")
-    plt.close()
+
+def save_crossOverUncertainties(crossOverUncertainties_dict, fileName, nBootstrap):
+    """
+    Save the bootstrap crossover points in a npz file with the arrays:
+        omkeys: (n_oms, 2) the string and om of each OM
+        median, spread, failed: (n_oms, 2) the values of the crossover points 0-1 and 1-2
+        nBootstrap: the number of bootstrap samples
+    """
+    values = list(crossOverUncertainties_dict.values())
+    nOMs = len(values)
+    np.savez_compressed(
+        fileName,
+        omkeys=np.array(
+            [omkey_to_tuple(k) for k in crossOverUncertainties_dict], dtype=np.int16
+        ).reshape(nOMs, 2),
+        **{
+            name: np.array([v[name] for v in values], dtype=np.float64).reshape(nOMs, 2)
+            for name in ("median", "spread", "failed")
+        },
+        nBootstrap=nBootstrap,
+    )
+    return
@@ -0,0 +1,200 @@
+"""
+__author__ = Federico Bontempo KIT PhD student <federico.bontempo@kit.edu>
+
+This script contains the set of the events which were already used by the calibration,
+so that the same event read twice (e.g. overlapping burn-sample and full-run files or broad globs)
+is counted only once.
+
+An event is identified by the (run_id, sub_run_id, event_id) of its I3EventHeader packed in a uint64:
+    run_id << 44 | sub_run_id << 32 | event_id
+(run_id < 2**20, sub_run_id < 2**12, event_id < 2**32).
+The set keeps a few sorted arrays (runs) of the packed ids (8 bytes per event) and a small Python set
+of the newest ids. When the Python set has bufferSize ids, they are sorted as a new run, which is merged
+with the last run while that one is at most RUN_RATIO times larger (a linear merge of two sorted arrays,
+the accumulated ids are never sorted again). Each run is more than RUN_RATIO times smaller than the one
+before, so there are only a few runs (O(log n)) and each id is merged O(log n) times:
+the memory is bounded by the number of events and each check is a set lookup and a few binary searches.
+
+The set can be saved in a .npy file (the sorted array) and the sets of parallel workers can be merged.
+
+Functions:
+    pack_eventId: Packs (run_id, sub_run_id, event_id) in a uint64.
+    unpack_eventId: Unpacks the uint64 ids in (run_id, sub_run_id, event_id).
+    load_eventIds: Loads and merges saved sets.
+Classes:
+    EventIdSet: The set of the packed event ids.
+"""
+
+import time
+import numpy as np
+
+RUN_BITS = 20
+SUB_RUN_BITS = 12
+EVENT_BITS = 32
+# Minimum size ratio of two consecutive runs of an EventIdSet (fewer runs to search, more merging)
+RUN_RATIO = 16
+
+
+def pack_eventId(run_id, sub_run_id, event_id):
+    """
+    Return the uint64 id of (run_id, sub_run_id, event_id), scalars or NumPy arrays
+    (the id of scalars is a Python int). A ValueError is raised if a value does not fit in its bits.
+    """
+    scalars = (int, np.integer)
+    if (
+        isinstance(run_id, scalars)
+        and isinstance(sub_run_id, scalars)
+        and isinstance(event_id, scalars)
+    ):
+        run_id, sub_run_id, event_id = int(run_id), int(sub_run_id), int(event_id)
+        if (
+            0 <= run_id < 1 << RUN_BITS
+            and 0 <= sub_run_id < 1 << SUB_RUN_BITS
+            and 0 <= event_id < 1 << EVENT_BITS
+        ):
+            return (
+                run_id << (SUB_RUN_BITS + EVENT_BITS)
+                | sub_run_id << EVENT_BITS
+                | event_id
+            )
+    for name, value, bits in (
+        ("run_id", run_id, RUN_BITS),
+        ("sub_run_id", sub_run_id, SUB_RUN_BITS),
+        ("event_id", event_id, EVENT_BITS),
+    ):
+        if np.any(np.asarray(value) < 0) or np.any(np.asarray(value) >= 1 << bits):
+            raise ValueError(f"{name} {value} does not fit in {bits} bits")
+    return (
+        (np.uint64(run_id) << np.uint64(SUB_RUN_BITS + EVENT_BITS))
+        | (np.uint64(sub_run_id) << np.uint64(EVENT_BITS))
+        | np.uint64(event_id)
+    )
+
+
+def unpack_eventId(eventId):
+    """Return the (run_id, sub_run_id, event_id) of uint64 ids"""
+    eventId = np.asarray(eventId, dtype=np.uint64)
+    return (
+        eventId >> np.uint64(SUB_RUN_BITS + EVENT_BITS),
+        (eventId >> np.uint64(EVENT_BITS)) & np.uint64((1 << SUB_RUN_BITS) - 1),
+        eventId & np.uint64((1 << EVENT_BITS) - 1),
+    )
+
+
+class EventIdSet:
+    """
+    The set of the packed event ids (see pack_eventId).
+    add returns False for the ids which are already in the set. The number of checked and
+    duplicate ids (nChecked, nDuplicates) and the time spent in add_event (checkSeconds) are counted.
+    """
+
+    def __init__(self, eventIds=None, bufferSize=1 << 16):
+        """
+        Parameters:
+            eventIds: An array of packed ids to start with (default is empty).
+            bufferSize: The number of new ids kept in the Python set before they are sorted in a run.
+        """
+        # Sorted and disjoint arrays of ids, each one RUN_RATIO times smaller than the one before
+        self._runs = []
+        self._recent = set()
+        self.bufferSize = bufferSize
+        self.checkSeconds = 0.0
+        self.nChecked = 0
+        self.nDuplicates = 0
+        if eventIds is not None:
+            self.merge(eventIds)
+
+    def __len__(self):
+        return sum(len(run) for run in self._runs) + len(self._recent)
+
+    def __contains__(self, eventId):
+        eventId = int(eventId)
+        if eventId in self._recent:
+            return True
+        eventId = np.uint64(eventId)
+        for run in self._runs:
+            i = np.searchsorted(run, eventId)
+            if i < len(run) and run[i] == eventId:
+                return True
+        return False
+
+    def add(self, eventId):
+        """
+        Add a packed id, return True if it is new and False if it was already in the set.
+        """
+        self.nChecked += 1
+        isNew = eventId not in self
+        if isNew:
+            self._recent.add(int(eventId))
+            if len(self._recent) >= self.bufferSize:
+                self._flush()
+        else:
+            self.nDuplicates += 1
+        return isNew
+
+    def add_event(self, run_id, sub_run_id, event_id):
+        """
+        Add the id of (run_id, sub_run_id, event_id) (e.g. of an I3EventHeader),
+        return True if it is new and False if it was already in the set.
+        """
+        t0 = time.perf_counter()
+        isNew = self.add(pack_eventId(run_id, sub_run_id, event_id))
+        self.checkSeconds += time.perf_counter() - t0
+        return isNew
+
+    def _push_run(self, ids):
+        """Add a sorted array of new ids (not in the set) as a run, merged with the runs not RUN_RATIO times larger"""
+        while self._runs and len(self._runs[-1]) <= RUN_RATIO * len(ids):
+            run = self._runs.pop()
+            # Linear merge of two disjoint sorted arrays
+            ids = np.insert(run, np.searchsorted(run, ids), ids)
+        if len(ids):
+            self._runs.append(ids)
+        return
+
+    def _flush(self):
+        """Sort the recent ids in a new run"""
+        if self._recent:
+            recent = np.fromiter(self._recent, dtype=np.uint64, count=len(self._recent))
+            recent.sort()
+            self._recent = set()
+            self._push_run(recent)
+        return
+
+    def to_array(self):
+        """Return the sorted array of the packed ids"""
+        self._flush()
+        while len(self._runs) > 1:
+            run = self._runs.pop()
+            self._runs[-1] = np.insert(
+                self._runs[-1], np.searchsorted(self._runs[-1], run), run
+            )
+        return self._runs[0] if self._runs else np.empty(0, dtype=np.uint64)
+
+    def merge(self, other):
+        """Add the ids of another EventIdSet (or of an array of packed ids) to this set"""
+        ids = other.to_array() if isinstance(other, EventIdSet) else other
+        ids = np.unique(np.asarray(ids, dtype=np.uint64))
+        self._flush()
+        for run in self._runs:
+            if len(ids) == 0:
+                break
+            i = np.minimum(np.searchsorted(run, ids), len(run) - 1)
+            ids = ids[run[i] != ids]
+        self._push_run(ids)
+        return self
+
+    def save(self, fileName):
+        """Save the sorted packed ids in a .npy file"""
+        np.save(fileName, self.to_array())
+        return
+
+
+def load_eventIds(fileNames, bufferSize=1 << 16):
+    """
+    Load the ids saved by EventIdSet.save in several files (e.g. of parallel workers) in one EventIdSet.
+    """
+    eventIds = EventIdSet(bufferSize=bufferSize)
+    for fileName in fileNames:
+        eventIds.merge(np.load(fileName))
+    return eventIds
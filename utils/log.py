@@ -0,0 +1,59 @@
+"""
+__author__ = Federico Bontempo KIT PhD student <federico.bontempo@kit.edu>
+
+This script contains the logging functions of the icetray-free modules of utils.
+The icetray i3logging functions are used when the IceCube software is available,
+otherwise the messages go to the python logging module and log_fatal raises a RuntimeError
+(as i3logging does). i3logging is imported at the first message, so that importing
+the numerical modules never loads icetray.
+
+Functions:
+    log_debug, log_info, log_warn, log_error, log_fatal: Same signature as icetray.i3logging.
+"""
+
+import logging
+
+_i3logging = None
+
+
+def _get_i3logging():
+    """Return the icetray i3logging module, or False if the IceCube software is not available"""
+    global _i3logging
+    if _i3logging is None:
+        try:
+            from icecube.icetray import i3logging
+
+            _i3logging = i3logging
+        except ImportError:
+            _i3logging = False
+    return _i3logging
+
+
+def _log(level, message, unit):
+    i3logging = _get_i3logging()
+    if i3logging:
+        getattr(i3logging, f"log_{level}")(message, unit=unit)
+    elif level == "fatal":
+        raise RuntimeError(f"{unit}: {message}")
+    else:
+        logging.getLogger(unit).log(getattr(logging, level.upper()), message)
+
+
+def log_debug(message, unit="SLCCalibration"):
+    _log("debug", message, unit)
+
+
+def log_info(message, unit="SLCCalibration"):
+    _log("info", message, unit)
+
+
+def log_warn(message, unit="SLCCalibration"):
+    _log("warn", message, unit)
+
+
+def log_error(message, unit="SLCCalibration"):
+    _log("error", message, unit)
+
+
+def log_fatal(message, unit="SLCCalibration"):
+    _log("fatal", message, unit)
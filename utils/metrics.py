@@ -0,0 +1,191 @@
+"""
+__author__ = Federico Bontempo KIT PhD student <federico.bontempo@kit.edu>
+
+This script contains a lightweight instrumentation layer for the calibration scripts:
+counters and context-manager timers (wall and CPU time) with optional labels.
+The metrics can be dumped as JSON or in the Prometheus textfile-exporter format,
+so that the batch monitoring can scrape them.
+
+When the metrics are disabled the NULL_METRICS object is used: all its methods do nothing,
+so the instrumented code pays only an empty method call.
+
+Classes:
+    Metrics: Collects counters and timers.
+    NullMetrics: The disabled version of Metrics.
+
+Usage:
+    metrics = Metrics()
+    with metrics.timer("stage", stage="ingest"):
+        metrics.inc("frames_seen")
+    metrics.write_json("metrics.json")
+    metrics.write_textfile("metrics.prom")
+"""
+
+import contextlib
+import json
+import os
+import time
+
+
+def _metric_name(name, labels):
+    """Return the name of a metric with its labels, e.g. frames_skipped{reason="stream"}"""
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+
+class Metrics:
+    """
+    Counters and timers of the calibration scripts.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.counters = {}
+        self.timers = {}
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increase the counter name (with its labels) by value.
+        """
+        key = _metric_name(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """
+        Set the counter name (with its labels) to value.
+        """
+        self.counters[_metric_name(name, labels)] = value
+
+    def add_time(self, name, wall, cpu=0.0, **labels):
+        """
+        Add a measured wall and CPU time to the timer name (with its labels).
+        """
+        key = _metric_name(name, labels)
+        timer = self.timers.setdefault(key, {"count": 0, "wall_s": 0.0, "cpu_s": 0.0})
+        timer["count"] += 1
+        timer["wall_s"] += wall
+        timer["cpu_s"] += cpu
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """
+        Context manager which adds the wall and CPU time of its block to the timer name.
+        """
+        wall0, cpu0 = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.add_time(
+                name,
+                time.perf_counter() - wall0,
+                time.process_time() - cpu0,
+                **labels,
+            )
+
+    def timed_iter(self, iterable, name, consumerName=None, **labels):
+        """
+        Yield the items of iterable and add the wall and CPU time spent to produce them (e.g. decoding
+        the I3 frames) to the timer name. If consumerName is given, the time spent by the
+        loop body between two items is added to that timer.
+        """
+        iterator = iter(iterable)
+        producer, producerCPU = 0.0, 0.0
+        consumer, consumerCPU = 0.0, 0.0
+        count = 0
+        try:
+            while True:
+                t0, c0 = time.perf_counter(), time.process_time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    producer += time.perf_counter() - t0
+                    producerCPU += time.process_time() - c0
+                    break
+                t1, c1 = time.perf_counter(), time.process_time()
+                producer += t1 - t0
+                producerCPU += c1 - c0
+                count += 1
+                yield item
+                consumer += time.perf_counter() - t1
+                consumerCPU += time.process_time() - c1
+        finally:
+            self._add_loop_time(name, producer, producerCPU, count, labels)
+            if consumerName is not None:
+                self._add_loop_time(consumerName, consumer, consumerCPU, count, labels)
+
+    def _add_loop_time(self, name, wall, cpu, count, labels):
+        key = _metric_name(name, labels)
+        timer = self.timers.setdefault(key, {"count": 0, "wall_s": 0.0, "cpu_s": 0.0})
+        timer["count"] += count
+        timer["wall_s"] += wall
+        timer["cpu_s"] += cpu
+
+    def to_dict(self):
+        """
+        Return the counters and timers as a dictionary.
+        """
+        return {"counters": dict(self.counters), "timers": dict(self.timers)}
+
+    def write_json(self, fileName):
+        """
+        Write the counters and timers in a JSON file.
+        """
+        with open(fileName, "w") as f:
+            json.dump(self.to_dict(), f, indent=1)
+        return
+
+    def write_textfile(self, fileName, prefix="slccal_"):
+        """
+        Write the counters and timers in the Prometheus textfile-exporter format.
+        The file is written next to its final name and renamed, so that a scrape
+        never reads a half written file.
+        """
+        lines = []
+        for key, value in sorted(self.counters.items()):
+            name, _, labels = key.partition("{")
+            labels = "{" + labels if labels else ""
+            lines.append(f"{prefix}{name}_total{labels} {value}")
+        for key, timer in sorted(self.timers.items()):
+            name, _, labels = key.partition("{")
+            labels = "{" + labels if labels else ""
+            lines.append(f"{prefix}{name}_count{labels} {timer['count']}")
+            lines.append(f"{prefix}{name}_wall_seconds{labels} {timer['wall_s']}")
+            lines.append(f"{prefix}{name}_cpu_seconds{labels} {timer['cpu_s']}")
+
+        tmpName = f"{fileName}.tmp{os.getpid()}"
+        with open(tmpName, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmpName, fileName)
+        return
+
+
+class NullMetrics:
+    """
+    The disabled metrics: every method does nothing.
+    """
+
+    enabled = False
+    _nullcontext = contextlib.nullcontext()
+
+    def inc(self, name, value=1, **labels):
+        pass
+
+    def set(self, name, value, **labels):
+        pass
+
+    def add_time(self, name, wall, cpu=0.0, **labels):
+        pass
+
+    def timer(self, name, **labels):
+        return self._nullcontext
+
+    def timed_iter(self, iterable, name, consumerName=None, **labels):
+        return iterable
+
+    def to_dict(self):
+        return {"counters": {}, "timers": {}}
+
+
+NULL_METRICS = NullMetrics()
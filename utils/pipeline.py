@@ -0,0 +1,535 @@
+"""
+__author__ = Federico Bontempo KIT PhD student <federico.bontempo@kit.edu>
+
+This script contains the icetray-free orchestration of the calibration scripts of many runs and years
+(e.g. readSave_HLC_SLC_charges.py -> write_SLC_Calibration_in_GCD.py, write_extrapolated_SLC_calibration.py)
+from a json manifest, see run_pipeline.py.
+
+Each stage is one command (a script with its arguments) with its input and output files.
+The stages of the manifest are either run once for each run of the manifest ("perRun": true)
+or once in total. A stage depends on the stages which write its inputs and on the stages
+given in "after", so the stages are a DAG (a cycle raises a ValueError). The ready stages are run
+concurrently with at most nWorkers commands at a time; the stages of a failed stage are not run.
+
+A stage is skipped if nothing changed since its last successful run: its key is the sha256 of the command,
+of the content of its script and of the utils package and of the content of its inputs. The key and
+the sha256 of the outputs are saved in the provenance record of the stage ({workDir}/provenance/),
+and every run of a stage is appended to {workDir}/provenance.jsonl. The sha256 of a file is computed
+again only if its size or modification time changed ({workDir}/hashCache.json).
+
+Functions:
+    load_pipelineManifest: Loads the manifest and expands it into stages.
+    build_dag: Returns the dependencies of each stage.
+    stage_key: Returns the key of a stage.
+    run_command: Runs a command with its output in a log file.
+    run_pipeline: Runs the stages of the DAG and returns the report.
+Classes:
+    HashCache: The sha256 of the files, cached by size and modification time.
+"""
+
+import datetime
+import glob
+import hashlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from utils.metrics import NULL_METRICS
+
+PIPELINE_FORMAT = "ITSLCCalibrationPipeline"
+PIPELINE_VERSION = 1
+
+# The directory of the scripts (the scripts of the manifest are relative to it)
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class HashCache:
+    """
+    The sha256 of the files, kept in a json file and computed again only when
+    the size or the modification time of a file changed.
+    """
+
+    def __init__(self, fileName=""):
+        self.fileName = fileName
+        self._hashes = {}
+        self._lock = threading.Lock()
+        if fileName != "" and os.path.exists(fileName):
+            with open(fileName, "r") as f:
+                self._hashes = json.load(f)
+        self.nHashed = 0
+        self.hashedBytes = 0
+
+    def file_sha256(self, path):
+        """Return the sha256 of the content of a file"""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self._lock:
+            cached = self._hashes.get(path)
+        if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2]
+
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        with self._lock:
+            self._hashes[path] = [stat.st_size, stat.st_mtime_ns, digest]
+            self.nHashed += 1
+            self.hashedBytes += stat.st_size
+        return digest
+
+    def sha256(self, pattern):
+        """
+        Return the sha256 of a file, of all the files of a directory or of all the files of a glob
+        (the sorted names and contents). A FileNotFoundError is raised if nothing matches.
+        """
+        if os.path.isdir(pattern):
+            files = sorted(
+                os.path.join(root, name)
+                for root, _, names in os.walk(pattern)
+                for name in names
+            )
+        elif os.path.exists(pattern):
+            return self.file_sha256(pattern)
+        else:
+            files = sorted(glob.glob(pattern))
+            if not files:
+                raise FileNotFoundError(f"Input {pattern} does not exist")
+        sha = hashlib.sha256()
+        for path in files:
+            sha.update(f"{os.path.relpath(path, os.path.dirname(pattern))}:".encode())
+            sha.update(self.file_sha256(path).encode())
+        return sha.hexdigest()
+
+    def save(self):
+        """
+        Save the cache (in a unique temporary file which is renamed). The whole save holds the lock,
+        so concurrent saves can not rename each other's file.
+        """
+        if self.fileName == "":
+            return
+        with self._lock:
+            fd, tmpName = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.fileName)),
+                prefix=os.path.basename(self.fileName) + ".",
+            )
+            with os.fdopen(fd, "w") as f:
+                json.dump(self._hashes, f)
+            os.replace(tmpName, self.fileName)
+        return
+
+
+def _render(value, variables):
+    """Fill the {fields} of the strings of value (a string or a list) with variables"""
+    if isinstance(value, str):
+        return value.format(**variables)
+    if isinstance(value, list):
+        return [_render(v, variables) for v in value]
+    return value
+
+
+def _render_list(values, variables, runs):
+    """
+    Fill the {fields} of a list of strings. In a stage which is not per run,
+    the strings starting with * are repeated for each run (with the variables of the run).
+    """
+    rendered = []
+    for value in values:
+        if isinstance(value, str) and value.startswith("*"):
+            rendered.extend(_render(value[1:], {**variables, **run}) for run in runs)
+        else:
+            rendered.append(_render(value, variables))
+    return rendered
+
+
+def _run_name(run):
+    """Return the name of a run of the manifest (its "name" or Run{runNumb})"""
+    return str(run.get("name", f"Run{run.get('runNumb', '')}"))
+
+
+def _command(script, args, python):
+    """Return the command list of a script and its {"--option": value} arguments"""
+    command = [python, os.path.join(PACKAGE_DIR, script)]
+    for option, value in args.items():
+        if value is True:
+            command.append(option)
+        elif value is False or value is None:
+            continue
+        elif isinstance(value, list):
+            command.append(option)
+            command.extend(str(v) for v in value)
+        else:
+            command.extend([option, str(value)])
+    return command
+
+
+def load_pipelineManifest(manifestFile):
+    """
+    Load the json manifest and expand it into stages:
+        {
+            "python": <python executable> (default: this python),
+            "variables": {<name>: <value>, ...} (the {name} fields of all the stages),
+            "runs": [{"runNumb": <run>, "year": <year>, <name>: <value>, ...}, ...],
+            "stages": [
+                {
+                    "name": <stage name>,
+                    "script": <script relative to the package directory>,
+                    "args": {"--option": <value, list of values, true for a flag>, ...},
+                    "inputs": [<files, directories or globs>],
+                    "outputs": [<files>],
+                    "after": [<stage names>] (optional),
+                    "perRun": true or false (default: true)
+                },
+                ...
+            ]
+        }
+    The strings can have {fields} of the variables and of the run. In a stage with "perRun": false,
+    the list items starting with * are repeated for each run (e.g. the artifacts of all the runs).
+    ----------------------------------
+    Returns:
+        stages: A list of dictionaries with id, name, run, command, script, inputs, outputs and after.
+    """
+    with open(manifestFile, "r") as f:
+        manifest = json.load(f)
+    python = manifest.get("python", sys.executable)
+    variables = manifest.get("variables", {})
+    runs = manifest.get("runs", [])
+    stageNames = [stage["name"] for stage in manifest["stages"]]
+    if len(set(stageNames)) != len(stageNames):
+        raise ValueError(f"{manifestFile} has two stages with the same name")
+    perRunNames = {s["name"] for s in manifest["stages"] if s.get("perRun", True)}
+
+    stages = []
+    for stage in manifest["stages"]:
+        for key in ("name", "script", "outputs"):
+            if key not in stage:
+                raise ValueError(f"{manifestFile}: a stage has no {key}")
+        perRun = stage.get("perRun", True)
+        for run in runs if perRun else [None]:
+            if run is None:
+                runVariables = dict(variables)
+                runName = ""
+                args = {
+                    option: (
+                        _render_list(value, variables, runs)
+                        if isinstance(value, list)
+                        else _render(value, variables)
+                    )
+                    for option, value in stage.get("args", {}).items()
+                }
+                inputs = _render_list(stage.get("inputs", []), variables, runs)
+                outputs = _render_list(stage["outputs"], variables, runs)
+            else:
+                runVariables = {**variables, **run}
+                runName = _run_name(run)
+                args = {
+                    option: _render(value, runVariables)
+                    for option, value in stage.get("args", {}).items()
+                }
+                inputs = _render(stage.get("inputs", []), runVariables)
+                outputs = _render(stage["outputs"], runVariables)
+
+            # A stage after a per-run stage depends on the same run (all the runs if it is not per run)
+            after = []
+            for name in stage.get("after", []):
+                if name not in stageNames:
+                    raise ValueError(f"{manifestFile}: unknown stage {name} in after")
+                if name not in perRunNames:
+                    after.append(name)
+                elif perRun:
+                    after.append(f"{name}:{runName}")
+                else:
+                    after.extend(f"{name}:{_run_name(r)}" for r in runs)
+
+            stages.append(
+                {
+                    "id": f"{stage['name']}:{runName}" if perRun else stage["name"],
+                    "name": stage["name"],
+                    "run": runName,
+                    "script": stage["script"],
+                    "command": _command(
+                        stage["script"], args, _render(python, runVariables)
+                    ),
+                    "inputs": inputs,
+                    "outputs": outputs,
+                    "after": after,
+                }
+            )
+    return stages
+
+
+def build_dag(stages):
+    """
+    Return the dependencies of each stage: the stages of "after" and the stages which write its inputs.
+    A ValueError is raised if two stages write the same output or if the stages have a cycle.
+    ----------------------------------
+    Returns:
+        dependencies: A dictionary {stage id: set of stage ids}.
+        order: The stage ids in a topological order.
+    """
+    writers = {}
+    for stage in stages:
+        for output in stage["outputs"]:
+            output = os.path.abspath(output)
+            if output in writers:
+                raise ValueError(
+                    f"{output} is written by {writers[output]} and {stage['id']}"
+                )
+            writers[output] = stage["id"]
+
+    ids = [stage["id"] for stage in stages]
+    dependencies = {}
+    for stage in stages:
+        deps = set(stage["after"])
+        for path in stage["inputs"]:
+            writer = writers.get(os.path.abspath(path))
+            if writer is not None:
+                deps.add(writer)
+        deps.discard(stage["id"])
+        unknown = deps.difference(ids)
+        if unknown:
+            raise ValueError(
+                f"{stage['id']} depends on unknown stages {sorted(unknown)}"
+            )
+        dependencies[stage["id"]] = deps
+
+    # Kahn's algorithm
+    remaining = {i: set(deps) for i, deps in dependencies.items()}
+    order = []
+    ready = [i for i in ids if not remaining[i]]
+    while ready:
+        current = ready.pop(0)
+        order.append(current)
+        for i in ids:
+            if current in remaining[i]:
+                remaining[i].discard(current)
+                if not remaining[i]:
+                    ready.append(i)
+    if len(order) != len(ids):
+        cycle = sorted(i for i in ids if remaining[i])
+        raise ValueError(f"The stages have a cycle: {cycle}")
+    return dependencies, order
+
+
+def code_sha256(hashCache, script):
+    """Return the sha256 of the script and of the python files of utils (the code of a stage)"""
+    sha = hashlib.sha256()
+    files = [os.path.join(PACKAGE_DIR, script)] + sorted(
+        glob.glob(os.path.join(PACKAGE_DIR, "utils", "*.py"))
+    )
+    for path in files:
+        sha.update(hashCache.file_sha256(path).encode())
+    return sha.hexdigest()
+
+
+def stage_key(stage, hashCache):
+    """
+    Return the key of a stage (the sha256 of its command, code and inputs) and the sha256 of its inputs.
+    A FileNotFoundError is raised if an input does not exist.
+    """
+    inputs = {path: hashCache.sha256(path) for path in stage["inputs"]}
+    sha = hashlib.sha256()
+    sha.update(json.dumps(stage["command"][1:]).encode())
+    sha.update(code_sha256(hashCache, stage["script"]).encode())
+    sha.update(json.dumps(inputs, sort_keys=True).encode())
+    return sha.hexdigest(), inputs
+
+
+def run_command(command, logFile):
+    """
+    Run a command with its stdout and stderr in logFile and return its exit code.
+    """
+    with open(logFile, "w") as log:
+        return subprocess.run(
+            command, stdout=log, stderr=subprocess.STDOUT, cwd=PACKAGE_DIR
+        ).returncode
+
+
+def _record_fileName(workDir, stageId):
+    return os.path.join(workDir, "provenance", stageId.replace(":", "_") + ".json")
+
+
+def _load_record(workDir, stageId):
+    fileName = _record_fileName(workDir, stageId)
+    if not os.path.exists(fileName):
+        return None
+    with open(fileName, "r") as f:
+        return json.load(f)
+
+
+def _is_upToDate(record, key, stage, hashCache):
+    """Return True if the stage ran successfully with the same key and its outputs are unchanged"""
+    if record is None or record.get("key") != key or record.get("returncode") != 0:
+        return False
+    for output in stage["outputs"]:
+        if not os.path.exists(output):
+            return False
+        if hashCache.sha256(output) != record["outputs"].get(output):
+            return False
+    return True
+
+
+def run_pipeline(
+    stages,
+    workDir,
+    nWorkers=0,
+    force=False,
+    dryRun=False,
+    runCommand=run_command,
+    metrics=NULL_METRICS,
+):
+    """
+    Run the stages of the DAG with at most nWorkers commands at a time.
+    ----------------------------------
+    Parameters:
+        stages: The stages of load_pipelineManifest.
+        workDir: The directory of the provenance records, logs and hash cache.
+        nWorkers: The maximum number of concurrent commands (default: number of cores).
+        force: Run all the stages, also the ones which are up to date.
+        dryRun: Only print which stages would run. The stages after a stage which would run
+            are "pending" (their inputs are not known yet).
+        runCommand: The callable runCommand(command, logFile) -> exit code (replaced by a stub in tests).
+        metrics: Metrics object (see utils.metrics) for the counters and the stage times.
+    Returns:
+        report: A dictionary with the status of each stage (done, skipped, failed, blocked, missing_input,
+            would_run, pending), the counts, the number of hashed files and bytes and the wall time.
+    """
+    nWorkers = nWorkers if nWorkers > 0 else os.cpu_count()
+    dependencies, order = build_dag(stages)
+    stagesById = {stage["id"]: stage for stage in stages}
+    for directory in ("provenance", "logs"):
+        os.makedirs(os.path.join(workDir, directory), exist_ok=True)
+    hashCache = HashCache(os.path.join(workDir, "hashCache.json"))
+    status = {}
+    lock = threading.Lock()
+
+    def execute(stage, key, inputs):
+        """Run one stage and write its provenance record"""
+        for output in stage["outputs"]:
+            outputDir = os.path.dirname(output)
+            if outputDir != "":
+                os.makedirs(outputDir, exist_ok=True)
+        logFile = os.path.join(workDir, "logs", stage["id"].replace(":", "_") + ".log")
+        start = datetime.datetime.now(datetime.timezone.utc)
+        t0 = time.perf_counter()
+        returncode = runCommand(stage["command"], logFile)
+        wall = time.perf_counter() - t0
+
+        outputs = {}
+        for output in stage["outputs"]:
+            outputs[output] = (
+                hashCache.sha256(output) if os.path.exists(output) else None
+            )
+        if returncode == 0 and None in outputs.values():
+            # The command did not write all its outputs
+            returncode = -1
+        record = {
+            "format": PIPELINE_FORMAT,
+            "version": PIPELINE_VERSION,
+            "stage": stage["id"],
+            "run": stage["run"],
+            "command": stage["command"],
+            "key": key,
+            "code_sha256": code_sha256(hashCache, stage["script"]),
+            "inputs": inputs,
+            "outputs": outputs,
+            "returncode": returncode,
+            "start": start.isoformat(),
+            "wall_s": wall,
+            "host": platform.node(),
+            "python": platform.python_version(),
+            "log": logFile,
+        }
+        with lock:
+            with open(os.path.join(workDir, "provenance.jsonl"), "a") as f:
+                f.write(json.dumps(record) + "\n")
+        if returncode == 0:
+            # The record is only replaced by a successful run, so it describes the outputs on disk
+            tmpName = _record_fileName(workDir, stage["id"]) + ".tmp"
+            with open(tmpName, "w") as f:
+                json.dump(record, f, indent=1)
+            os.replace(tmpName, _record_fileName(workDir, stage["id"]))
+        return ("done" if returncode == 0 else "failed"), wall, returncode
+
+    def process(stage):
+        """
+        Hash the inputs of a stage and run it if it is not up to date (in a worker thread,
+        so the inputs of several stages are hashed concurrently).
+        Returns the status, the wall time and a message.
+        """
+        try:
+            key, inputs = stage_key(stage, hashCache)
+        except FileNotFoundError as e:
+            return "missing_input", 0.0, str(e)
+        record = _load_record(workDir, stage["id"])
+        if not force and _is_upToDate(record, key, stage, hashCache):
+            return "skipped", 0.0, "up to date"
+        if dryRun:
+            return "would_run", 0.0, " ".join(stage["command"])
+        status, wall, returncode = execute(stage, key, inputs)
+        return status, wall, f"exit code {returncode}"
+
+    wall0 = time.perf_counter()
+    pending = {}
+    waiting = list(order)
+    # The statuses after which the next stages can run (or would run in a dry run)
+    finished = ("done", "skipped") + (("would_run", "pending") if dryRun else ())
+    with ThreadPoolExecutor(max_workers=nWorkers) as pool:
+        while waiting or pending:
+            # Dispatch the stages whose dependencies are finished
+            for stageId in list(waiting):
+                if len(pending) >= nWorkers:
+                    break
+                depStatus = [status.get(dep) for dep in dependencies[stageId]]
+                if any(s is None for s in depStatus):
+                    continue
+                waiting.remove(stageId)
+                if any(s not in finished for s in depStatus):
+                    status[stageId] = "blocked"
+                elif dryRun and any(s in ("would_run", "pending") for s in depStatus):
+                    status[stageId] = "pending"
+                else:
+                    pending[pool.submit(process, stagesById[stageId])] = stageId
+                    continue
+                metrics.inc("stages", status=status[stageId])
+                print(f"{stageId}: {status[stageId]}")
+
+            if not pending:
+                continue
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                stageId = pending.pop(future)
+                try:
+                    status[stageId], wall, message = future.result()
+                except Exception as e:
+                    status[stageId], wall, message = (
+                        "failed",
+                        0.0,
+                        f"{type(e).__name__}: {e}",
+                    )
+                metrics.inc("stages", status=status[stageId])
+                if status[stageId] in ("done", "failed"):
+                    metrics.add_time("stage", wall, stage=stagesById[stageId]["name"])
+                print(f"{stageId}: {status[stageId]} ({wall:.1f} s, {message})")
+            # Only the dispatching thread saves the cache, after each finished stage,
+            # so an interrupted pipeline keeps the hashes of the stages which ran
+            hashCache.save()
+    hashCache.save()
+
+    counts = {}
+    for s in status.values():
+        counts[s] = counts.get(s, 0) + 1
+    return {
+        "status": {stageId: status[stageId] for stageId in order},
+        "counts": counts,
+        "n_hashed_files": hashCache.nHashed,
+        "hashed_bytes": hashCache.hashedBytes,
+        "wall_s": time.perf_counter() - wall0,
+    }
@@ -0,0 +1,152 @@
+"""
+This script contains the functions to plot the histograms of the SLC charges with their
+kde curves and crossover points. It only reads the diagnostics saved by
+calculate_crossOverPoints (see save_crossOverDiagnostics), nothing is computed again.
+The pages (one per station, or one per OM) are drawn in parallel processes
+with the non-interactive Agg backend.
+
+__author__ =
+Julian Saffer KIT PhD student <julian.saffer@kit.edu>
+Federico Bontempo KIT PhD student <federico.bontempo@kit.edu>
+
+Functions:
+    load_crossOverDiagnostics: Loads the diagnostics npz file.
+    plot_crossOverDiagnostics: Draws all the pages in a process pool.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+ATWD_COLORS = ("blue", "green", "red")
+
+
+def load_crossOverDiagnostics(fileName):
+    """
+    Load the histograms and kde curves saved by save_crossOverDiagnostics.
+    ----------------------------------------------
+    Parameters:
+        fileName: The name of the diagnostics npz file.
+    Returns:
+        diagnostics: A dictionary of NumPy arrays.
+    """
+    with np.load(fileName) as f:
+        return {k: f[k] for k in f.files}
+
+
+def _plot_page(page):
+    """
+    Draw one page with the panels of one or more OMs and save it as png.
+    """
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fileName, charge_binning, charge_array_kde, panels = page
+    fig, axes = plt.subplots(
+        1, len(panels), figsize=(6.25 * len(panels), 3), squeeze=False
+    )
+
+    for ax, (omkey, counts, kde, crossovers, bad) in zip(axes[0], panels):
+        ax.text(
+            0.05,
+            0.8,
+            f"OMKey({omkey[0]},{omkey[1]})",
+            fontsize=10,
+            color="k",
+            weight="bold",
+            transform=ax.transAxes,
+        )
+        for atwd in range(3):
+            if counts[atwd].sum() == 0:
+                continue
+            ax.hist(
+                charge_binning[:-1],
+                bins=charge_binning,
+                weights=counts[atwd],
+                alpha=0.5,
+                color=ATWD_COLORS[atwd],
+                label=f"ATWD{atwd}",
+            )
+            ax.plot(charge_array_kde, kde[atwd], color=ATWD_COLORS[atwd], lw=1)
+        if np.isfinite(crossovers[0]):
+            ax.axvline(x=crossovers[0], c="k", ls="solid")
+        if np.isfinite(crossovers[1]):
+            ax.axvline(x=crossovers[1], c="k", ls="dashed")
+
+        ax.set_xlabel(r"$\log_\mathrm{10}$" + "(SLC charge (PE))")
+        ax.set_ylabel("count")
+        ax.set_xlim(charge_binning[0], charge_binning[-1])
+        if counts.sum() > 0:
+            ax.set_yscale("log")
+            # The kde tails would otherwise stretch the axis over many decades
+            ax.set_ylim(bottom=0.5)
+        if bad:
+            ax.text(
+                0.5,
+                0.5,
+                "dead DOM",
+                horizontalalignment="center",
+                verticalalignment="center",
+                fontsize=10,
+                color="k",
+                weight="bold",
+                transform=ax.transAxes,
+            )
+        elif counts.sum() > 0:
+            ax.legend(loc="upper right")
+
+    fig.savefig(fileName, bbox_inches="tight")
+    plt.close(fig)
+    return fileName
+
+
+def plot_crossOverDiagnostics(diagnostics, pathSave, perOM=False, nWorkers=0):
+    """
+    Plot the histograms with the kde curves and the crossover points,
+    one page per station (the 4 OMs side by side) or one page per OM.
+    ----------------------------------------------
+    Parameters:
+        diagnostics: The diagnostics npz file name or the dictionary returned by load_crossOverDiagnostics.
+        pathSave: The path (prefix) of the png files.
+        perOM: A boolean to save one png per OM instead of one per station.
+        nWorkers: Number of processes (default is the number of cores).
+    Returns:
+        fileNames: The list of the saved png files.
+    """
+    if isinstance(diagnostics, str):
+        diagnostics = load_crossOverDiagnostics(diagnostics)
+
+    omkeys = diagnostics["omkeys"]
+    order = np.lexsort((omkeys[:, 1], omkeys[:, 0]))
+    panels = [
+        (
+            tuple(omkeys[i].tolist()),
+            diagnostics["counts"][i],
+            diagnostics["kde"][i],
+            diagnostics["crossovers"][i],
+            bool(diagnostics["bad"][i]),
+        )
+        for i in order
+    ]
+
+    pages = {}
+    for panel in panels:
+        string, om = panel[0]
+        if perOM:
+            fileName = f"{pathSave}crossOvers_OMKey{string}_{om}.png"
+        else:
+            fileName = f"{pathSave}crossOvers_station{string:02d}.png"
+        pages.setdefault(fileName, []).append(panel)
+
+    pages = [
+        (fileName, diagnostics["charge_binning"], diagnostics["charge_array_kde"], p)
+        for fileName, p in pages.items()
+    ]
+    nWorkers = nWorkers if nWorkers > 0 else os.cpu_count()
+    with ProcessPoolExecutor(max_workers=nWorkers) as pool:
+        fileNames = list(pool.map(_plot_page, pages, chunksize=4))
+    print(f"Saved {len(fileNames)} plots in {pathSave}")
+    return fileNames
@@ -0,0 +1,337 @@
+"""
+__author__ = Federico Bontempo KIT PhD student <federico.bontempo@kit.edu>
+
+This script contains the icetray-free scheduling of the file-by-file reprocessing
+(e.g. the Calibrate_Orphaned_SLCVEMPulses trays of reprocess_Level3.py).
+Each input file is a job which is processed by a tray callable in a process pool:
+    runTray(inputFile, outputFile) -> number of frames written
+The callable must be picklable (a module-level function or a functools.partial of one),
+so the scheduling can be tested with a stub instead of an I3Tray.
+
+Only queueSize jobs are submitted at a time, so the memory of the pool does not grow
+with the number of files. The output is written next to its final name and renamed at the end,
+so an existing output file is a finished job: these jobs are skipped when the processing is restarted.
+A failed job (an exception or a crashed worker) is submitted again up to maxRetries times.
+A crashed worker breaks the whole pool and it is not known which job killed it: if several jobs
+were in the pool, they are not charged a retry but run again one at a time, so that a crash is
+charged only to the job which was alone in the pool.
+
+Functions:
+    output_fileName: Returns the output file name of an input file.
+    load_fileManifest: Loads the jobs of a manifest file.
+    make_jobs: Returns the jobs of a list of input files.
+    run_jobs: Processes the jobs in a process pool and returns the throughput report.
+    print_report: Prints the throughput report.
+"""
+
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from utils.metrics import NULL_METRICS
+
+# Suffixes of the I3 files, kept at the end of the output names (I3Writer uses them for the compression)
+I3_SUFFIXES = (".i3", ".i3.gz", ".i3.bz2", ".i3.zst")
+PART_PREFIX = "_part_"
+
+
+def _split_i3Suffix(fileName):
+    """Return the file name without its I3 suffix and the suffix"""
+    for suffix in sorted(I3_SUFFIXES, key=len, reverse=True):
+        if fileName.endswith(suffix):
+            return fileName[: -len(suffix)], suffix
+    return os.path.splitext(fileName)
+
+
+def output_fileName(
+    inputFile, outputDir, pattern="{stem}_SLCCalibrated{suffix}", index=0
+):
+    """
+    Return the output file name of an input file.
+    ----------------------------------
+    Parameters:
+        inputFile: Path of the input file.
+        outputDir: Output directory.
+        pattern: Format of the output name with the fields stem (the input name without the I3 suffix),
+            suffix (e.g. .i3.bz2), name (the input name) and index (the position of the file in the list).
+        index: The position of the file in the list.
+    """
+    name = os.path.basename(inputFile)
+    stem, suffix = _split_i3Suffix(name)
+    return os.path.join(
+        outputDir, pattern.format(stem=stem, suffix=suffix, name=name, index=index)
+    )
+
+
+def make_jobs(inputFiles, outputDir, pattern="{stem}_SLCCalibrated{suffix}"):
+    """
+    Return the jobs (dictionaries with inputFile and outputFile) of a list of input files.
+    A ValueError is raised if two input files have the same output file.
+    """
+    jobs = [
+        {
+            "inputFile": inputFile,
+            "outputFile": output_fileName(inputFile, outputDir, pattern, index),
+        }
+        for index, inputFile in enumerate(inputFiles)
+    ]
+    outputFiles = set()
+    for job in jobs:
+        if job["outputFile"] in outputFiles:
+            raise ValueError(
+                f"Two input files have the output {job['outputFile']}, change the output pattern"
+            )
+        outputFiles.add(job["outputFile"])
+    return jobs
+
+
+def load_fileManifest(manifestFile, outputDir, pattern="{stem}_SLCCalibrated{suffix}"):
+    """
+    Load the jobs of a manifest file. Each line is either the path of an input file
+    (the output is named with pattern in outputDir) or a json dictionary
+    {"inputFile": <input path>, "outputFile": <output path>} ("outputFile" is optional).
+    Empty lines and lines starting with # are skipped.
+    """
+    inputFiles = []
+    outputFiles = {}
+    with open(manifestFile, "r") as f:
+        for lineNumb, line in enumerate(f, start=1):
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            if line.startswith("{"):
+                entry = json.loads(line)
+                if "inputFile" not in entry:
+                    raise ValueError(f"{manifestFile}:{lineNumb} has no inputFile")
+                if "outputFile" in entry:
+                    outputFiles[len(inputFiles)] = entry["outputFile"]
+                inputFiles.append(entry["inputFile"])
+            else:
+                inputFiles.append(line)
+
+    jobs = make_jobs(inputFiles, outputDir, pattern)
+    for index, outputFile in outputFiles.items():
+        jobs[index]["outputFile"] = outputFile
+    return jobs
+
+
+def _part_fileName(outputFile):
+    """Return the name the output is written to before it is renamed"""
+    directory, name = os.path.split(outputFile)
+    return os.path.join(directory, PART_PREFIX + name)
+
+
+def _remove(fileName):
+    if os.path.exists(fileName):
+        os.remove(fileName)
+
+
+def _run_job(runTray, job):
+    """
+    Process one job in a worker process.
+    A failure is returned instead of raised, so that it can be retried.
+    ----------------------------------
+    Returns:
+        nFrames: The number of frames written (None if the job failed).
+        error: The error message (None if the job succeeded).
+        wall: The wall time of the job.
+        cpu: The CPU time of the job.
+    """
+    partFile = _part_fileName(job["outputFile"])
+    wall0, cpu0 = time.perf_counter(), time.process_time()
+    try:
+        nFrames = runTray(job["inputFile"], partFile)
+        os.replace(partFile, job["outputFile"])
+    except Exception as e:
+        # Do not leave a truncated output file behind
+        _remove(partFile)
+        return None, f"{type(e).__name__}: {e}", time.perf_counter() - wall0, 0.0
+    return (
+        nFrames,
+        None,
+        time.perf_counter() - wall0,
+        time.process_time() - cpu0,
+    )
+
+
+def run_jobs(
+    jobs,
+    runTray,
+    nWorkers=0,
+    maxRetries=1,
+    queueSize=0,
+    skipDone=True,
+    metrics=NULL_METRICS,
+    executorClass=ProcessPoolExecutor,
+):
+    """
+    Process the jobs with runTray in a pool of nWorkers processes.
+    ----------------------------------
+    Parameters:
+        jobs: A list of dictionaries with inputFile and outputFile (see make_jobs).
+        runTray: The callable runTray(inputFile, outputFile) -> number of frames written.
+        nWorkers: The number of worker processes (default: number of cores).
+        maxRetries: The number of times a failed job is submitted again
+            (a crash of the pool counts only for a job which ran alone, see the module docstring).
+        queueSize: The maximum number of submitted jobs (default: 2 * nWorkers).
+        skipDone: If True, the jobs whose output file exists are skipped.
+        metrics: Metrics object (see utils.metrics) for the counters and the tray times.
+        executorClass: The class of the pool (ProcessPoolExecutor, or a ThreadPoolExecutor for tests).
+    Returns:
+        report: The throughput report, a dictionary with the number of files done, skipped and failed,
+            the retries, the crashes of the pool, the frames and input bytes processed,
+            the wall and tray times and the rates.
+            The failed jobs (with their error) are in report["failed"].
+    """
+    nWorkers = nWorkers if nWorkers > 0 else os.cpu_count()
+    queueSize = queueSize if queueSize > 0 else 2 * nWorkers
+
+    todo = []
+    nSkipped = 0
+    for job in jobs:
+        if skipDone and os.path.exists(job["outputFile"]):
+            nSkipped += 1
+            metrics.inc("files_skipped", reason="done")
+            continue
+        outputDir = os.path.dirname(job["outputFile"])
+        if outputDir != "":
+            os.makedirs(outputDir, exist_ok=True)
+        todo.append((job, 0))
+    todo.reverse()
+
+    report = {
+        "n_files": len(jobs),
+        "n_done": 0,
+        "n_skipped": nSkipped,
+        "n_failed": 0,
+        "n_retries": 0,
+        "n_crashes": 0,
+        "n_frames": 0,
+        "input_bytes": 0,
+        "tray_wall_s": 0.0,
+        "tray_cpu_s": 0.0,
+        "n_workers": nWorkers,
+        "failed": [],
+    }
+
+    def finish(job, attempt, result):
+        nFrames, error, wall, cpu = result
+        if error is None:
+            report["n_done"] += 1
+            report["n_frames"] += int(nFrames or 0)
+            report["input_bytes"] += os.path.getsize(job["inputFile"])
+            report["tray_wall_s"] += wall
+            report["tray_cpu_s"] += cpu
+            metrics.inc("files_done")
+            metrics.inc("frames_written", int(nFrames or 0))
+            metrics.add_time("tray", wall, cpu)
+            print(
+                f"[{report['n_done'] + report['n_failed']}/{len(jobs) - nSkipped}] "
+                + f"Saved {job['outputFile']} ({wall:.1f} s)"
+            )
+        elif attempt < maxRetries:
+            report["n_retries"] += 1
+            metrics.inc("files_retried")
+            print(f"Retrying {job['inputFile']} ({attempt + 1}/{maxRetries}): {error}")
+            todo.append((job, attempt + 1))
+        else:
+            report["n_failed"] += 1
+            report["failed"].append({**job, "error": error})
+            metrics.inc("files_failed")
+            print(
+                f"[{report['n_done'] + report['n_failed']}/{len(jobs) - nSkipped}] "
+                + f"FAILED {job['inputFile']}: {error}"
+            )
+
+    wall0 = time.perf_counter()
+    pending = {}
+    # The jobs of a pool which broke with several jobs, run again one at a time
+    suspects = []
+    pool = executorClass(max_workers=nWorkers)
+    try:
+        while todo or suspects or pending:
+            if suspects:
+                if not pending:
+                    job, attempt = suspects.pop()
+                    pending[pool.submit(_run_job, runTray, job)] = (job, attempt)
+            else:
+                while todo and len(pending) < queueSize:
+                    job, attempt = todo.pop()
+                    pending[pool.submit(_run_job, runTray, job)] = (job, attempt)
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            lost = []
+            while done:
+                for future in done:
+                    job, attempt = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool:
+                        # A worker died (e.g. a segmentation fault in the tray), all the jobs
+                        # still in the pool are lost
+                        _remove(_part_fileName(job["outputFile"]))
+                        lost.append((job, attempt))
+                        continue
+                    finish(job, attempt, result)
+                # The other jobs of a broken pool end with BrokenProcessPool too
+                done = wait(pending)[0] if lost else set()
+
+            if lost:
+                report["n_crashes"] += 1
+                metrics.inc("pool_crashes")
+                if len(lost) == 1:
+                    job, attempt = lost[0]
+                    finish(
+                        job,
+                        attempt,
+                        (None, "BrokenProcessPool: a worker died", 0.0, 0.0),
+                    )
+                else:
+                    print(
+                        f"A worker died with {len(lost)} jobs in the pool, "
+                        + "running them again one at a time"
+                    )
+                    suspects.extend(reversed(lost))
+                pool.shutdown(wait=False)
+                pool = executorClass(max_workers=nWorkers)
+    finally:
+        pool.shutdown(wait=True)
+
+    wall = time.perf_counter() - wall0
+    report["wall_s"] = wall
+    report["files_per_s"] = report["n_done"] / wall if wall > 0 else 0.0
+    report["frames_per_s"] = report["n_frames"] / wall if wall > 0 else 0.0
+    report["input_MB_per_s"] = report["input_bytes"] / 1e6 / wall if wall > 0 else 0.0
+    report["mean_file_s"] = (
+        report["tray_wall_s"] / report["n_done"] if report["n_done"] else 0.0
+    )
+    # The fraction of the workers' time spent in the trays
+    report["worker_occupancy"] = (
+        report["tray_wall_s"] / (wall * nWorkers) if wall > 0 else 0.0
+    )
+    metrics.add_time("reprocessing", wall)
+    return report
+
+
+def print_report(report):
+    """
+    Print the throughput report of run_jobs.
+    """
+    print(
+        f"Processed {report['n_done']} of {report['n_files']} files "
+        + f"({report['n_skipped']} already done, {report['n_failed']} failed, "
+        + f"{report['n_retries']} retries, {report['n_crashes']} crashes) "
+        + f"in {report['wall_s']:.1f} s with {report['n_workers']} workers"
+    )
+    print(
+        f"{report['files_per_s']:.3f} files/s, {report['frames_per_s']:.1f} frames/s, "
+        + f"{report['input_MB_per_s']:.2f} MB/s, {report['mean_file_s']:.1f} s per file, "
+        + f"worker occupancy {report['worker_occupancy']:.0%}"
+    )
+    for failed in report["failed"]:
+        print(
+            f"Failed {failed['inputFile']} -> {failed['outputFile']}: {failed['error']}"
+        )
+    return
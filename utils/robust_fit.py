@@ -0,0 +1,193 @@
+"""
+__author__ = Federico Bontempo KIT PhD student <federico.bontempo@kit.edu>
+
+This script contains the robust refit of p0 and p1 on the stored charges
+(the slc_hlc_q_dict of readSave_HLC_SLC_charges.py or a charge store, see utils.charge_store).
+The fit of calculate_p0_p1 uses the sums of all the charges, so a few pathological hits
+can pull p0 and p1. Here the straight line hlc = p0 + p1 * slc is fitted k times, each time
+without the hits further than nSigma standard deviations of the residuals from the previous line.
+
+The (om, atwd) segments are fitted in chunks of consecutive segments, all the segments of a chunk
+at once: the charges of the chunk are converted to PE and concatenated in segment order
+(see utils.channel_index) and the sums of each segment are segmented reductions (np.add.reduceat).
+Only the charges of one chunk are in memory in PE, the stored (or spilled) charges are read chunk by chunk.
+The sums are centered on the mean of each segment, so chi2 can not come out negative.
+The stored charges do not know their chip, so the results are those of the sum of the two chips (chip 2).
+
+Functions:
+    iterate_segmentChunks: Yields the stored charges in segment order, chunk by chunk.
+    robust_fit: Fits all the segments with k rounds of sigma clipping.
+    save_robustFit: Saves the results in a npz file.
+"""
+
+import numpy as np
+
+from utils.charge_store import charges_to_pe
+from utils.channel_index import (
+    DOM_SHAPE,
+    N_ATWDS,
+    N_SEGMENTS,
+    omkey_to_dom,
+)
+
+# Maximum number of charges of a chunk (a segment with more charges is a chunk by itself)
+CHUNK_SIZE = 1 << 22
+
+
+def iterate_segmentChunks(slc_hlc_q_dict, chunkSize=CHUNK_SIZE):
+    """
+    Yield the slc and hlc charges (in PE) of the (om, atwd) segments in segment order,
+    concatenated in chunks of consecutive segments with at most chunkSize charges.
+    ----------------------------------
+    Parameters:
+        slc_hlc_q_dict: A dictionary of OMKeys (or (string, om) tuples) with a (2, n) array
+            of slc and hlc charges for each ATWD.
+        chunkSize: The maximum number of charges of a chunk.
+    Yields:
+        first: The first segment of the chunk.
+        x: The slc charges of the chunk.
+        y: The hlc charges of the chunk.
+        lengths: The number of charges of each segment of the chunk.
+    """
+    segments = [None] * N_SEGMENTS
+    for omkey, atwd_dict in slc_hlc_q_dict.items():
+        dom = omkey_to_dom(omkey)
+        for atwd in range(N_ATWDS):
+            segments[dom * N_ATWDS + atwd] = atwd_dict[f"atwd{atwd}"]
+    lengths = np.array(
+        [0 if segment is None else segment.shape[1] for segment in segments],
+        dtype=np.int64,
+    )
+
+    first = 0
+    while first < N_SEGMENTS:
+        # At least one segment, then as many as fit in chunkSize
+        last = first + 1
+        total = lengths[first]
+        while last < N_SEGMENTS and total + lengths[last] <= chunkSize:
+            total += lengths[last]
+            last += 1
+        chunk = [
+            charges_to_pe(segment)
+            for segment in segments[first:last]
+            if segment is not None and segment.shape[1]
+        ]
+        charges = np.concatenate(chunk, axis=1) if chunk else np.empty((2, 0))
+        yield first, charges[0], charges[1], lengths[first:last]
+        first = last
+
+
+def _segment_sums(values, starts, filled):
+    """Return the sum of values over each segment, 0 for the empty segments"""
+    sums = np.zeros(len(filled))
+    if len(values):
+        sums[filled] = np.add.reduceat(values, starts)
+    return sums
+
+
+def _fit_chunk(x, y, lengths, nRounds, nSigma):
+    """
+    Fit the segments of a chunk with nRounds of sigma clipping (see robust_fit).
+    Returns the arrays of the segments of the chunk and the number of rounds.
+    """
+    filled = lengths > 0
+    starts = (np.cumsum(lengths) - lengths)[filled]
+    segmentLengths = lengths[filled]
+
+    used = np.ones(len(x), dtype=bool)
+    rounds = 0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        while True:
+            w = used.astype(np.float64)
+            n = _segment_sums(w, starts, filled)
+            mx = _segment_sums(w * x, starts, filled) / n
+            my = _segment_sums(w * y, starts, filled) / n
+            dx = x - np.repeat(mx[filled], segmentLengths)
+            dy = y - np.repeat(my[filled], segmentLengths)
+            sxx = _segment_sums(w * dx * dx, starts, filled)
+            sxy = _segment_sums(w * dx * dy, starts, filled)
+            syy = _segment_sums(w * dy * dy, starts, filled)
+
+            valid = (n > 1) & (sxx > 0)
+            p1 = np.where(valid, sxy / sxx, np.nan)
+            p0 = my - p1 * mx
+            chi2 = np.where(valid, np.maximum(syy - p1 * sxy, 0.0), np.nan)
+            sigma = np.sqrt(np.where(n > 2, chi2 / (n - 2), np.nan))
+
+            if rounds == nRounds:
+                break
+            residuals = (
+                y
+                - np.repeat(p0[filled], segmentLengths)
+                - np.repeat(p1[filled], segmentLengths) * x
+            )
+            # The segments without a valid fit (nan residuals) or with all the hits
+            # on the line (sigma = 0) keep all their hits
+            threshold = np.repeat(
+                np.where(sigma > 0, nSigma * sigma, np.inf)[filled], segmentLengths
+            )
+            newUsed = ~(np.abs(residuals) > threshold)
+            rounds += 1
+            if np.array_equal(newUsed, used):
+                break
+            used = newUsed
+
+        fit = {
+            "n_used": n,
+            "clipped_fraction": np.where(filled, 1.0 - n / lengths, np.nan),
+            "p0": p0,
+            "p1": p1,
+            "p0_error": sigma * np.sqrt(1.0 / n + mx**2 / sxx),
+            "p1_error": sigma / np.sqrt(sxx),
+            "chi2": chi2,
+        }
+    return fit, rounds
+
+
+def robust_fit(slc_hlc_q_dict, nRounds=3, nSigma=3.0, chunkSize=CHUNK_SIZE):
+    """
+    Fit hlc = p0 + p1 * slc for all the (om, atwd) segments with nRounds of sigma clipping.
+    In each round the hits with |residual| > nSigma * sigma of the previous fit are excluded
+    (a hit excluded once can come back if the line moves). The clipping of a chunk stops earlier
+    if no hit of the chunk changes (the next rounds would not change its fits).
+    ----------------------------------
+    Parameters:
+        slc_hlc_q_dict: A dictionary of OMKeys with a (2, n) array of slc and hlc charges for each ATWD.
+        nRounds: The maximum number of clipping rounds (0 is the plain least squares).
+        nSigma: The clipping threshold in standard deviations of the residuals.
+        chunkSize: The maximum number of charges fitted at once (see iterate_segmentChunks).
+    Returns:
+        robust: A dictionary of (81, 4, 3) arrays indexed by [string - 1, om - 61, atwd]:
+            n: the number of charges
+            n_used: the number of charges of the last fit
+            clipped_fraction: the fraction of clipped charges (nan for the empty segments)
+            p0, p1, p0_error, p1_error, chi2: the last fit (nan if it is not possible,
+                the errors are nan if n_used <= 2)
+            and nRounds: the largest number of rounds which were done.
+    """
+    lengths = np.zeros(N_SEGMENTS, dtype=np.int64)
+    results = {}
+    rounds = 0
+    for first, x, y, chunkLengths in iterate_segmentChunks(slc_hlc_q_dict, chunkSize):
+        last = first + len(chunkLengths)
+        lengths[first:last] = chunkLengths
+        fit, chunkRounds = _fit_chunk(x, y, chunkLengths, nRounds, nSigma)
+        for name, values in fit.items():
+            results.setdefault(name, np.empty(N_SEGMENTS))[first:last] = values
+        rounds = max(rounds, chunkRounds)
+
+    shape = DOM_SHAPE + (N_ATWDS,)
+    robust = {"n": lengths.reshape(shape)}
+    robust["n_used"] = results.pop("n_used").astype(np.int64).reshape(shape)
+    for name, values in results.items():
+        robust[name] = values.reshape(shape)
+    robust["nRounds"] = rounds
+    return robust
+
+
+def save_robustFit(robust, fileName, nSigma):
+    """
+    Save the results of robust_fit in a compressed npz file (with nSigma).
+    """
+    np.savez_compressed(fileName, nSigma=nSigma, **robust)
+    return
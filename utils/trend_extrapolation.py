@@ -0,0 +1,203 @@
+"""
+__author__ = Federico Bontempo KIT PhD student <federico.bontempo@kit.edu>
+
+This script contains the functions to extrapolate the SLC calibration to future years
+from the calibrations of several past years, taking the aging of the detector into account.
+
+All the calibrations are stacked in (year, string, om, chip, atwd) arrays and a straight line
+is fitted to every channel at once, using the closed form of the weighted least squares
+(missing or invalid years have weight 0). The extrapolated values and their prediction
+errors are returned as calibration artifacts (see utils.calibration_artifact).
+
+Functions:
+    mjd_to_year: Converts a modified julian day in a fractional year.
+    year_to_mjd: Returns the modified julian day of the middle of a year.
+    stack_calibrationSets: Stacks the calibration artifacts of several years.
+    fit_trends: Fits a straight line along the first axis for all the channels at once.
+    evaluate_trends: Evaluates the fitted lines and their prediction errors.
+    extrapolate_calibrations: Creates the extrapolated calibration artifacts.
+"""
+
+import datetime
+import numpy as np
+
+from utils.calibration_artifact import ARTIFACT_FORMAT, ARTIFACT_VERSION, valid_fits
+
+MJD_EPOCH = datetime.date(1858, 11, 17)
+
+
+def mjd_to_year(mjd):
+    """
+    Convert a modified julian day (or an array of them) in a fractional year.
+    """
+    return 2000.0 + (np.asarray(mjd, dtype=np.float64) - 51544.5) / 365.25
+
+
+def year_to_mjd(year, month=7, day=2):
+    """
+    Return the modified julian day of a date of the year (default is the middle of the year).
+    """
+    return float((datetime.date(int(year), month, day) - MJD_EPOCH).days)
+
+
+def stack_calibrationSets(artifacts, years=None):
+    """
+    Stack the calibration artifacts of several years in (year, string, om, chip, atwd) arrays.
+    ----------------------------------
+    Parameters:
+        artifacts: A list of calibration artifacts.
+        years: The fractional year of each artifact (default is the middle of its time range,
+            or the middle of its year if the artifact has no times).
+    Returns:
+        stack: A dictionary with:
+            x: (n_years,) the fractional year of each calibration
+            p0, p1: (n_years, 81, 4, 3, 3) the fit results
+            n: (n_years, 81, 4, 3, 3) the number of charges of the fit
+            fit_valid: (n_years, 81, 4, 3, 3) the fit results can be used
+            crossover: (n_years, 81, 4, 2) the crossover points
+            crossover_valid: (n_years, 81, 4, 2) the crossover points can be used
+    """
+    if years is None:
+        years = []
+        for artifact in artifacts:
+            metadata = artifact["metadata"]
+            mjd = 0.5 * (
+                metadata.get("startMJD", np.nan) + metadata.get("endMJD", np.nan)
+            )
+            if np.isfinite(mjd):
+                years.append(float(mjd_to_year(mjd)))
+            elif metadata.get("year", 0) != 0:
+                years.append(metadata["year"] + 0.5)
+            else:
+                raise ValueError(
+                    "A calibration has neither times nor year, give its year"
+                )
+
+    stack = {"x": np.asarray(years, dtype=np.float64)}
+    for name in ("p0", "p1", "n", "crossover"):
+        stack[name] = np.stack([artifact[name] for artifact in artifacts])
+
+    # A fit with n <= 2 has no errors and p0 = p1 = 0 if delta <= 0
+    stack["fit_valid"] = np.stack([valid_fits(a, minN=2) for a in artifacts])
+    stack["crossover_valid"] = np.stack([a["has_crossover"] for a in artifacts])[
+        ..., np.newaxis
+    ] & np.isfinite(stack["crossover"])
+    return stack
+
+
+def fit_trends(x, y, valid):
+    """
+    Fit y = a + b * (x - xm) along the first axis for all the channels at once
+    with the closed form of the least squares (the invalid entries have weight 0).
+    ----------------------------------
+    Parameters:
+        x: (n_years,) the fractional years.
+        y: (n_years, ...) the values of each channel.
+        valid: (n_years, ...) the entries used in the fit.
+    Returns:
+        trend: A dictionary with the arrays (...) of the channels:
+            a: the value at the mean year xm of the channel
+            b: the slope per year (0 if the channel has a single year)
+            xm: the mean year of the valid entries
+            sxx: the sum of the squared centered years
+            sigma: the standard deviation of the residuals (nan with less than 3 years)
+            count: the number of valid years
+    """
+    w = valid.astype(np.float64)
+    y = np.where(valid, y, 0.0)
+    xb = x.reshape((-1,) + (1,) * (y.ndim - 1))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        count = w.sum(axis=0)
+        xm = (w * xb).sum(axis=0) / count
+        dx = np.where(valid, xb - xm, 0.0)
+        ym = (w * y).sum(axis=0) / count
+        sxx = (dx * dx).sum(axis=0)
+        sxy = (dx * (y - ym)).sum(axis=0)
+        b = np.where(sxx > 0, sxy / sxx, 0.0)
+        residuals = np.where(valid, y - ym - b * dx, 0.0)
+        sigma = np.where(
+            count > 2, np.sqrt((residuals**2).sum(axis=0) / (count - 2)), np.nan
+        )
+
+    return {"a": ym, "b": b, "xm": xm, "sxx": sxx, "sigma": sigma, "count": count}
+
+
+def evaluate_trends(trend, x0):
+    """
+    Evaluate the fitted lines at the year x0.
+    ----------------------------------
+    Parameters:
+        trend: The dictionary returned by fit_trends.
+        x0: The fractional year.
+    Returns:
+        value: The extrapolated values (nan for the channels without valid years).
+        error: The standard error of the prediction (nan with less than 3 years).
+    """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        dx0 = x0 - trend["xm"]
+        value = trend["a"] + trend["b"] * dx0
+        leverage = 1.0 / trend["count"] + np.where(
+            trend["sxx"] > 0, dx0**2 / trend["sxx"], 0.0
+        )
+        error = trend["sigma"] * np.sqrt(leverage)
+    return value, error
+
+
+def extrapolate_calibrations(artifacts, targetYears, years=None, sources=()):
+    """
+    Extrapolate the p0, p1 and crossover points of all the channels to the target years.
+    ----------------------------------
+    Parameters:
+        artifacts: A list of calibration artifacts of past years.
+        targetYears: The years of the extrapolated calibrations.
+        years: The fractional year of each artifact (see stack_calibrationSets).
+        sources: The names of the input calibrations, saved in the metadata.
+    Returns:
+        extrapolated: A list of calibration artifacts, one for each target year.
+            p0_error and p1_error are the prediction errors of the trends, chi2 is nan.
+            n is the sum of the number of charges of the fits, or the number of calibrations
+            of the trend if an input has no number of charges (metadata fitCounts false).
+            Only the OMs with a trend for all their channels have a fit.
+    """
+    stack = stack_calibrationSets(artifacts, years)
+    p0Trend = fit_trends(stack["x"], stack["p0"], stack["fit_valid"])
+    p1Trend = fit_trends(stack["x"], stack["p1"], stack["fit_valid"])
+    copTrend = fit_trends(stack["x"], stack["crossover"], stack["crossover_valid"])
+    # The number of charges of the fits, or the number of calibrations of the trend
+    # if an input has no number of charges (e.g. a Level3 pickle), so that n > 1 is still a usable fit
+    fitCounts = all(a["metadata"].get("fitCounts", True) for a in artifacts)
+    if fitCounts:
+        nSum = np.where(stack["fit_valid"], stack["n"], 0).sum(axis=0)
+    else:
+        nSum = p0Trend["count"]
+
+    extrapolated = []
+    for targetYear in targetYears:
+        x0 = targetYear + 0.5
+        artifact = {"n": nSum.astype(np.int64)}
+        artifact["p0"], artifact["p0_error"] = evaluate_trends(p0Trend, x0)
+        artifact["p1"], artifact["p1_error"] = evaluate_trends(p1Trend, x0)
+        artifact["chi2"] = np.full_like(artifact["p0"], np.nan)
+        artifact["crossover"], _ = evaluate_trends(copTrend, x0)
+
+        # An OM has a fit only if all its channels have a trend (as for the crossover points)
+        artifact["has_fit"] = (p0Trend["count"] > 0).all(axis=(-2, -1))
+        artifact["has_crossover"] = (copTrend["count"] > 0).all(axis=-1)
+        artifact["crossover"][~artifact["has_crossover"]] = np.nan
+
+        artifact["metadata"] = {
+            "format": ARTIFACT_FORMAT,
+            "version": ARTIFACT_VERSION,
+            "runNumb": 0,
+            "year": int(targetYear),
+            "startMJD": year_to_mjd(targetYear, 1, 1),
+            "endMJD": year_to_mjd(targetYear + 1, 1, 1),
+            "recordingStartTime": "",
+            "recordingStopTime": "",
+            "extrapolatedFrom": list(sources),
+            "extrapolatedFromYears": stack["x"].tolist(),
+            "fitCounts": fitCounts,
+        }
+        extrapolated.append(artifact)
+    return extrapolated
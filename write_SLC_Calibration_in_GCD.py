@@ -9,11 +9,27 @@ __author__ = Federico Bontempo KIT PhD student <federico.bontempo@kit.edu>
 How to run:
 env-shell.sh python3 write_SLC_Calibration_in_GCD.py \
     --GCD <GCD path> \
-    --chargesSumsFile <SLC calibration .pkl path> \
+    --calibrationArtifact <Run{runNumb}_{year}_SLCCalibration.npz path> \
     --outputFile <output path + name + .i3.gz> \
     --startTime <start time> \
     --endTime <end time>
 
+The calibration artifact is written by readSave_HLC_SLC_charges.py --saveArtifact
+and already contains the p0, p1 and crossover points, so nothing is refitted.
+The old inputs (--chargesSumsFile and --crossOverPointsFile) can still be used instead.
+
+Batch mode, for many run-specific GCD files with the same calibration:
+env-shell.sh python3 write_SLC_Calibration_in_GCD.py \
+    --calibrationArtifact <Run{runNumb}_{year}_SLCCalibration.npz path> \
+    --manifest <manifest .jsonl path> \
+    --nWorkers <number of processes>
+
+Each line of the manifest is a json dictionary:
+    {"GCD": <GCD path>, "outputFile": <output path>, "startTime": <start time>, "endTime": <end time>}
+The calibrations are built once per worker, a failing GCD file does not stop the others.
+If a worker dies, the GCD files which were in the pool are written again one at a time,
+a GCD file is failed only if its worker dies when it is alone in the pool.
+
 TODO: 
     1. Check if the script is consistent with the readSave_... script
     2. Add the SetCrossOver and GetCrossOver methods to:
@@ -23,17 +39,38 @@ TODO:
 
 import argparse
 import json
+import os
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
 
 from icecube import icetray, dataio, dataclasses
 
-from utils.calculate_p0_p1 import calculate_p0_p1
-from utils.utils import tuple_to_str, str_to_tuple
+from utils.calculate_p0_p1 import fit_channels, sums_from_dict
+from utils.calibration_artifact import load_calibrationArtifact
+from utils.channel_index import (
+    DOM_SHAPE,
+    N_ATWDS,
+    N_CHIPS,
+    N_DOMS,
+    bad_dom_mask,
+    dom_from_index,
+    omkey_to_dom,
+)
 
 
 def get_args():
     p = argparse.ArgumentParser()
     p.add_argument("--GCD", type=str, default="", help="GCD path")
+    p.add_argument(
+        "--calibrationArtifact",
+        type=str,
+        default="",
+        help="SLC calibration artifact .npz path (replaces the .json files)",
+    )
     p.add_argument(
         "--chargesSumsFile", type=str, default="", help="SLC calibration .json path"
     )
@@ -51,20 +88,42 @@ def get_args():
     )
     p.add_argument("--startTime", type=float, default=0.0, help="Start time")
     p.add_argument("--endTime", type=float, default=0.0, help="End time")
+    p.add_argument(
+        "--manifest",
+        type=str,
+        default="",
+        help="Batch manifest .jsonl with GCD, outputFile, startTime and endTime per line",
+    )
+    p.add_argument(
+        "--nWorkers",
+        type=int,
+        default=0,
+        help="Number of worker processes in batch mode (default: number of cores)",
+    )
 
     return p.parse_args()
 
 
 def __check_args(args):
+    if args.manifest != "":
+        # The GCD, output and times are given in the manifest
+        if args.calibrationArtifact == "":
+            print("The batch mode needs a calibration artifact")
+            sys.exit(1)
+        if not os.path.exists(args.manifest):
+            print(f"Manifest {args.manifest} does not exist")
+            sys.exit(1)
+        return
     if args.GCD == "":
         print("No GCD file given")
         sys.exit(1)
-    if args.chargesSumsFile == "":
-        print("No SLC calibration file given")
-        sys.exit(1)
-    if args.crossOverPointsFile == "":
-        print("No crossover points file given")
-        sys.exit(1)
+    if args.calibrationArtifact == "":
+        if args.chargesSumsFile == "":
+            print("No SLC calibration file given")
+            sys.exit(1)
+        if args.crossOverPointsFile == "":
+            print("No crossover points file given")
+            sys.exit(1)
     if args.outputFile == "":
         print("No output file name given")
         sys.exit(1)
@@ -77,175 +136,382 @@ def __check_args(args):
     return
 
 
+def build_SLCCalibrations(artifact):
+    """
+    Create the I3IceTopSLCCalibration of every OM directly from the calibration artifact.
+    The intercepts, slopes and crossover points are read from the dense arrays,
+    nothing is refitted.
+    ----------------------------------
+    Parameters:
+        artifact: The calibration artifact (see utils.calibration_artifact).
+    Returns:
+        calibrations: A list with the I3IceTopSLCCalibration of each dom index
+            (see utils.channel_index), None for the OMs without fit results.
+    """
+    # Python lists are much faster to index than NumPy arrays element by element
+    p0 = artifact["p0"].reshape(N_DOMS, N_CHIPS, N_ATWDS).tolist()
+    p1 = artifact["p1"].reshape(N_DOMS, N_CHIPS, N_ATWDS).tolist()
+    crossover = artifact["crossover"].reshape(N_DOMS, 2).tolist()
+    has_crossover = artifact["has_crossover"].reshape(N_DOMS).tolist()
+
+    calibrations = [None] * N_DOMS
+    for dom in np.flatnonzero(artifact["has_fit"]).tolist():
+        calibration = dataclasses.I3IceTopSLCCalibration()
+        for chip in range(2):
+            for atwd in range(3):
+                calibration.SetIntercept(chip, atwd, p0[dom][chip][atwd])
+                calibration.SetSlope(chip, atwd, p1[dom][chip][atwd])
+
+        if has_crossover[dom]:
+            # The crossover points of the artifact are already in PE
+            cop01, cop12 = crossover[dom]
+            calibration.SetCrossOver(1, cop01)
+            calibration.SetCrossOver(12, cop12)
+        else:
+            # Give a run warning
+            RuntimeWarning(
+                f"OMKey {dom_from_index(dom)} has less than 3 ATWDs with charges. Probably something is broken."
+            )
+
+        calibrations[dom] = calibration
+    return calibrations
+
+
+def make_SLCCalibrationCollection(calibrations, bad_dom_list, startTime, endTime):
+    """
+    Create the I3IceTopSLCCalibrationCollection from already built calibrations,
+    only the bad DOMs and the time range change between GCD files.
+    ----------------------------------
+    Parameters:
+        calibrations: The list of I3IceTopSLCCalibration of each dom index (see build_SLCCalibrations).
+        bad_dom_list: A list of bad DOMs which are not calibrated.
+        startTime: Start time of the calibration.
+        endTime: End time of the calibration.
+    Returns:
+        calibration_collection: The I3IceTopSLCCalibrationCollection.
+    """
+    calibration_collection = dataclasses.I3IceTopSLCCalibrationCollection()
+    calibration_collection.start_time = dataclasses.I3Time(startTime)  # TODO check time
+    calibration_collection.end_time = dataclasses.I3Time(endTime)  # TODO check time
+
+    # e.g. 2022 dead DOMs "OMKey(74,61,0)" and "OMKey(39,61,0)" are not calibrated
+    bad_doms = bad_dom_mask(bad_dom_list)
+    for dom, calibration in enumerate(calibrations):
+        if calibration is None or bad_doms[dom]:
+            continue
+        calibration_collection.it_slc_cal[icetray.OMKey(*dom_from_index(dom))] = (
+            calibration
+        )
+    return calibration_collection
+
+
+def artifact_fromJson(chargesSums_dict, crossOverPoints):
+    """
+    Create a calibration artifact from the json files of the charge sums and of the crossover points,
+    the p0 and p1 values are fitted from the sums.
+    ----------------------------------
+    Parameters:
+        chargesSums_dict: A dictionary {"string,om": {"chip0atwd0": {"n": ..., "x": ...}, ...}}.
+        crossOverPoints: A dictionary {"string,om": (log10 crossover 0-1, log10 crossover 1-2)}.
+    Returns:
+        artifact: The arrays of the calibration artifact used by build_SLCCalibrations.
+    """
+    fit = fit_channels(sums_from_dict(chargesSums_dict))
+    artifact = {"p0": fit["p0"], "p1": fit["p1"]}
+    artifact["has_fit"] = np.zeros(DOM_SHAPE, dtype=bool)
+    artifact["has_fit"].flat[[omkey_to_dom(k) for k in chargesSums_dict]] = True
+
+    artifact["crossover"] = np.full(DOM_SHAPE + (2,), np.nan)
+    artifact["has_crossover"] = np.zeros(DOM_SHAPE, dtype=bool)
+    for omkey, (cop01, cop12) in crossOverPoints.items():
+        dom = omkey_to_dom(omkey)
+        artifact["crossover"].reshape(N_DOMS, 2)[dom] = (10**cop01, 10**cop12)
+        artifact["has_crossover"].flat[dom] = True
+    return artifact
+
+
 def write_SLC_Calibration_in_Cframe(args, frame, bad_dom_list):
     # This is the calibration frame
-    # Load SLC calibration
-    with open(args.chargesSumsFile, "r") as f:
-        chargesSums_dict = json.load(f)
+    if args.calibrationArtifact != "":
+        artifact = load_calibrationArtifact(args.calibrationArtifact)
+    else:
+        # Load SLC calibration
+        with open(args.chargesSumsFile, "r") as f:
+            chargesSums_dict = json.load(f)
+            """
+            chargesSums_dict is a dictionary with the following structure:
+            chargesSums_dict = {
+                (OMKey): {
+                    "chip0atwd0": {
+                        "n": int,
+                        "x": float,
+                        "xx": float,
+                        "y": float,
+                        "yy": float,
+                        "xy": float,
+                    },
+                    ... so on for 0, 1 chip and 0, 1, 2 atwd
+                }
+            """
+
+        # Load crossover points
+        with open(args.crossOverPointsFile, "r") as f:
+            crossOverPoints = json.load(f)
         """
-        slc_calibration_dict is a dictionary with the following structure:
+        crossOverPoints_dict is a dictionary with the following structure:
         {
             (OMKey): (
-                array([float, float, ... float]), # time
-                array([float, float, ... float]), # intercepts
-                array([float, float, ... float]), # slopes
-            )
-            (OMKey): (
-                array([float, float, ... float]), # time
-                array([float, float, ... float]), # intercepts
-                array([float, float, ... float]), # slopes
+                float, # log10 crossover point 0-1
+                float, # log10 crossover point 1-2
             )
             ...
         }
         """
-        """
-        chargesSums_dict is a dictionary with the following structure:
-        chargesSums_dict = {
-            (OMKey): {
-                "chip0atwd0": {
-                    "n": int,
-                    "x": float,
-                    "xx": float,
-                    "y": float,
-                    "yy": float,
-                    "xy": float,
-                },
-                "chip0atwd1": {
-                    "n": int,
-                    "x": float,
-                    "xx": float,
-                    "y": float,
-                    "yy": float,
-                    "xy": float,
-                },
-                ... so on for 0, 1 chip and 0, 1, 2 atwd
-            }
-        """
+        artifact = artifact_fromJson(chargesSums_dict, crossOverPoints)
+
+    frame["I3IceTopSLCCalibrationCollection"] = make_SLCCalibrationCollection(
+        build_SLCCalibrations(artifact), bad_dom_list, args.startTime, args.endTime
+    )
+    return frame
+
+
+def get_bad_dom_list(frame):
+    """Get the list of bad DOMs from the GCD file"""
+    # Get the IceTopBadDOMs from the frame
+    bad_dom_list = list(frame["IceTopBadDOMs"])
+    return bad_dom_list
 
-    # Load crossover points
-    with open(args.crossOverPointsFile, "r") as f:
-        crossOverPoints = json.load(f)
+
+def stream_GCD_frames(frames, write_Cframe):
     """
-    crossOverPoints_dict is a dictionary with the following structure:
-    {
-        (OMKey): (
-            float, # crossover point 0-1
-            float, # crossover point 1-2
-        )
-        (OMKey): (
-            float, # crossover point 0-1
-            float, # crossover point 1-2
-        )
-        ...
-    }
+    Add the SLC calibration to every calibration frame of a stream of frames
+    and yield the frames in their original order as soon as possible.
+    A C frame needs the IceTopBadDOMs of its D frame. If no D frame has been seen yet,
+    the C frame (and the frames after it) are held until the next D frame arrives.
+    If a D frame has already been seen, the C frame waits only for the next frame:
+    if that is its D frame the new bad DOMs are used, otherwise the previous ones.
+    This works for multi G/C/D files and for GCD files merged with data files.
+    ----------------------------------
+    Parameters:
+        frames: An iterable of I3Frames (e.g. a dataio.I3File).
+        write_Cframe: A function (frame, bad_dom_list) -> frame which adds the SLC calibration.
+    Yields:
+        frame: The frames in their original order, with the SLC calibration in the C frames.
     """
+    bad_dom_list = None  # bad DOMs of the last D frame
+    pending = []  # the C frames waiting for their D frame and the frames after them
 
-    # Create an instance of the I3IceTopSLCCalibrationCollection
-    calibration_collection = dataclasses.I3IceTopSLCCalibrationCollection()
+    def flush(bad_dom_list):
+        for frame in pending:
+            if frame.Stop == icetray.I3Frame.Calibration:
+                frame = write_Cframe(frame, bad_dom_list)
+            yield frame
+        pending.clear()
 
-    p0_p1_dict = calculate_p0_p1(chargesSums_dict, bad_dom_list=bad_dom_list)
-    for omkey, chipATWdict in p0_p1_dict.items():
-        calibration = dataclasses.I3IceTopSLCCalibration()
+    for frame in frames:
+        if frame.Stop == icetray.I3Frame.DetectorStatus and "IceTopBadDOMs" in frame:
+            # This is the detector status frame which the pending C frames need
+            bad_dom_list = get_bad_dom_list(frame)
+            yield from flush(bad_dom_list)
+            yield frame
+        elif pending and bad_dom_list is None:
+            # No D frame yet: hold the frames until it arrives
+            pending.append(frame)
+        else:
+            # The pending C frame has no D frame right after it, use the previous one
+            if pending:
+                yield from flush(bad_dom_list)
+            if frame.Stop == icetray.I3Frame.Calibration:
+                pending.append(frame)
+            else:
+                yield frame
 
-        string, om = str_to_tuple(omkey)
-
-        # Populate the calibration collection with the loaded SLC calibration values
-        for chipATWkey, calibration_values in chipATWdict.items():
-            # Eg. chipATWkey = "chip0atwd0"
-            # We want to get the chip and atwd values
-            chipATWlist = chipATWkey.replace("chip", "").replace("atwd", ",")
-            chip, atwd = str_to_tuple(chipATWlist)
-            # Get the calibration values
-            interceptsCalibration = calibration_values["p0"]
-            slopesCalibration = calibration_values["p1"]
-
-            # Set the intercept and slope of the calibration
-            calibration.SetIntercept(
-                int(chip),
-                int(atwd),
-                float(interceptsCalibration),
-            )
-            calibration.SetSlope(
-                int(chip),
-                int(atwd),
-                float(slopesCalibration),
-            )
+    if pending:
+        if bad_dom_list is None:
+            raise RuntimeError("No D frame with IceTopBadDOMs found for the C frame")
+        yield from flush(bad_dom_list)
 
-        # make omkey the propper OMKey
-        omkey = icetray.OMKey(int(string), int(om))
 
-        # Check if the OMKey is not dead
-        if omkey in bad_dom_list:
-            # e.g. 2022 dead DOMs "OMKey(74,61,0)" and "OMKey(39,61,0)"
-            continue
-        elif tuple_to_str(omkey) in crossOverPoints.keys():
-            # Get the crossover values
-            cop01, cop12 = crossOverPoints[tuple_to_str(omkey)]
-            # Set the crossover for unknown chip and unknown atwd
-            calibration.SetCrossOver(
-                int(1),
-                float(10 ** (cop01)),
-            )
-            calibration.SetCrossOver(
-                int(12),
-                float(10 ** (cop12)),
+def write_GCD(gcdFile, outputFile, write_Cframe):
+    """
+    Copy the GCD file (or a GCD file merged with data) frame by frame
+    and add the SLC calibration to its calibration frames.
+    ----------------------------------
+    Parameters:
+        gcdFile: Path of the input GCD file.
+        outputFile: Path of the output GCD file.
+        write_Cframe: A function (frame, bad_dom_list) -> frame which adds the SLC calibration.
+    """
+    # Load GCD file
+    gcd_file = dataio.I3File(gcdFile)
+    # Create the new GCD file
+    gcd_file_out = dataio.I3File(outputFile, "w")
+    for frame in stream_GCD_frames(gcd_file, write_Cframe):
+        gcd_file_out.push(frame)
+
+    gcd_file_out.close()
+    gcd_file.close()
+    return
+
+
+def load_manifest(manifestFile):
+    """
+    Load the batch manifest. Each line is a json dictionary with the
+    "GCD", "outputFile", "startTime" and "endTime" of one GCD file.
+    ----------------------------------
+    Parameters:
+        manifestFile: Path of the manifest (.jsonl).
+    Returns:
+        entries: A list of dictionaries, one for each GCD file.
+    """
+    entries = []
+    with open(manifestFile, "r") as f:
+        for lineNumb, line in enumerate(f, start=1):
+            if line.strip() == "" or line.lstrip().startswith("#"):
+                continue
+            entry = json.loads(line)
+            for key in ("GCD", "outputFile", "startTime", "endTime"):
+                if key not in entry:
+                    raise ValueError(f"{manifestFile}:{lineNumb} has no {key}")
+            entries.append(entry)
+    return entries
+
+
+# The calibrations of each worker process, built once by __init_worker
+_worker_calibrations = None
+
+
+def __init_worker(artifactFile):
+    global _worker_calibrations
+    _worker_calibrations = build_SLCCalibrations(load_calibrationArtifact(artifactFile))
+
+
+def _write_GCD_fromManifest(entry):
+    """
+    Write the GCD file of one manifest entry in a worker process.
+    A failure is returned instead of raised, so the other GCD files are not affected.
+    """
+    startTime = float(entry["startTime"])
+    endTime = float(entry["endTime"])
+
+    def write_Cframe(frame, bad_dom_list):
+        frame["I3IceTopSLCCalibrationCollection"] = make_SLCCalibrationCollection(
+            _worker_calibrations, bad_dom_list, startTime, endTime
+        )
+        return frame
+
+    t0 = time.perf_counter()
+    try:
+        write_GCD(entry["GCD"], entry["outputFile"], write_Cframe)
+    except Exception as e:
+        # Do not leave a truncated GCD file behind
+        if os.path.exists(entry["outputFile"]):
+            os.remove(entry["outputFile"])
+        return entry, f"{type(e).__name__}: {e}", time.perf_counter() - t0
+    return entry, None, time.perf_counter() - t0
+
+
+def run_batch(args):
+    """
+    Write the SLC calibration in all the GCD files of the manifest.
+    The calibrations are built once per worker process from the calibration artifact,
+    only the bad DOMs and the time range are changed for each GCD file.
+    ----------------------------------
+    Parameters:
+        args: Command-line arguments.
+    Returns:
+        failed: A list of (entry, error) of the GCD files which could not be written.
+    """
+    entries = load_manifest(args.manifest)
+    nWorkers = args.nWorkers if args.nWorkers > 0 else os.cpu_count()
+    print(f"Writing {len(entries)} GCD files with {nWorkers} workers")
+
+    def new_pool():
+        return ProcessPoolExecutor(
+            max_workers=nWorkers,
+            initializer=__init_worker,
+            initargs=(args.calibrationArtifact,),
+        )
+
+    failed = []
+    nFinished = 0
+
+    def finish(entry, error, duration):
+        nonlocal nFinished
+        nFinished += 1
+        if error is None:
+            print(
+                f"[{nFinished}/{len(entries)}] Saved {entry['outputFile']} ({duration:.1f} s)"
             )
         else:
-            # Give a run warning
-            RuntimeWarning(
-                f"OMKey {omkey} has less than 3 ATWDs with charges. Probably something is broken."
-            )
+            print(f"[{nFinished}/{len(entries)}] FAILED {entry['GCD']}: {error}")
+            failed.append((entry, error))
 
-        # Set the start and end time of the calibration
-        calibration_collection.start_time = dataclasses.I3Time(
-            args.startTime
-        )  # TODO check time
-        calibration_collection.end_time = dataclasses.I3Time(
-            args.endTime
-        )  # TODO check time
-        # make omkey the propper OMKey
-        # omkey = icetray.OMKey(int(string), int(om))
-        # Add the calibration to the collection
-        calibration_collection.it_slc_cal[omkey] = calibration
-
-    # Add the I3IceTopSLCCalibrationCollection to the frame
-    frame["I3IceTopSLCCalibrationCollection"] = calibration_collection
-    return frame
+    # The entries submitted together: all of them, then one at a time the entries
+    # of a pool which broke (it is not known which GCD file killed the worker)
+    batches = [entries]
+    pool = new_pool()
+    try:
+        while batches:
+            batch = batches.pop()
+            futures = {}
+            lost = []
+            for entry in batch:
+                try:
+                    futures[pool.submit(_write_GCD_fromManifest, entry)] = entry
+                except BrokenProcessPool:
+                    lost.append(entry)
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    # A worker died (e.g. a segmentation fault or the OOM killer)
+                    # or the initializer failed, the entries still in the pool are lost
+                    lost.append(futures[future])
+                    continue
+                finish(*result)
+            if not lost:
+                continue
 
+            for entry in lost:
+                # Do not leave a truncated GCD file behind
+                if os.path.exists(entry["outputFile"]):
+                    os.remove(entry["outputFile"])
+            if len(lost) == 1:
+                finish(lost[0], "BrokenProcessPool: a worker died", 0.0)
+            else:
+                print(
+                    f"A worker died with {len(lost)} GCD files in the pool, "
+                    + "writing them again one at a time"
+                )
+                batches.extend([entry] for entry in reversed(lost))
+            pool.shutdown(wait=False)
+            pool = new_pool()
+    finally:
+        pool.shutdown(wait=True)
 
-def get_bad_dom_list(frame):
-    """Get the list of bad DOMs from the GCD file"""
-    # Get the IceTopBadDOMs from the frame
-    bad_dom_list = list(frame["IceTopBadDOMs"])
-    return bad_dom_list
+    print(f"Written {len(entries) - len(failed)} of {len(entries)} GCD files")
+    for entry, error in failed:
+        print(f"Failed {entry['GCD']} -> {entry['outputFile']}: {error}")
+    return failed
 
 
 def main(args):
     __check_args(args)
-    # Load GCD file
-    gcd_file = dataio.I3File(args.GCD)
-    # Create the new GCD file
-    gcd_file_out = dataio.I3File(args.outputFile, "w")
-    # Get the Calibration frame
-    for frame in gcd_file:
-        # Check if the frame is the Detector frame
-        if frame.Stop == icetray.I3Frame.DetectorStatus:
-            # This is the geometry frame thus we add the the SLC calibration values
-            Dframe = frame
-            bad_dom_list = get_bad_dom_list(frame)
-        # Check if the frame is the calibration frame
-        elif frame.Stop == icetray.I3Frame.Calibration:
-            # This is the calibration frame thus we add the the SLC calibration values
-            Cframe = frame
-        else:
-            # This is not the calibration frame and is just pushed to the new GCD file
-            gcd_file_out.push(frame)
 
-    Cframe = write_SLC_Calibration_in_Cframe(args, Cframe, bad_dom_list)
-    gcd_file_out.push(Cframe)
-    gcd_file_out.push(Dframe)
+    if args.manifest != "":
+        failed = run_batch(args)
+        if failed:
+            sys.exit(1)
+        return
 
-    gcd_file_out.close()
+    write_GCD(
+        args.GCD,
+        args.outputFile,
+        lambda frame, bad_dom_list: write_SLC_Calibration_in_Cframe(
+            args, frame, bad_dom_list
+        ),
+    )
     return
 
 
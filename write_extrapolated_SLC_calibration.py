@@ -0,0 +1,127 @@
+#! /usr/bin/env python3
+"""
+This script writes SLC calibrations for future years extrapolated from the calibrations of past years.
+Instead of copying one year forward in time (see write_fake_SLC_calibration.py), a straight line
+is fitted to the p0, p1 and crossover points of every channel over the past years,
+so that the aging of the detector is taken into account.
+
+__author__ = Federico Bontempo KIT PhD student <federico.bontempo@kit.edu>
+
+How to run:
+python3 write_extrapolated_SLC_calibration.py \
+    --calibrations <calibration path> <calibration path> ... \
+    --targetYears <year> <year> ... \
+    --outputFile <output path + name containing {year} + .npz> \
+    [--calibrationYears <year> <year> ...] \
+    [--saveJsonl]
+
+The calibrations can be calibration artifacts, columnar results, jsonl results
+(readSave_HLC_SLC_charges.py) or Level3 pickles keyed by (string, om, chip, atwd).
+The output files are calibration artifacts, read by write_SLC_Calibration_in_GCD.py.
+With --saveJsonl the jsonl file read by the Agnostic_I3IceTopSLCCalibrator is written too.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from utils.calibration_artifact import (
+    artifact_to_resultColumns,
+    load_calibrationSet,
+    save_calibrationArtifact,
+)
+from utils.columnar_results import write_jsonl_fromColumns
+from utils.trend_extrapolation import extrapolate_calibrations
+
+
+def get_args():
+    p = argparse.ArgumentParser()
+    p.add_argument(
+        "--calibrations",
+        type=str,
+        nargs="+",
+        default=[],
+        help="Calibration files of the past years",
+    )
+    p.add_argument(
+        "--calibrationYears",
+        type=float,
+        nargs="+",
+        default=None,
+        help="Year of each calibration file (default: taken from the files)",
+    )
+    p.add_argument(
+        "--targetYears",
+        type=int,
+        nargs="+",
+        default=[],
+        help="Years of the extrapolated calibrations",
+    )
+    p.add_argument(
+        "--outputFile",
+        type=str,
+        default="",
+        help="Output path + name containing {year} + .npz",
+    )
+    p.add_argument(
+        "--saveJsonl",
+        action="store_true",
+        help="Save the extrapolated calibrations also in jsonl files",
+    )
+    return p.parse_args()
+
+
+def __check_args(args):
+    if len(args.calibrations) < 2:
+        print("At least two calibration files are needed")
+        sys.exit(1)
+    for calibration in args.calibrations:
+        if not os.path.exists(calibration):
+            print(f"Calibration file {calibration} does not exist")
+            sys.exit(1)
+    if args.calibrationYears is not None and len(args.calibrationYears) != len(
+        args.calibrations
+    ):
+        print("Give one year for each calibration file")
+        sys.exit(1)
+    if len(args.targetYears) == 0:
+        print("No target year given")
+        sys.exit(1)
+    if "{year}" not in args.outputFile:
+        print("The output file name needs {year}")
+        sys.exit(1)
+    if not os.path.exists(os.path.dirname(os.path.abspath(args.outputFile))):
+        print("The output directory does not exist")
+        sys.exit(1)
+    return
+
+
+def main(args):
+    __check_args(args)
+
+    artifacts = [load_calibrationSet(calibration) for calibration in args.calibrations]
+
+    t0 = time.perf_counter()
+    extrapolated = extrapolate_calibrations(
+        artifacts,
+        args.targetYears,
+        years=args.calibrationYears,
+        sources=args.calibrations,
+    )
+    print(f"Fitted the trends in {time.perf_counter() - t0:.3f} s")
+
+    for targetYear, artifact in zip(args.targetYears, extrapolated):
+        fileName = args.outputFile.replace("{year}", str(targetYear))
+        save_calibrationArtifact(artifact, fileName)
+        print(f"Saved {fileName}")
+        if args.saveJsonl:
+            fileName = os.path.splitext(fileName)[0] + ".jsonl"
+            write_jsonl_fromColumns(artifact_to_resultColumns(artifact), fileName)
+            print(f"Saved {fileName}")
+    return
+
+
+if __name__ == "__main__":
+    main(args=get_args())
+    print("-------------------- Program finished --------------------")
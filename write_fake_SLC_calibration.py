@@ -12,6 +12,16 @@ python3 write_fake_SLC_calibration.py \
     --outputFile <output path + name + .pkl> \
     --originalYear <original year> \
     --fakeYear <fake year>
+
+Bulk mode, several fake years from one load of the original calibration:
+python3 write_fake_SLC_calibration.py \
+    --slcCalibration <SLC calibration .pkl path> \
+    --outputFile <output path + name containing {fakeYear} + .pkl> \
+    --originalYear <original year> \
+    --fakeYears <fake year> <fake year> ...
+
+The times are shifted by the exact number of days between the 1st of January
+of the original year and of the fake year (leap years included).
 """
 
 import argparse
@@ -19,6 +29,7 @@ import datetime
 import pickle
 import sys
 import os
+import numpy as np
 
 
 def get_args():
@@ -38,6 +49,13 @@ def get_args():
     p.add_argument(
         "--fakeYear", type=int, default=0, help="The time of the fake SLC calibration"
     )
+    p.add_argument(
+        "--fakeYears",
+        type=int,
+        nargs="+",
+        default=[],
+        help="The times of several fake SLC calibrations ({fakeYear} in --outputFile)",
+    )
 
     return p.parse_args()
 
@@ -52,63 +70,103 @@ def __check_args(args):
     if args.originalYear == 0:
         print("No original year given")
         sys.exit(1)
-    if args.fakeYear == 0:
+    if args.fakeYear == 0 and len(args.fakeYears) == 0:
         print("No fake year given")
         sys.exit(1)
+    if len(get_fakeYears(args)) > 1 and "{fakeYear}" not in args.outputFile:
+        print("The output file name needs {fakeYear} for several fake years")
+        sys.exit(1)
     return
 
 
+def get_fakeYears(args):
+    """Return the list of fake years given with --fakeYear and --fakeYears"""
+    fakeYears = list(args.fakeYears)
+    if args.fakeYear != 0 and args.fakeYear not in fakeYears:
+        fakeYears.insert(0, args.fakeYear)
+    return fakeYears
+
+
+def get_mjdOffsets(originalYear, fakeYears):
+    """
+    Exact difference in days (mjd) between the 1st of January
+    of the original year and of each fake year, leap years included.
+    """
+    original = datetime.date(originalYear, 1, 1)
+    return np.array(
+        [(datetime.date(fakeYear, 1, 1) - original).days for fakeYear in fakeYears],
+        dtype=np.float64,
+    )
+
+
+def load_SLC_calibration_stacked(fileName):
+    """
+    Load the SLC calibration and stack the time arrays of all OMKeys in one array.
+    ----------------------------------
+    Parameters:
+        fileName: The SLC calibration .pkl path.
+    Returns:
+        slc_calibration: The loaded dictionary {OMKey: (time, intercepts, slopes)}.
+        omkeys: The list of the OMKeys.
+        times: All the time arrays concatenated, OMKey after OMKey.
+        splits: The indices where the times of the next OMKey start.
+    """
+    with open(fileName, "rb") as f:
+        slc_calibration = pickle.load(f)
+
+    omkeys = list(slc_calibration.keys())
+    timeArrays = [np.asarray(slc_calibration[omkey][0]) for omkey in omkeys]
+    times = np.concatenate(timeArrays) if timeArrays else np.array([])
+    splits = np.cumsum([len(t) for t in timeArrays])[:-1]
+    return slc_calibration, omkeys, times, splits
+
+
 def write_fake_SLC_calibration(args):
     # Load SLC calibration
-    with open(args.slcCalibration, "rb") as f:
-        slc_calibration = pickle.load(f)
-        """
-        slc_calibration is a dictionary with the following structure:
-        {
-            (OMKey): (
-                array([float, float, ... float]), # time
-                array([float, float, ... float]), # intercepts
-                array([float, float, ... float]), # slopes
-            )
-            (OMKey): (
-                array([float, float, ... float]), # time
-                array([float, float, ... float]), # intercepts
-                array([float, float, ... float]), # slopes
-            )
-            ...
-        }
-        """
-
-    # Create fake SLC calibration
-    fake_slc_calibration = slc_calibration.copy()
-
-    # Get the difference in years between the original and fake SLC calibration
-    # Calculate the difference in mjd between the original and fake SLC calibration
-    timeDifference = datetime.timedelta(days=365) * (args.fakeYear - args.originalYear)
-    # Make the time difference in mjd
-    timeDifference = timeDifference.total_seconds() / 86400  # seconds in a day
-
-    print("timeDifference: ", timeDifference)
-
-    # Add the difference in mjd to the original SLC cal
-    for omkey in fake_slc_calibration.keys():
-        # Add the time difference to the time array
-        newTime = fake_slc_calibration[omkey][0] + timeDifference
-        # Create the new SLC cal
-        newSlcCal = (
-            newTime,
-            fake_slc_calibration[omkey][1],
-            fake_slc_calibration[omkey][2],
+    slc_calibration, omkeys, times, splits = load_SLC_calibration_stacked(
+        args.slcCalibration
+    )
+    """
+    slc_calibration is a dictionary with the following structure:
+    {
+        (OMKey): (
+            array([float, float, ... float]), # time
+            array([float, float, ... float]), # intercepts
+            array([float, float, ... float]), # slopes
+        )
+        (OMKey): (
+            array([float, float, ... float]), # time
+            array([float, float, ... float]), # intercepts
+            array([float, float, ... float]), # slopes
+        )
+        ...
+    }
+    """
+    intercepts = [slc_calibration[omkey][1] for omkey in omkeys]
+    slopes = [slc_calibration[omkey][2] for omkey in omkeys]
+
+    fakeYears = get_fakeYears(args)
+    # Calculate the difference in mjd between the original and fake SLC calibrations
+    timeDifferences = get_mjdOffsets(args.originalYear, fakeYears)
+    # Add the difference in mjd to the original SLC cal of all the fake years at once
+    newTimes = times[np.newaxis, :] + timeDifferences[:, np.newaxis]
+
+    for fakeYear, timeDifference, newTime in zip(fakeYears, timeDifferences, newTimes):
+        print(f"fakeYear: {fakeYear} timeDifference: {timeDifference}")
+        # The new time arrays are views of the shifted times
+        fake_slc_calibration = dict(
+            zip(omkeys, zip(np.split(newTime, splits), intercepts, slopes))
         )
-        # Add the new SLC cal to the fake SLC cal
-        fake_slc_calibration[omkey] = newSlcCal
 
-    print("Original time: ", slc_calibration[omkey][0])
-    print("New time: ", newTime)
+        # Write fake SLC calibration
+        outputFile = args.outputFile.replace("{fakeYear}", str(fakeYear))
+        with open(outputFile, "wb") as f:
+            pickle.dump(fake_slc_calibration, f)
+        print(f"Saved {outputFile}")
 
-    # Write fake SLC calibration
-    with open(args.outputFile, "wb") as f:
-        pickle.dump(fake_slc_calibration, f)
+    if len(omkeys):
+        print("Original time: ", slc_calibration[omkeys[-1]][0])
+        print("New time: ", fake_slc_calibration[omkeys[-1]][0])
     return
 
 